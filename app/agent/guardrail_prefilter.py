@@ -0,0 +1,230 @@
+import os
+import re
+import sys
+import json
+import math
+import zlib
+import random
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional
+
+from app.services.text_normalize import normalize_text
+
+logger = logging.getLogger(__name__)
+
+GUARDRAIL_PREFILTER_ENABLED = os.getenv("GUARDRAIL_PREFILTER_ENABLED", "true").lower() == "true"
+GUARDRAIL_PREFILTER_MODEL = os.getenv("GUARDRAIL_PREFILTER_MODEL")
+# Xác suất "đạt" >= ALLOW thì cho qua tại chỗ, <= BLOCK thì chặn tại chỗ, còn lại gọi LLM
+GUARDRAIL_PREFILTER_ALLOW_THRESHOLD = float(os.getenv("GUARDRAIL_PREFILTER_ALLOW_THRESHOLD", "0.97"))
+GUARDRAIL_PREFILTER_BLOCK_THRESHOLD = float(os.getenv("GUARDRAIL_PREFILTER_BLOCK_THRESHOLD", "0.02"))
+# Tỉ lệ quyết định tại chỗ vẫn được LLM chấm lại (chạy nền) để theo dõi drift
+GUARDRAIL_PREFILTER_SHADOW_RATE = float(os.getenv("GUARDRAIL_PREFILTER_SHADOW_RATE", "0.02"))
+GUARDRAIL_PREFILTER_AUDIT_LOG = os.getenv("GUARDRAIL_PREFILTER_AUDIT_LOG")
+
+FEATURE_DIMS = 1 << 18
+
+# Các mẫu rõ ràng, so khớp trên văn bản đã chuẩn hoá (chữ thường, không dấu)
+JAILBREAK_PATTERNS = [
+    r"\bdrop\s+(table|database)\b",
+    r"\bdelete\s+from\b",
+    r"\bunion\s+select\b",
+    r"\bsystem\s+prompt\b",
+    r"\b(hien thi|in ra|tiet lo|cho xem)\b.*\b(prompt|huong dan he thong|chi dan he thong)\b",
+    r"\b(bo qua|quen|phot lo)\b.*\b(huong dan|chi dan|quy tac)\b.*\b(truoc|tren|he thong)\b",
+    r"\bignore\b.*\b(previous|above|all)\b.*\binstructions?\b",
+    r"\b(xuat|tai|dump)\b.*\btoan bo du lieu\b",
+    r"\bban dang (chay|dung|su dung) (mo hinh|model) gi\b",
+    r"\bjailbreak\b",
+    r"\bdan mode\b",
+    r"\bscript\b.*\balert\b",
+]
+
+SAFE_SMALLTALK = [
+    "hi", "hello", "helo", "alo", "xin chao", "chao", "chao ban", "chao ad", "chao admin",
+    "cam on", "cam on ban", "thanks", "thank you", "ok", "oke", "vang", "da", "toi can giup do",
+    "ban la ai", "fiine la gi",
+]
+
+RELEVANT_PATTERNS = [
+    r"\bchuyen doi so\b",
+    r"\bso hoa\b",
+    r"\bdoan thanh nien\b",
+    r"\bcong doan\b",
+    r"\bfiine\b",
+    r"\bnen tang so\b",
+    r"\b(du lieu so|ky nang so|van hoa so)\b",
+]
+
+_jailbreak_re = re.compile("|".join(f"(?:{p})" for p in JAILBREAK_PATTERNS))
+_relevant_re = re.compile("|".join(f"(?:{p})" for p in RELEVANT_PATTERNS))
+_smalltalk = set(SAFE_SMALLTALK)
+
+
+@dataclass
+class PrefilterDecision:
+    verdict: Optional[bool]  # True = đạt, False = chặn, None = cần hỏi LLM
+    probability: float
+    source: str
+    reasoning: str = ""
+
+
+def _features(normalized: str) -> List[int]:
+    tokens = normalized.split()
+    grams = tokens + [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+    return [zlib.crc32(g.encode("utf-8")) % FEATURE_DIMS for g in grams]
+
+
+def _sigmoid(x: float) -> float:
+    if x < -30:
+        return 0.0
+    if x > 30:
+        return 1.0
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+class LinearModel:
+    """
+    Hồi quy logistic trên feature băm (unigram + bigram âm tiết), huấn luyện từ audit log
+    """
+
+    def __init__(self, bias: float = 0.0, weights: Optional[Dict[int, float]] = None):
+        self.bias = bias
+        self.weights = weights or {}
+
+    def predict(self, normalized: str) -> float:
+        score = self.bias + sum(self.weights.get(f, 0.0) for f in _features(normalized))
+        return _sigmoid(score)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"bias": self.bias, "weights": {str(k): v for k, v in self.weights.items() if abs(v) > 1e-6}}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LinearModel":
+        return cls(data.get("bias", 0.0), {int(k): float(v) for k, v in data.get("weights", {}).items()})
+
+    @classmethod
+    def train(cls, samples: List[tuple], epochs: int = 10, lr: float = 0.2, l2: float = 1e-5) -> "LinearModel":
+        model = cls()
+        samples = list(samples)
+        for _ in range(epochs):
+            random.shuffle(samples)
+            for normalized, label in samples:
+                feats = _features(normalized)
+                error = model.predict(normalized) - (1.0 if label else 0.0)
+                model.bias -= lr * error
+                for f in feats:
+                    w = model.weights.get(f, 0.0)
+                    model.weights[f] = w - lr * (error + l2 * w)
+        return model
+
+
+def _load_models(path: Optional[str]) -> Dict[str, LinearModel]:
+    if not path:
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return {kind: LinearModel.from_dict(params) for kind, params in data.items()}
+    except Exception as e:
+        logger.error(f"Không nạp được model pre-filter guardrail {path}: {e}")
+        return {}
+
+
+_models = _load_models(GUARDRAIL_PREFILTER_MODEL)
+
+_audit_logger = logging.getLogger(f"{__name__}.audit")
+if GUARDRAIL_PREFILTER_AUDIT_LOG:
+    _handler = logging.FileHandler(GUARDRAIL_PREFILTER_AUDIT_LOG, encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _audit_logger.addHandler(_handler)
+    _audit_logger.setLevel(logging.INFO)
+    _audit_logger.propagate = False
+
+
+def classify(kind: str, message: str) -> PrefilterDecision:
+    """
+    Phân loại nhanh tại chỗ cho guardrail `kind` ("relevance" | "jailbreak")
+    """
+    if not GUARDRAIL_PREFILTER_ENABLED:
+        return PrefilterDecision(None, 0.5, "disabled")
+    normalized = normalize_text(message)
+    if not normalized:
+        return PrefilterDecision(None, 0.5, "empty")
+
+    if _jailbreak_re.search(normalized):
+        if kind == "jailbreak":
+            return PrefilterDecision(False, 0.0, "rule", "Tin nhắn khớp mẫu khai thác hệ thống đã biết.")
+        return PrefilterDecision(None, 0.5, "rule")
+
+    if normalized in _smalltalk:
+        return PrefilterDecision(True, 1.0, "rule", "Lời chào/giao tiếp thông thường.")
+
+    if kind == "relevance" and _relevant_re.search(normalized):
+        return PrefilterDecision(True, 1.0, "rule", "Tin nhắn thuộc chủ đề chuyển đổi số/dịch vụ.")
+
+    model = _models.get(kind)
+    if model is None:
+        return PrefilterDecision(None, 0.5, "no_model")
+    p = model.predict(normalized)
+    if p >= GUARDRAIL_PREFILTER_ALLOW_THRESHOLD:
+        return PrefilterDecision(True, p, "model", "Bộ phân loại cục bộ đánh giá là hợp lệ.")
+    if p <= GUARDRAIL_PREFILTER_BLOCK_THRESHOLD:
+        return PrefilterDecision(False, p, "model", "Bộ phân loại cục bộ đánh giá là không hợp lệ.")
+    return PrefilterDecision(None, p, "model")
+
+
+def should_shadow() -> bool:
+    return random.random() < GUARDRAIL_PREFILTER_SHADOW_RATE
+
+
+def audit(kind: str, message: str, decision: PrefilterDecision, llm_verdict: Optional[bool] = None, shadow: bool = False):
+    """
+    Ghi quyết định pre-filter (và verdict của LLM nếu có) dạng JSON một dòng,
+    dùng để đối chiếu drift và làm dữ liệu huấn luyện lại
+    """
+    record = {
+        "guardrail": kind,
+        "message": normalize_text(message),
+        "verdict": decision.verdict,
+        "probability": round(decision.probability, 4),
+        "source": decision.source,
+        "llm_verdict": llm_verdict,
+        "shadow": shadow,
+    }
+    if decision.verdict is not None and llm_verdict is not None and decision.verdict != llm_verdict:
+        record["disagree"] = True
+        logger.warning(f"Pre-filter guardrail {kind} khác verdict LLM: {record}")
+    _audit_logger.info(json.dumps(record, ensure_ascii=False))
+
+
+def _training_samples(records: Iterable[Dict[str, Any]], kind: str) -> List[tuple]:
+    return [
+        (r["message"], bool(r["llm_verdict"]))
+        for r in records
+        if r.get("guardrail") == kind and r.get("llm_verdict") is not None and r.get("message")
+    ]
+
+
+def train_from_audit_log(log_path: str, output_path: str, epochs: int = 10):
+    """
+    Huấn luyện model cho cả hai guardrail từ audit log (các dòng có llm_verdict)
+    """
+    with open(log_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip().startswith("{")]
+    models = {}
+    for kind in ("relevance", "jailbreak"):
+        samples = _training_samples(records, kind)
+        if samples:
+            models[kind] = LinearModel.train(samples, epochs=epochs).to_dict()
+            print(f"{kind}: {len(samples)} mẫu")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(models, f)
+
+
+if __name__ == "__main__":
+    # python -m app.agent.guardrail_prefilter <audit_log.jsonl> <model.json>
+    if len(sys.argv) != 3:
+        print("Cách dùng: python -m app.agent.guardrail_prefilter <audit_log.jsonl> <model.json>")
+        sys.exit(1)
+    train_from_audit_log(sys.argv[1], sys.argv[2])
@@ -4,7 +4,7 @@ from agents import Agent, FileSearchTool
 import openai
 from app.agent.formatter_agent import CompanyAgentContext
 from agents.extensions.handoff_prompt import RECOMMENDED_PROMPT_PREFIX
-from app.agent.guardrail import relevance_guardrail, jailbreak_guardrail
+from app.agent.guardrail import active_input_guardrails
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -80,5 +80,5 @@ company_info_agent = Agent[CompanyAgentContext](
             vector_store_ids=["vs_691591c8d17c81918e17ad65136010d1"],
         )
     ],
-    input_guardrails=[relevance_guardrail, jailbreak_guardrail],
+    input_guardrails=active_input_guardrails(),
 )
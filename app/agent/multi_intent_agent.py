@@ -1,11 +1,31 @@
-from typing import List, Tuple
+import os
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+from agents import Agent, Runner
+from app.agent.formatter_agent import CompanyAgentContext
 from app.agent.info_agent import company_info_agent
 from app.agent.price_agent import company_price_agent
 from app.agent.support_error_agent import company_support_error_agent
 from app.agent.support_technical_agent import company_support_technical_agent
 
+logger = logging.getLogger(__name__)
+
+# Bật luồng tách intent và gọi song song các agent chuyên trách cho câu hỏi nhiều ý
+MULTI_INTENT_ENABLED = os.getenv("MULTI_INTENT_ENABLED", "false").lower() == "true"
+MULTI_INTENT_BRANCH_TIMEOUT = float(os.getenv("MULTI_INTENT_BRANCH_TIMEOUT", "30"))
+MULTI_INTENT_MERGE_TIMEOUT = float(os.getenv("MULTI_INTENT_MERGE_TIMEOUT", "15"))
+
 # Optional: You can add LLM-based parsing for more intelligent query splitting
 
+# Từ khoá nhận diện từng intent; dùng chung với pre-router (app/agent/pre_router.py)
+INTENT_KEYWORDS: Dict[str, List[str]] = {
+    "company_info": ["tên công ty", "địa chỉ", "lịch sử", "fiine là gì"],
+    "company_price": ["gói dịch vụ", "giá", "bao nhiêu", "phí", "chi phí"],
+    "company_support_error": ["lỗi", "sự cố", "không vào được", "bị treo"],
+    "company_support_technical": ["cách dùng", "tạo công việc", "hướng dẫn", "tính năng"],
+}
+
 def split_intents(user_query: str) -> List[Tuple[str, str]]:
     """
     Tách câu hỏi thành các intent nhỏ theo loại tác vụ.
@@ -14,46 +34,96 @@ def split_intents(user_query: str) -> List[Tuple[str, str]]:
     user_query_lower = user_query.lower()
     sub_queries = []
 
-    if any(kw in user_query_lower for kw in ["tên công ty", "địa chỉ", "lịch sử", "fiine là gì"]):
+    if any(kw in user_query_lower for kw in INTENT_KEYWORDS["company_info"]):
         sub_queries.append(("company_info", "Công ty tên là gì và làm gì?"))
 
-    if any(kw in user_query_lower for kw in ["gói dịch vụ", "giá", "bao nhiêu", "phí", "chi phí"]):
+    if any(kw in user_query_lower for kw in INTENT_KEYWORDS["company_price"]):
         sub_queries.append(("company_price", "Fiine đang cung cấp các gói dịch vụ nào và mức giá là bao nhiêu?"))
 
-    if any(kw in user_query_lower for kw in ["lỗi", "sự cố", "không vào được", "bị treo"]):
+    if any(kw in user_query_lower for kw in INTENT_KEYWORDS["company_support_error"]):
         sub_queries.append(("company_support_error", user_query))
 
-    if any(kw in user_query_lower for kw in ["cách dùng", "tạo công việc", "hướng dẫn", "tính năng"]):
+    if any(kw in user_query_lower for kw in INTENT_KEYWORDS["company_support_technical"]):
         sub_queries.append(("company_support_technical", user_query))
 
     return sub_queries
 
 
-def call_agents_for_query(user_query: str) -> str:
+INTENT_AGENTS = {
+    "company_info": company_info_agent,
+    "company_price": company_price_agent,
+    "company_support_error": company_support_error_agent,
+    "company_support_technical": company_support_technical_agent,
+}
+
+multi_intent_merge_agent = Agent[CompanyAgentContext](
+    name="Multi-intent Formatter",
+    model="gpt-4.1-mini",
+    instructions=(
+        "Bạn nhận câu hỏi gốc của khách hàng và các câu trả lời riêng lẻ cho từng ý của câu hỏi.\n"
+        "Hãy gộp chúng thành MỘT câu trả lời mạch lạc, chia đoạn/gạch đầu dòng theo từng ý.\n"
+        "Không thêm thông tin mới, không bỏ sót thông tin quan trọng, bỏ phần trùng lặp và lời chào lặp lại."
+    ),
+)
+
+
+def is_multi_intent(user_query: str) -> bool:
+    """
+    Câu hỏi có nhiều ý: có từ 2 dấu nối trở lên và tách được ít nhất 2 intent
+    """
+    if sum(user_query.count(sep) for sep in ["và", "với", ",", "cùng"]) < 2:
+        return False
+    return len(split_intents(user_query)) >= 2
+
+
+async def _run_branch(intent: str, agent: Agent, sub_query: str, context: Optional[CompanyAgentContext]) -> str:
+    # Guardrail đã chạy một lần cho cả câu hỏi; nhánh không handoff ngược về triage
+    branch_agent = agent.clone(input_guardrails=[], handoffs=[])
+    result = await asyncio.wait_for(
+        Runner.run(branch_agent, sub_query, context=context),
+        timeout=MULTI_INTENT_BRANCH_TIMEOUT,
+    )
+    return str(result.final_output or "")
+
+
+async def _merge_responses(user_query: str, responses: List[Tuple[str, str]], context: Optional[CompanyAgentContext]) -> str:
+    parts = "\n\n".join(f"[{intent}]\n{text}" for intent, text in responses)
+    prompt = f"Câu hỏi gốc: {user_query}\n\nCác câu trả lời thành phần:\n{parts}"
+    try:
+        result = await asyncio.wait_for(
+            Runner.run(multi_intent_merge_agent, prompt, context=context),
+            timeout=MULTI_INTENT_MERGE_TIMEOUT,
+        )
+        return str(result.final_output)
+    except Exception as e:
+        logger.warning(f"Không gộp được câu trả lời multi-intent, nối trực tiếp: {e}")
+        return "\n\n".join(text for _, text in responses)
+
+
+async def call_agents_for_query(user_query: str, context: Optional[CompanyAgentContext] = None) -> str:
     """
-    Gọi tuần tự các agent theo từng phần câu hỏi và hợp nhất kết quả.
+    Gọi song song các agent theo từng phần câu hỏi (mỗi nhánh có timeout) và hợp nhất kết quả.
     """
-    intent_to_agent = {
-        "company_info": company_info_agent,
-        "company_price": company_price_agent,
-        "company_support_error": company_support_error_agent,
-        "company_support_technical": company_support_technical_agent,
-    }
-
-    sub_queries = split_intents(user_query)
-    responses = []
-
-    for intent, sub_query in sub_queries:
-        agent = intent_to_agent.get(intent)
-        if agent:
-            try:
-                result = agent.run(sub_query)
-                if result:
-                    responses.append(result)
-            except Exception as e:
-                responses.append(f"[Lỗi khi gọi {intent}]: {str(e)}")
+    sub_queries = [
+        (intent, sub_query) for intent, sub_query in split_intents(user_query) if intent in INTENT_AGENTS
+    ]
+    results = await asyncio.gather(
+        *(_run_branch(intent, INTENT_AGENTS[intent], sub_query, context) for intent, sub_query in sub_queries),
+        return_exceptions=True,
+    )
+
+    responses: List[Tuple[str, str]] = []
+    for (intent, _), result in zip(sub_queries, results):
+        if isinstance(result, asyncio.TimeoutError):
+            logger.warning(f"Nhánh {intent} quá thời gian {MULTI_INTENT_BRANCH_TIMEOUT}s")
+            responses.append((intent, f"[{intent}]: Xin lỗi, phần này đang mất nhiều thời gian, bạn vui lòng hỏi lại sau."))
+        elif isinstance(result, BaseException):
+            responses.append((intent, f"[Lỗi khi gọi {intent}]: {str(result)}"))
+        elif result:
+            responses.append((intent, result))
 
     if not responses:
         return "Xin lỗi, tôi không thể xác định được yêu cầu của bạn. Bạn vui lòng nói rõ hơn nhé."
-
-    return "\n\n".join(responses)
+    if len(responses) == 1:
+        return responses[0][1]
+    return await _merge_responses(user_query, responses, context)
@@ -0,0 +1,141 @@
+import os
+import json
+import logging
+import threading
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+from app.agent.multi_intent_agent import INTENT_AGENTS, INTENT_KEYWORDS
+from app.services.keyword_matcher import KeywordMatcher
+from app.services.text_normalize import collapse_whitespace, fold_diacritics
+
+logger = logging.getLogger(__name__)
+
+PRE_ROUTER_ENABLED = os.getenv("PRE_ROUTER_ENABLED", "false").lower() == "true"
+# Các intent được phép gửi thẳng tới agent chuyên trách (cách nhau bởi dấu phẩy)
+PRE_ROUTER_ROUTES = [r.strip() for r in os.getenv("PRE_ROUTER_ROUTES", "company_info").split(",") if r.strip()]
+PRE_ROUTER_MIN_HITS = int(os.getenv("PRE_ROUTER_MIN_HITS", "2"))
+# Chỉ một lần khớp vẫn được định tuyến nếu từ khoá chiếm ít nhất tỉ lệ này số âm tiết của tin nhắn
+PRE_ROUTER_MIN_COVERAGE = float(os.getenv("PRE_ROUTER_MIN_COVERAGE", "0.5"))
+# Tin nhắn dài hơn số âm tiết này luôn để Triage Agent quyết định
+PRE_ROUTER_MAX_WORDS = int(os.getenv("PRE_ROUTER_MAX_WORDS", "30"))
+
+# Từ khoá bổ sung ngoài INTENT_KEYWORDS (chủ đề chính của Company Info Agent)
+EXTRA_INTENT_KEYWORDS: Dict[str, List[str]] = {
+    "company_info": ["chuyển đổi số", "số hoá", "số hóa", "đoàn thanh niên", "công đoàn", "nền tảng số"],
+}
+
+
+def _load_keywords() -> Dict[str, List[str]]:
+    keywords = {intent: list(kws) for intent, kws in INTENT_KEYWORDS.items()}
+    for intent, kws in EXTRA_INTENT_KEYWORDS.items():
+        keywords.setdefault(intent, []).extend(kws)
+    raw = os.getenv("PRE_ROUTER_EXTRA_KEYWORDS")
+    if raw:
+        try:
+            for intent, kws in json.loads(raw).items():
+                keywords.setdefault(intent, []).extend(kws)
+        except Exception as e:
+            logger.error(f"PRE_ROUTER_EXTRA_KEYWORDS không hợp lệ: {e}")
+    return keywords
+
+
+def _prepare(text: str) -> str:
+    return collapse_whitespace(unicodedata.normalize("NFC", text.lower()))
+
+
+class PreRouter:
+    """
+    Định tuyến tất định trước Triage Agent: nếu tin nhắn ngắn chỉ khớp từ khoá của
+    đúng một intent (và intent đó được bật), với ít nhất min_hits lần khớp hoặc từ khoá
+    chiếm phần lớn tin nhắn, thì chuyển thẳng tới agent chuyên trách,
+    còn lại để Triage Agent (LLM) quyết định.
+    """
+
+    def __init__(
+        self,
+        keywords: Dict[str, List[str]],
+        routes: List[str],
+        min_hits: int = PRE_ROUTER_MIN_HITS,
+        min_coverage: float = PRE_ROUTER_MIN_COVERAGE,
+        max_words: int = PRE_ROUTER_MAX_WORDS,
+    ):
+        entries = []
+        for intent, kws in keywords.items():
+            for kw in kws:
+                kw = _prepare(kw)
+                entries.append((kw, intent))
+                # Người dùng hay gõ không dấu: chỉ thêm bản bỏ dấu cho từ khoá nhiều âm tiết để tránh nhầm
+                folded = fold_diacritics(kw)
+                if folded != kw and len(kw.split()) >= 2:
+                    entries.append((folded, intent))
+        self._matcher = KeywordMatcher(entries)
+        self.routes = set(routes)
+        self.min_hits = min_hits
+        self.min_coverage = min_coverage
+        self.max_words = max_words
+        self._lock = threading.Lock()
+        self._route_hits: Dict[str, int] = {}
+        self._fallbacks: Dict[str, int] = {}
+        self._total = 0
+
+    def _count(self, bucket: Dict[str, int], key: str):
+        with self._lock:
+            bucket[key] = bucket.get(key, 0) + 1
+
+    def route(self, message: str) -> Optional[Any]:
+        """
+        Trả về agent đích nếu đủ chắc chắn, ngược lại None (dùng Triage Agent)
+        """
+        with self._lock:
+            self._total += 1
+        text = _prepare(message)
+        words = len(text.split())
+        if words > self.max_words:
+            self._count(self._fallbacks, "too_long")
+            return None
+        matches = self._matcher.find(text)
+        hits: Dict[str, int] = {}
+        for _, intent, _ in matches:
+            hits[intent] = hits.get(intent, 0) + 1
+
+        if not hits:
+            self._count(self._fallbacks, "no_match")
+            return None
+        if len(hits) > 1:
+            self._count(self._fallbacks, "multi_intent")
+            return None
+        intent, count = next(iter(hits.items()))
+        if intent not in self.routes or intent not in INTENT_AGENTS:
+            self._count(self._fallbacks, "route_disabled")
+            return None
+        # Một lần khớp (ví dụ "nhân sự" trong một câu hỏi dài) chưa đủ chắc chắn,
+        # trừ khi tin nhắn gần như chỉ gồm từ khoá đó
+        covered = sum(len(keyword.split()) for keyword in {kw for kw, _, _ in matches})
+        if count < self.min_hits and covered < self.min_coverage * words:
+            self._count(self._fallbacks, "low_confidence")
+            return None
+
+        self._count(self._route_hits, intent)
+        return INTENT_AGENTS[intent]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            routed = sum(self._route_hits.values())
+            return {
+                "enabled": PRE_ROUTER_ENABLED,
+                "routes": sorted(self.routes),
+                "min_hits": self.min_hits,
+                "min_coverage": self.min_coverage,
+                "max_words": self.max_words,
+                "total": self._total,
+                "routed": routed,
+                "routed_rate": (routed / self._total) if self._total else 0.0,
+                "route_hits": {
+                    intent: {"count": n, "rate": n / self._total} for intent, n in self._route_hits.items()
+                },
+                "fallbacks": dict(self._fallbacks),
+            }
+
+
+pre_router = PreRouter(_load_keywords(), PRE_ROUTER_ROUTES)
@@ -4,7 +4,7 @@ from dotenv import load_dotenv
 from agents import Agent, FileSearchTool
 from app.agent.formatter_agent import CompanyAgentContext
 from agents.extensions.handoff_prompt import RECOMMENDED_PROMPT_PREFIX
-from app.agent.guardrail import relevance_guardrail, jailbreak_guardrail
+from app.agent.guardrail import active_input_guardrails
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -55,5 +55,5 @@ Vui lòng chọn thời gian sử dụng để tôi cung cấp chi phí cụ th
             vector_store_ids=["vs_688347155a848191af744d7c2a0cd5f0"],
         )
     ],
-    input_guardrails=[relevance_guardrail, jailbreak_guardrail],
+    input_guardrails=active_input_guardrails(),
 )
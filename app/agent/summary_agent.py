@@ -0,0 +1,21 @@
+import os
+import openai
+from dotenv import load_dotenv
+from agents import Agent
+from app.agent.formatter_agent import CompanyAgentContext
+
+load_dotenv()
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+history_summary_agent = Agent[CompanyAgentContext](
+    name="History Summarizer",
+    model="gpt-4.1-mini",
+    instructions=(
+        "Bạn tóm tắt lịch sử hội thoại giữa khách hàng và trợ lý để dùng làm ngữ cảnh cho các lượt sau.\n"
+        "Đầu vào gồm bản tóm tắt trước đó (nếu có) và các lượt hội thoại cũ hơn cần gộp vào.\n"
+        "- Giữ lại: nhu cầu, câu hỏi chính của khách, thông tin khách đã cung cấp, các kết luận/câu trả lời quan trọng.\n"
+        "- Bỏ qua: lời chào, nội dung lặp lại, trích dẫn tài liệu dài.\n"
+        "- Viết bằng tiếng Việt, dạng gạch đầu dòng, tối đa khoảng 200 từ.\n"
+        "Chỉ trả về bản tóm tắt, không giải thích thêm."
+    ),
+)
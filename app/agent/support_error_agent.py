@@ -4,7 +4,7 @@ from agents import Agent, FileSearchTool, function_tool
 import openai
 from app.agent.formatter_agent import CompanyAgentContext
 from agents.extensions.handoff_prompt import RECOMMENDED_PROMPT_PREFIX
-from app.agent.guardrail import relevance_guardrail, jailbreak_guardrail
+from app.agent.guardrail import active_input_guardrails
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -48,5 +48,5 @@ company_support_error_agent = Agent[CompanyAgentContext](
             max_num_results=3,
             vector_store_ids=["vs_6892cfb3811c81918a701f7b04388b98"], 
         )],
-    input_guardrails=[relevance_guardrail, jailbreak_guardrail],
+    input_guardrails=active_input_guardrails(),
 )
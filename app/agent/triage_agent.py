@@ -8,17 +8,21 @@ from app.agent.info_agent import company_info_agent
 from app.agent.price_agent import company_price_agent
 from app.agent.support_error_agent import company_support_error_agent
 from app.agent.support_technical_agent import company_support_technical_agent
-from app.agent.guardrail import relevance_guardrail, jailbreak_guardrail
-from app.agent.multi_intent_agent import call_agents_for_query
+from app.agent.guardrail import active_input_guardrails
+from app.agent.multi_intent_agent import MULTI_INTENT_ENABLED, call_agents_for_query, is_multi_intent
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 class SmartTriageAgent(Agent[CompanyAgentContext]):
-    def run(self, query: str) -> str:
-        if sum(query.count(sep) for sep in ["và", "với", ",", "cùng"]) >= 2:
-            return call_agents_for_query(query)
-        return super().run(query)
+    def wants_multi_intent(self, query: str) -> bool:
+        return MULTI_INTENT_ENABLED and is_multi_intent(query)
+
+    async def run_multi_intent(self, query: str, context: CompanyAgentContext) -> str:
+        """
+        Câu hỏi nhiều ý: gọi song song các agent chuyên trách rồi gộp câu trả lời
+        """
+        return await call_agents_for_query(query, context)
 
 triage_agent = SmartTriageAgent(
     name="Triage Agent",
@@ -73,7 +77,7 @@ Chỉ trả về duy nhất nhãn phân loại, không giải thích thêm.
         company_support_error_agent,
         company_support_technical_agent,
     ],
-    input_guardrails=[relevance_guardrail, jailbreak_guardrail],
+    input_guardrails=active_input_guardrails(),
 )
 
 company_info_agent.handoffs.append(triage_agent)
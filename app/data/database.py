@@ -1,19 +1,78 @@
 import os
-from pymongo import MongoClient
+import logging
+from pymongo import AsyncMongoClient
+from pymongo.errors import BulkWriteError
 from dotenv import load_dotenv
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
+from app.data.pagination import InvalidCursor, fetch_page
 
 load_dotenv()
 
-client = MongoClient(os.getenv("MONGO_URI"))
+logger = logging.getLogger(__name__)
+
+# Pool kết nối dùng chung cho toàn bộ worker (một client cho mỗi tiến trình)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+
+client = AsyncMongoClient(
+    os.getenv("MONGO_URI"),
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+)
 db = client["chatbotagent"]
 user_collection = db["users"]
 chat_collection = db["chats"]
 chat_history_collection = db["chat_history"]
 technical_error_collection = db["technical_errors"]
+conversation_state_collection = db["conversation_states"]
+
+DUPLICATE_KEY_ERROR = 11000
+
+async def ping_database() -> bool:
+    """
+    Kiểm tra kết nối MongoDB (gọi trong lifespan lúc khởi động)
+    """
+    try:
+        await client.admin.command("ping")
+        return True
+    except Exception as e:
+        logger.error(f"Không kết nối được MongoDB: {e}")
+        return False
+
+async def close_database():
+    await client.close()
 
-def save_chat_history(
+async def insert_new_documents(collection, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    insert_many không theo thứ tự, bỏ qua document trùng _id (ghi lại từ spool).
+    Trả về các document mới thực sự được ghi.
+    """
+    if not docs:
+        return []
+    try:
+        await collection.insert_many(docs, ordered=False)
+        return docs
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != DUPLICATE_KEY_ERROR for err in errors):
+            raise
+        duplicated = {err.get("index") for err in errors}
+        return [doc for i, doc in enumerate(docs) if i not in duplicated]
+
+async def insert_many_idempotent(collection, docs: List[Dict[str, Any]]) -> int:
+    """
+    Như insert_new_documents, trả về số document mới được ghi
+    """
+    return len(await insert_new_documents(collection, docs))
+
+async def save_chat_history(
     conversation_id: str,
     user_id: str,
     question: str,
@@ -37,27 +96,28 @@ def save_chat_history(
             "events": events
         }
         
-        result = chat_history_collection.insert_one(chat_doc)
+        result = await chat_history_collection.insert_one(chat_doc)
         return result.inserted_id is not None
     except Exception as e:
         print(f"Lỗi khi lưu lịch sử chat: {e}")
         return False
 
-def get_chat_history_by_user(user_id: str, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
+async def get_chat_history_by_user(
+    user_id: str, limit: int = 50, offset: int = 0, cursor: Optional[str] = None
+) -> List[Dict[str, Any]]:
     """
-    Lấy lịch sử chat của user từ database
+    Lấy lịch sử chat của user từ database (offset hoặc cursor keyset)
     """
     try:
-        cursor = chat_history_collection.find(
-            {"user_id": user_id}
-        ).sort("timestamp", -1).skip(offset).limit(limit)
-        
-        return list(cursor)
+        docs, _, _ = await fetch_page(chat_history_collection, {"user_id": user_id}, limit, offset, cursor)
+        return docs
+    except InvalidCursor:
+        raise
     except Exception as e:
         print(f"Lỗi khi lấy lịch sử chat: {e}")
         return []
 
-def get_chat_history_by_conversation(conversation_id: str) -> List[Dict[str, Any]]:
+async def get_chat_history_by_conversation(conversation_id: str) -> List[Dict[str, Any]]:
     """
     Lấy lịch sử chat theo conversation_id
     """
@@ -66,12 +126,37 @@ def get_chat_history_by_conversation(conversation_id: str) -> List[Dict[str, Any
             {"conversation_id": conversation_id}
         ).sort("timestamp", 1)  # Sắp xếp theo thời gian tăng dần
         
-        return list(cursor)
+        return await cursor.to_list()
     except Exception as e:
         print(f"Lỗi khi lấy lịch sử chat theo conversation: {e}")
         return []
 
-def save_technical_error_report(
+def build_technical_error_report(
+    name: str,
+    organization: str,
+    error_content: str,
+    phone: str = None,
+    email: str = None,
+    image_url: str = None
+) -> Dict[str, Any]:
+    """
+    Tạo document báo cáo lỗi kỹ thuật
+    """
+    # Kiểm tra ít nhất phải có email hoặc số điện thoại
+    if not phone and not email:
+        raise ValueError("Phải cung cấp ít nhất email hoặc số điện thoại")
+
+    return {
+        "name": name,
+        "organization": organization,
+        "phone": phone,
+        "email": email,
+        "error_content": error_content,
+        "image_url": image_url,
+        "timestamp": datetime.utcnow()
+    }
+
+async def save_technical_error_report(
     name: str,
     organization: str,
     error_content: str,
@@ -83,44 +168,47 @@ def save_technical_error_report(
     Lưu báo cáo lỗi kỹ thuật vào database
     """
     try:
-        # Kiểm tra ít nhất phải có email hoặc số điện thoại
-        if not phone and not email:
-            raise ValueError("Phải cung cấp ít nhất email hoặc số điện thoại")
-        
-        error_report = {
-            "name": name,
-            "organization": organization,
-            "phone": phone,
-            "email": email,
-            "error_content": error_content,
-            "image_url": image_url,
-            "timestamp": datetime.utcnow()
-        }
-        
-        result = technical_error_collection.insert_one(error_report)
+        error_report = build_technical_error_report(name, organization, error_content, phone, email, image_url)
+        result = await technical_error_collection.insert_one(error_report)
         return result.inserted_id is not None
     except Exception as e:
         print(f"Lỗi khi lưu báo cáo lỗi kỹ thuật: {e}")
         return False
 
-def get_technical_error_reports(limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
+async def save_technical_error_reports(reports: List[Dict[str, Any]]) -> int:
+    """
+    Lưu một lô báo cáo lỗi kỹ thuật (handler của hàng đợi ghi nền)
+    """
+    return await insert_many_idempotent(technical_error_collection, reports)
+
+async def get_technical_error_reports(limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
     """
     Lấy danh sách báo cáo lỗi kỹ thuật từ database
     """
+    reports, _, _ = await get_technical_error_reports_page(limit, offset)
+    return reports
+
+async def get_technical_error_reports_page(
+    limit: int = 50, offset: int = 0, cursor: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str], bool]:
+    """
+    Lấy một trang báo cáo lỗi kỹ thuật, trả về (reports, next_cursor, has_more)
+    """
     try:
-        cursor = technical_error_collection.find().sort("timestamp", -1).skip(offset).limit(limit)
-        return list(cursor)
+        return await fetch_page(technical_error_collection, {}, limit, offset, cursor)
+    except InvalidCursor:
+        raise
     except Exception as e:
         print(f"Lỗi khi lấy danh sách báo cáo lỗi kỹ thuật: {e}")
-        return []
+        return [], None, False
 
-def get_technical_error_report_by_id(report_id: str) -> Dict[str, Any]:
+async def get_technical_error_report_by_id(report_id: str) -> Dict[str, Any]:
     """
     Lấy báo cáo lỗi kỹ thuật theo ID
     """
     try:
         from bson import ObjectId
-        return technical_error_collection.find_one({"_id": ObjectId(report_id)})
+        return await technical_error_collection.find_one({"_id": ObjectId(report_id)})
     except Exception as e:
         print(f"Lỗi khi lấy báo cáo lỗi kỹ thuật theo ID: {e}")
         return None
@@ -0,0 +1,193 @@
+import os
+import sys
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from app.data.database import db, close_database
+from app.services.chat_buckets import CHAT_BUCKET_LEDGER_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "true").lower() == "true"
+MONGO_VERIFY_INDEXES = os.getenv("MONGO_VERIFY_INDEXES", "false").lower() == "true"
+
+# collection -> index cần có; tên index cố định để create_indexes idempotent
+INDEX_SPECS: Dict[str, List[IndexModel]] = {
+    "chat_history": [
+        # find({user_id}).sort(timestamp), thống kê theo user trong khoảng thời gian
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], name="user_timestamp"),
+        # find({conversation_id}).sort(timestamp)
+        IndexModel([("conversation_id", ASCENDING), ("timestamp", ASCENDING)], name="conversation_timestamp"),
+    ],
+    "chat_history_buckets": [
+        # Ghi: tìm bucket còn chỗ của conversation; đọc: các bucket của conversation
+        IndexModel([("conversation_id", ASCENDING), ("count", ASCENDING)], name="conversation_count"),
+        # Lịch sử/thống kê theo user trong khoảng thời gian
+        IndexModel([("user_id", ASCENDING), ("end_ts", DESCENDING)], name="user_end_ts"),
+        # Kiểm tra lượt đã được $push khi tiếp quản claim, nạp lượt theo _id cho kết quả tìm kiếm
+        IndexModel([("turns._id", ASCENDING)], name="turn_id"),
+    ],
+    "chat_history_bucket_turns": [
+        # Ledger giành quyền ghi lượt (_id unique); entry hết hạn sau thời gian có thể replay spool
+        IndexModel([("claimed_at", ASCENDING)], name="claimed_at_ttl", expireAfterSeconds=CHAT_BUCKET_LEDGER_TTL_SECONDS),
+    ],
+    "conversations": [
+        # Danh sách conversation của user (keyset theo updated_at)
+        IndexModel([("user_id", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)], name="user_updated_at"),
+    ],
+    "chat_turn_payloads": [
+        # Dựng context: đọc ngược theo conversation tới snapshot gần nhất
+        IndexModel([("conversation_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], name="conversation_timestamp"),
+        IndexModel([("user_id", ASCENDING)], name="user"),
+    ],
+    "chat_search_postings": [
+        # Multikey theo terms.term: các lượt chứa một term của user, mới nhất trước
+        IndexModel([("user_id", ASCENDING), ("terms.term", ASCENDING), ("timestamp", DESCENDING)], name="user_terms_timestamp"),
+        IndexModel([("conversation_id", ASCENDING)], name="conversation"),
+    ],
+    "chat_search_terms": [
+        # df theo (user, term) đọc bằng _id; xoá theo user
+        IndexModel([("user_id", ASCENDING)], name="user"),
+    ],
+    "user_daily_stats": [
+        # Thống kê N ngày gần đây của user
+        IndexModel([("user_id", ASCENDING), ("day", ASCENDING)], name="user_day"),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "technical_errors": [
+        IndexModel([("timestamp", DESCENDING), ("_id", DESCENDING)], name="timestamp"),
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING)], name="user_timestamp"),
+    ],
+}
+
+# Các truy vấn chính cần kiểm tra bằng explain(): (tên, collection, lệnh explain)
+QUERY_CHECKS: List[Dict[str, Any]] = [
+    {
+        "name": "history by user",
+        "collection": "chat_history",
+        "command": {"find": "chat_history", "filter": {"user_id": "_"}, "sort": {"timestamp": -1}, "limit": 50},
+    },
+    {
+        "name": "history by conversation",
+        "collection": "chat_history",
+        "command": {"find": "chat_history", "filter": {"conversation_id": "_"}, "sort": {"timestamp": 1}},
+    },
+    {
+        "name": "open bucket of conversation",
+        "collection": "chat_history_buckets",
+        "command": {"find": "chat_history_buckets", "filter": {"conversation_id": "_", "count": {"$lt": 50}}, "limit": 1},
+    },
+    {
+        "name": "search postings of term",
+        "collection": "chat_search_postings",
+        "command": {
+            "find": "chat_search_postings", "filter": {"user_id": "_", "terms.term": "_"}, "sort": {"timestamp": -1},
+        },
+    },
+    {
+        "name": "conversations of user",
+        "collection": "conversations",
+        "command": {"find": "conversations", "filter": {"user_id": "_"}, "sort": {"updated_at": -1, "_id": -1}, "limit": 20},
+    },
+    {
+        "name": "user by username",
+        "collection": "users",
+        "command": {"find": "users", "filter": {"username": "_"}, "limit": 1},
+    },
+    {
+        "name": "technical errors by time",
+        "collection": "technical_errors",
+        "command": {"find": "technical_errors", "filter": {}, "sort": {"timestamp": -1}, "limit": 50},
+    },
+]
+
+
+async def ensure_indexes(database=db) -> List[str]:
+    """
+    Tạo các index trong INDEX_SPECS (bỏ qua index đã có), trả về danh sách lỗi
+    """
+    errors = []
+    for collection_name, models in INDEX_SPECS.items():
+        for model in models:
+            try:
+                await database[collection_name].create_indexes([model])
+            except OperationFailure as e:
+                # VD: trùng tên nhưng khác khoá/option, hoặc dữ liệu trùng với index unique
+                name = model.document.get("name")
+                errors.append(f"{collection_name}.{name}: {e}")
+                logger.error(f"Không tạo được index {collection_name}.{name}: {e}")
+    return errors
+
+
+def _plan_stages(plan: Any) -> Iterable[str]:
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+async def verify_queries(database=db) -> List[Dict[str, Any]]:
+    """
+    Chạy explain() cho các truy vấn chính, đánh dấu truy vấn nào phải quét toàn collection
+    """
+    report = []
+    for check in QUERY_CHECKS:
+        try:
+            explain = await database.command({"explain": check["command"], "verbosity": "queryPlanner"})
+            stages = list(_plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {})))
+            report.append({"name": check["name"], "stages": stages, "collscan": "COLLSCAN" in stages})
+        except Exception as e:
+            report.append({"name": check["name"], "error": str(e)})
+    for item in report:
+        if item.get("collscan"):
+            logger.warning(f"Truy vấn '{item['name']}' đang COLLSCAN: {item['stages']}")
+        elif item.get("error"):
+            logger.warning(f"Không explain được truy vấn '{item['name']}': {item['error']}")
+    return report
+
+
+async def bootstrap_indexes():
+    """
+    Gọi trong lifespan lúc khởi động (bật/tắt qua MONGO_ENSURE_INDEXES, MONGO_VERIFY_INDEXES)
+    """
+    if MONGO_ENSURE_INDEXES:
+        await ensure_indexes()
+    if MONGO_VERIFY_INDEXES:
+        await verify_queries()
+
+
+async def _run_cli(args: List[str]) -> int:
+    errors = [] if "--check" in args else await ensure_indexes()
+    for error in errors:
+        print(f"LỖI  {error}")
+    failed = bool(errors)
+    for item in await verify_queries():
+        if item.get("error"):
+            status = "LỖI "
+        else:
+            status = "SCAN" if item["collscan"] else "OK  "
+        failed = failed or status != "OK  "
+        print(f"{status} {item['name']}: {item.get('stages') or item.get('error')}")
+    return 1 if failed else 0
+
+
+async def _main(args: List[str]) -> int:
+    try:
+        return await _run_cli(args)
+    finally:
+        await close_database()
+
+
+if __name__ == "__main__":
+    # python -m app.data.indexes [--check]
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,77 @@
+import json
+import base64
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Thứ tự trang: mới nhất trước, _id để phân định các bản ghi cùng timestamp
+PAGE_SORT = [("timestamp", -1), ("_id", -1)]
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(doc: Dict[str, Any], field: str = "timestamp") -> str:
+    """
+    Cursor mờ (opaque) cho bản ghi cuối trang: base64 của (thời gian ms, _id)
+    """
+    millis = int((doc[field] - _EPOCH) / timedelta(milliseconds=1))
+    key = [millis, str(doc["_id"])]
+    if not isinstance(doc["_id"], ObjectId):
+        key.append("s")
+    raw = json.dumps(key, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[datetime, Any]:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        key = json.loads(raw)
+        millis, doc_id = key[0], key[1]
+        is_string_id = len(key) > 2 and key[2] == "s"
+        return _EPOCH + timedelta(milliseconds=int(millis)), doc_id if is_string_id else ObjectId(doc_id)
+    except Exception as e:
+        raise InvalidCursor(f"Cursor không hợp lệ: {token}") from e
+
+
+def after_cursor(query: Dict[str, Any], token: Optional[str], field: str = "timestamp") -> Dict[str, Any]:
+    """
+    Thêm điều kiện "đứng sau cursor" theo thứ tự (field giảm dần, _id giảm dần) vào query
+    """
+    if not token:
+        return query
+    value, doc_id = decode_cursor(token)
+    keyset = {"$or": [
+        {field: {"$lt": value}},
+        {field: value, "_id": {"$lt": doc_id}},
+    ]}
+    return {"$and": [query, keyset]} if query else keyset
+
+
+async def fetch_page(
+    collection,
+    query: Dict[str, Any],
+    limit: int,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict[str, Any]] = None,
+    field: str = "timestamp",
+) -> Tuple[List[Dict[str, Any]], Optional[str], bool]:
+    """
+    Lấy một trang theo keyset (cursor) hoặc offset (client cũ), đọc dư 1 bản ghi để biết has_more.
+    Thứ tự mặc định là PAGE_SORT; `field` thay timestamp bằng trường thời gian khác (VD: updated_at).
+    Trả về (docs, next_cursor, has_more).
+    """
+    sort = PAGE_SORT if field == "timestamp" else [(field, -1), ("_id", -1)]
+    find = collection.find(after_cursor(query, cursor, field), projection).sort(sort)
+    if offset and not cursor:
+        find = find.skip(offset)
+    docs = await find.limit(limit + 1).to_list()
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = encode_cursor(docs[-1], field) if has_more and docs else None
+    return docs, next_cursor, has_more
@@ -1,13 +1,35 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.router import chat
+from app.router import chat_ws
 from app.router import user
 from app.router import upload_file
 from app.router import chat_history
 from app.router import technical_error
+from app.services.background_writer import history_writer
+from app.data.database import ping_database, close_database
+from app.data.indexes import bootstrap_indexes
+import logging
 import uvicorn
 
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # MongoDB chưa sẵn sàng vẫn khởi động: chat history nằm trong spool chờ replay
+    if await ping_database():
+        logger.info("Đã kết nối MongoDB")
+        await bootstrap_indexes()
+    history_writer.start()
+    yield
+    # Ghi nốt chat history và conversation state còn đang chờ trước khi tắt worker
+    await history_writer.stop()
+    await chat.conversation_store.close()
+    await close_database()
+
 app = FastAPI(
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -20,6 +42,7 @@ app.add_middleware(
 )
 
 app.include_router(chat.router)
+app.include_router(chat_ws.router)
 app.include_router(user.router)
 app.include_router(upload_file.router)
 app.include_router(chat_history.router)
@@ -1,6 +1,11 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
 from fastapi import APIRouter
+from openai.types.responses import ResponseTextDeltaEvent
+from sse_starlette.sse import EventSourceResponse
 from uuid import uuid4
+import os
+import json
 import time
 import logging
 
@@ -19,9 +24,18 @@ from app.agent.price_agent import company_price_agent
 from app.agent.support_error_agent import company_support_error_agent
 from app.agent.support_technical_agent import company_support_technical_agent
 from app.agent.triage_agent import triage_agent
+from app.agent.guardrail import guardrail_cache_stats, guardrail_verdicts
+from app.agent.pre_router import PRE_ROUTER_ENABLED, pre_router
+from app.agent.multi_intent_agent import split_intents
 from app.entities.models import AgentEvent, ChatRequest,ChatResponse, GuardrailCheck, MessageResponse
-from app.agent.formatter_agent import create_initial_context
+from app.agent.formatter_agent import CompanyAgentContext, create_initial_context
 from app.services.chat_history_service import ChatHistoryService
+from app.services.background_writer import history_writer
+from app.services.conversation_store import create_conversation_store
+from app.services.conversation_locks import StripedLocks, TurnCoalescer, turn_key
+from app.services.history_compaction import build_run_input, compact_history, strip_summary
+from app.services.turn_runner import run_agent_turn, run_input_guardrails, turn_metrics
+from app.services.semantic_cache import SEMANTIC_CACHE_ENABLED, SemanticAnswerCache, agent_cache_version
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -29,23 +43,14 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-class ConversationStore:
-    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
-        pass
+conversation_store = create_conversation_store()
+conversation_locks = StripedLocks()
+turn_coalescer = TurnCoalescer()
+# Cache câu trả lời cho lượt đầu tiên (chưa có lịch sử) của Company Info Agent
+semantic_cache = SemanticAnswerCache()
 
-    def save(self, conversation_id: str, state: Dict[str, Any]):
-        pass
-
-class InMemoryConversationStore(ConversationStore):
-    _conversations: Dict[str, Dict[str, Any]] = {}
-
-    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
-        return self._conversations.get(conversation_id)
-
-    def save(self, conversation_id: str, state: Dict[str, Any]):
-        self._conversations[conversation_id] = state
-
-conversation_store = InMemoryConversationStore()
+# Số lượt hội thoại tối đa được nạp lại từ chat_history khi store không còn giữ conversation
+CONVERSATION_REHYDRATE_TURNS = int(os.getenv("CONVERSATION_REHYDRATE_TURNS", "10"))
 
 # =========================
 # Helpers
@@ -73,6 +78,52 @@ def _get_guardrail_name(g) -> str:
         return fn_name.replace("_", " ").title()
     return str(g)
 
+async def _rehydrate_state(conversation_id: str, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Dựng lại state (input_items, current_agent, context) từ chat_history
+    khi conversation không còn trong store (restart, eviction).
+    """
+    turns = await ChatHistoryService.get_recent_conversation_turns(conversation_id, CONVERSATION_REHYDRATE_TURNS)
+    if not turns:
+        return None
+    if user_id and any(turn.get("user_id") != user_id for turn in turns):
+        logger.warning(f"Conversation {conversation_id} không thuộc user {user_id}, bỏ qua rehydrate")
+        return None
+
+    input_items: List[Dict[str, Any]] = []
+    for turn in turns:
+        input_items.append({"role": "user", "content": turn.get("question", "")})
+        input_items.append({"role": "assistant", "content": turn.get("answer", "")})
+
+    last_turn = turns[-1]
+    try:
+        ctx = CompanyAgentContext(**(last_turn.get("context") or {}))
+    except Exception:
+        ctx = create_initial_context()
+
+    return {
+        "input_items": input_items,
+        "context": ctx,
+        "current_agent": _get_agent_by_name(last_turn.get("agent", "")).name,
+        # Mốc để lượt tiếp theo chỉ lưu context_delta
+        "persisted_context": ctx.model_dump() if last_turn.get("context") else None,
+    }
+
+def _build_guardrail_checks(agent, message: str, failed=None, output_info: Any = None) -> List[GuardrailCheck]:
+    """
+    Dựng danh sách GuardrailCheck cho frontend; guardrail gộp được tách thành từng mục
+    """
+    timestamp = time.time() * 1000
+    checks: List[GuardrailCheck] = []
+    for g in getattr(agent, "input_guardrails", []):
+        is_failed = failed is not None and g == failed
+        for name, passed, reasoning in guardrail_verdicts(_get_guardrail_name(g), output_info if is_failed else None):
+            checks.append(GuardrailCheck(
+                id=uuid4().hex, name=name, input=message, reasoning=reasoning, passed=passed, timestamp=timestamp,
+            ))
+    return checks
+
+@lru_cache(maxsize=1)
 def _build_agents_list() -> List[Dict[str, Any]]:
     def make_agent_dict(agent):
         return {
@@ -80,7 +131,10 @@ def _build_agents_list() -> List[Dict[str, Any]]:
             "description": getattr(agent, "handoff_description", ""),
             "handoffs": [getattr(h, "agent_name", getattr(h, "name", "")) for h in getattr(agent, "handoffs", [])],
             "tools": [getattr(t, "name", getattr(t, "__name__", "")) for t in getattr(agent, "tools", [])],
-            "input_guardrails": [_get_guardrail_name(g) for g in getattr(agent, "input_guardrails", [])],
+            "input_guardrails": [
+                name for g in getattr(agent, "input_guardrails", [])
+                for name, _, _ in guardrail_verdicts(_get_guardrail_name(g))
+            ],
         }
     return [
         make_agent_dict(triage_agent),
@@ -91,120 +145,141 @@ def _build_agents_list() -> List[Dict[str, Any]]:
     ]
 
 
-@router.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(req: ChatRequest):
-    is_new = not req.conversation_id or conversation_store.get(req.conversation_id) is None
-    if is_new:
-        conversation_id = uuid4().hex
-        ctx = create_initial_context()
-        current_agent_name = triage_agent.name
-        state = {
-            "input_items": [],
-            "context": ctx,
-            "current_agent": current_agent_name,
-        }
-        if req.message.strip() == "":
-            conversation_store.save(conversation_id, state)
-            return ChatResponse(
-                conversation_id=conversation_id,
-                current_agent=current_agent_name,
-                messages=[],
-                events=[],
-                context=ctx.model_dump(),
-                agents=_build_agents_list(),
-                guardrails=[],
-                reply="",
-                metadata={}
-            )
-    else:
-        conversation_id = req.conversation_id
-        state = conversation_store.get(conversation_id)
-
-    current_agent = _get_agent_by_name(state["current_agent"])
-    state["input_items"].append({"content": req.message, "role": "user"})
-    old_context = state["context"].model_dump().copy()
-    guardrail_checks: List[GuardrailCheck] = []
+async def _load_or_create_state(req: ChatRequest) -> Tuple[str, Dict[str, Any], bool]:
+    state = await conversation_store.get(req.conversation_id) if req.conversation_id else None
+    if state is None and req.conversation_id:
+        state = await _rehydrate_state(req.conversation_id, req.user_id)
+        if state is not None:
+            logger.info(f"Rehydrate conversation {req.conversation_id} từ chat_history")
+            await conversation_store.save(req.conversation_id, state)
+    if state is not None:
+        return req.conversation_id, state, False
 
-    try:
-        result = await Runner.run(current_agent, state["input_items"], context=state["context"])
-    except InputGuardrailTripwireTriggered as e:
-        failed = e.guardrail_result.guardrail
-        gr_output = e.guardrail_result.output.output_info
-        gr_reasoning = getattr(gr_output, "reasoning", "")
-        gr_input = req.message
-        gr_timestamp = time.time() * 1000
-        for g in current_agent.input_guardrails:
-            guardrail_checks.append(GuardrailCheck(
-                id=uuid4().hex,
-                name=_get_guardrail_name(g),
-                input=gr_input,
-                reasoning=(gr_reasoning if g == failed else ""),
-                passed=(g != failed),
-                timestamp=gr_timestamp,
-            ))
-        refusal = "Xin lỗi, tôi chỉ có thể hỗ trợ các chủ đề liên quan đến công ty và dịch vụ."
-        state["input_items"].append({"role": "assistant", "content": refusal})
-
-        if req.user_id:
-            try:
-                await _maybe_await(ChatHistoryService.save_chat(
-                    conversation_id=conversation_id,
-                    user_id=req.user_id,
-                    question=req.message,
-                    answer=refusal,
-                    agent=current_agent.name,
-                    context=state["context"].model_dump(),
-                    events=[{"type": "guardrail_failed", "guardrail": _get_guardrail_name(failed)}]
-                ))
-            except Exception as e:
-                logger.exception(f"Không thể lưu guardrail reply: {e}")
-
-        return ChatResponse(
-            conversation_id=conversation_id,
-            current_agent=current_agent.name,
-            messages=[MessageResponse(content=refusal, reply=refusal, agent=current_agent.name)],
-            events=[],
-            context=state["context"].model_dump(),
-            agents=_build_agents_list(),
-            guardrails=guardrail_checks,
-            reply=refusal,
-            metadata={}
-        )
+    state = {
+        "input_items": [],
+        "context": create_initial_context(),
+        "current_agent": triage_agent.name,
+    }
+    return uuid4().hex, state, True
 
-    messages: List[MessageResponse] = []
-    events: List[AgentEvent] = []
+def _empty_response(conversation_id: str, state: Dict[str, Any]) -> ChatResponse:
+    return ChatResponse(
+        conversation_id=conversation_id,
+        current_agent=state["current_agent"],
+        messages=[],
+        events=[],
+        context=state["context"].model_dump(),
+        agents=_build_agents_list(),
+        guardrails=[],
+        reply="",
+        metadata={}
+    )
 
-    for item in result.new_items:
-        if isinstance(item, MessageOutputItem):
-            text = ItemHelpers.text_message_output(item)
-            messages.append(MessageResponse(content=text, reply=text, agent=item.agent.name))
-            events.append(AgentEvent(id=uuid4().hex, type="message", agent=item.agent.name, content=text))
-        elif isinstance(item, HandoffOutputItem):
-            events.append(AgentEvent(
+def _item_to_event(item) -> Tuple[Optional[AgentEvent], Optional[MessageResponse], Optional[Any]]:
+    """
+    Chuyển một RunItem thành (event, message, agent đích nếu là handoff)
+    """
+    if isinstance(item, MessageOutputItem):
+        text = ItemHelpers.text_message_output(item)
+        return (
+            AgentEvent(id=uuid4().hex, type="message", agent=item.agent.name, content=text),
+            MessageResponse(content=text, reply=text, agent=item.agent.name),
+            None,
+        )
+    if isinstance(item, HandoffOutputItem):
+        return (
+            AgentEvent(
                 id=uuid4().hex, type="handoff",
                 agent=item.source_agent.name,
                 content=f"{item.source_agent.name} -> {item.target_agent.name}",
                 metadata={"source_agent": item.source_agent.name, "target_agent": item.target_agent.name},
-            ))
-            current_agent = item.target_agent
-        elif isinstance(item, ToolCallItem):
-            tool_name = getattr(item.raw_item, "name", None)
-            raw_args = getattr(item.raw_item, "arguments", None)
-            try:
-                import json
-                tool_args = json.loads(raw_args) if isinstance(raw_args, str) else raw_args
-            except Exception:
-                tool_args = raw_args
-            events.append(AgentEvent(
+            ),
+            None,
+            item.target_agent,
+        )
+    if isinstance(item, ToolCallItem):
+        tool_name = getattr(item.raw_item, "name", None)
+        raw_args = getattr(item.raw_item, "arguments", None)
+        try:
+            tool_args = json.loads(raw_args) if isinstance(raw_args, str) else raw_args
+        except Exception:
+            tool_args = raw_args
+        return (
+            AgentEvent(
                 id=uuid4().hex, type="tool_call", agent=item.agent.name,
                 content=tool_name or "", metadata={"tool_args": tool_args},
-            ))
-        elif isinstance(item, ToolCallOutputItem):
-            events.append(AgentEvent(
+            ),
+            None,
+            None,
+        )
+    if isinstance(item, ToolCallOutputItem):
+        return (
+            AgentEvent(
                 id=uuid4().hex, type="tool_output", agent=item.agent.name,
                 content=str(item.output), metadata={"tool_result": item.output},
-            ))
+            ),
+            None,
+            None,
+        )
+    return None, None, None
+
+async def _handle_guardrail_tripwire(
+    e: InputGuardrailTripwireTriggered,
+    req: ChatRequest,
+    conversation_id: str,
+    state: Dict[str, Any],
+    current_agent,
+) -> ChatResponse:
+    failed = e.guardrail_result.guardrail
+    guardrail_checks = _build_guardrail_checks(
+        current_agent, req.message, failed=failed, output_info=e.guardrail_result.output.output_info
+    )
+    failed_names = [check.name for check in guardrail_checks if not check.passed] or [_get_guardrail_name(failed)]
+    refusal = "Xin lỗi, tôi chỉ có thể hỗ trợ các chủ đề liên quan đến công ty và dịch vụ."
+    state["input_items"].append({"role": "assistant", "content": refusal})
+    # Tính context/delta trước khi lưu state để mốc persisted_context mới được lưu cùng
+    history_fields = ChatHistoryService.context_fields(state, conversation_id) if req.user_id else {}
+    await conversation_store.save(conversation_id, state)
+
+    if req.user_id:
+        try:
+            ChatHistoryService.enqueue_chat(
+                conversation_id=conversation_id,
+                user_id=req.user_id,
+                question=req.message,
+                answer=refusal,
+                agent=current_agent.name,
+                **history_fields,
+                events=[{"type": "guardrail_failed", "guardrail": name} for name in failed_names]
+            )
+        except Exception as e:
+            logger.exception(f"Không thể lưu guardrail reply: {e}")
 
+    return ChatResponse(
+        conversation_id=conversation_id,
+        current_agent=current_agent.name,
+        messages=[MessageResponse(content=refusal, reply=refusal, agent=current_agent.name)],
+        events=[],
+        context=state["context"].model_dump(),
+        agents=_build_agents_list(),
+        guardrails=guardrail_checks,
+        reply=refusal,
+        metadata={}
+    )
+
+async def _finalize_turn(
+    req: ChatRequest,
+    conversation_id: str,
+    state: Dict[str, Any],
+    current_agent,
+    old_context: Dict[str, Any],
+    input_list: List[Any],
+    messages: List[MessageResponse],
+    events: List[AgentEvent],
+) -> ChatResponse:
+    """
+    Cập nhật state, lưu chat history và dựng ChatResponse sau khi agent chạy xong
+    """
     new_context = state["context"].model_dump()  # dùng thống nhất Pydantic v2
     changes = {k: new_context[k] for k in new_context if old_context.get(k) != new_context[k]}
     if changes:
@@ -212,43 +287,40 @@ async def chat_endpoint(req: ChatRequest):
             id=uuid4().hex, type="context_update", agent=current_agent.name, content="", metadata={"changes": changes},
         ))
 
-    state["input_items"] = result.to_input_list()
+    state["input_items"] = strip_summary(input_list)
     state["current_agent"] = current_agent.name
-    conversation_store.save(conversation_id, state)
-
-    final_guardrails: List[GuardrailCheck] = []
-    for g in getattr(current_agent, "input_guardrails", []):
-        name = _get_guardrail_name(g)
-        failed = next((gc for gc in guardrail_checks if gc.name == name), None)
-        if failed:
-            final_guardrails.append(failed)
-        else:
-            final_guardrails.append(GuardrailCheck(
-                id=uuid4().hex, name=name, input=req.message, reasoning="", passed=True, timestamp=time.time() * 1000,
-            ))
+    main_reply = messages[-1].content if messages else ""
+    # Tính context/delta trước khi lưu state để mốc persisted_context mới được lưu cùng
+    history_fields = ChatHistoryService.context_fields(state, conversation_id) if req.user_id and main_reply else {}
+    # False: worker khác đã cập nhật conversation trước (store đã nạp lại state mới nhất)
+    state_saved = await conversation_store.save(conversation_id, state)
+
+    final_guardrails = _build_guardrail_checks(current_agent, req.message)
 
     # Lưu đúng 1 lần với question và câu trả lời cuối cùng
-    main_reply = messages[-1].content if messages else ""
     if req.user_id and main_reply:
         try:
             last_agent = messages[-1].agent if messages else current_agent.name
-            success = await _maybe_await(ChatHistoryService.save_chat(
+            # Ghi nền qua hàng đợi: response không chờ MongoDB
+            queued = ChatHistoryService.enqueue_chat(
                 conversation_id=conversation_id,
                 user_id=req.user_id,
                 question=req.message,
                 answer=main_reply,
                 agent=last_agent,
-                context=state["context"].model_dump(),
+                **history_fields,
                 events=[event.model_dump() for event in events]
-            ))
-            if success is False:
+            )
+            if not queued:
                 logger.error("Lỗi khi lưu chat history")
         except Exception as e:
             logger.exception(f"Không thể lưu chat history: {e}")
     elif not req.user_id:
         logger.warning("Không có user_id, bỏ qua lưu chat history")
 
-    metadata = {}
+    metadata = {"served_from_cache": False}
+    if state_saved is False:
+        metadata["state_conflict"] = True
     if messages and any("support" in msg.content.lower() or "hỗ trợ" in msg.content.lower() for msg in messages):
         metadata["requires_support_form"] = True
 
@@ -264,67 +336,306 @@ async def chat_endpoint(req: ChatRequest):
         metadata=metadata
     )
 
-# Helper: chạy được cho cả sync & async save_chat
-import inspect
-async def _maybe_await(call):
-    if inspect.isawaitable(call):
-        return await call
-    return call
+def _pre_route(current_agent, message: str) -> Tuple[Any, Optional[AgentEvent]]:
+    """
+    Bỏ qua bước LLM của Triage Agent khi pre-router xác định chắc chắn agent chuyên trách
+    """
+    if not PRE_ROUTER_ENABLED or current_agent is not triage_agent:
+        return current_agent, None
+    target = pre_router.route(message)
+    if target is None:
+        return current_agent, None
+    return target, AgentEvent(
+        id=uuid4().hex, type="handoff",
+        agent=current_agent.name,
+        content=f"{current_agent.name} -> {target.name}",
+        metadata={"source_agent": current_agent.name, "target_agent": target.name, "pre_router": True},
+    )
 
-@router.get("/history/conversation/{conversation_id}")
-async def get_conversation_history(conversation_id: str):
+async def _multi_intent_turn(
+    state: Dict[str, Any], message: str
+) -> Tuple[List[MessageResponse], List[AgentEvent], List[Any]]:
     """
-    Lấy lịch sử chat theo conversation_id
+    Câu hỏi nhiều ý ở Triage Agent: chạy guardrail một lần rồi gọi song song các agent chuyên trách
     """
+    run_input = build_run_input(state)
+    await run_input_guardrails(triage_agent, run_input, state["context"])
+    reply = await triage_agent.run_multi_intent(message, state["context"])
+    intents = [intent for intent, _ in split_intents(message)]
+    messages = [MessageResponse(content=reply, reply=reply, agent=triage_agent.name)]
+    events = [AgentEvent(
+        id=uuid4().hex, type="message", agent=triage_agent.name, content=reply, metadata={"multi_intent": intents},
+    )]
+    return messages, events, run_input + [{"role": "assistant", "content": reply}]
+
+def _semantic_cache_lookup(req: ChatRequest, first_turn: bool):
+    # Chỉ lượt hỏi đầu tiên (chưa có lượt nào trong state) mới độc lập với ngữ cảnh hội thoại;
+    # không dựa vào is_new vì client thường tạo conversation bằng một request rỗng trước
+    if not SEMANTIC_CACHE_ENABLED or not first_turn or not req.message.strip():
+        return None
+    semantic_cache.set_version(agent_cache_version(company_info_agent))
+    return semantic_cache.lookup(req.message)
+
+def _semantic_cache_store(req: ChatRequest, response: ChatResponse):
+    if not SEMANTIC_CACHE_ENABLED or not response.reply:
+        return
+    # Chỉ cache câu trả lời của Company Info Agent khi lượt chạy đã qua guardrail
+    if response.current_agent == company_info_agent.name and all(g.passed for g in response.guardrails):
+        semantic_cache.store(req.message, response.reply, response.current_agent)
+
+async def _serve_cached_answer(
+    req: ChatRequest, conversation_id: str, state: Dict[str, Any], cached: Tuple[Any, float]
+) -> ChatResponse:
+    entry, similarity = cached
+    agent = _get_agent_by_name(entry.agent)
+    messages = [MessageResponse(content=entry.answer, reply=entry.answer, agent=agent.name)]
+    events = [AgentEvent(
+        id=uuid4().hex, type="message", agent=agent.name, content=entry.answer,
+        metadata={"served_from_cache": True, "similarity": similarity},
+    )]
+    input_list = state["input_items"] + [
+        {"role": "user", "content": req.message},
+        {"role": "assistant", "content": entry.answer},
+    ]
+    response = await _finalize_turn(
+        req, conversation_id, state, agent, state["context"].model_dump(), input_list, messages, events
+    )
+    response.metadata["served_from_cache"] = True
+    response.metadata["cache_similarity"] = round(similarity, 4)
+    return response
+
+
+@router.post("/chat", response_model=ChatResponse)
+async def chat_endpoint(req: ChatRequest):
+    if not req.conversation_id:
+        return await _chat_turn(req)
+
+    # Mỗi conversation chỉ chạy một lượt tại một thời điểm; request trùng tin nhắn
+    # trong lúc lượt trước đang chạy sẽ dùng chung kết quả
+    async def locked_turn():
+        async with conversation_locks.get(req.conversation_id):
+            return await _chat_turn(req)
+
+    return await turn_coalescer.run(turn_key(req.conversation_id, req.message, req.user_id), locked_turn)
+
+async def _chat_turn(req: ChatRequest) -> ChatResponse:
+    conversation_id, state, is_new = await _load_or_create_state(req)
+    if is_new and req.message.strip() == "":
+        await conversation_store.save(conversation_id, state)
+        return _empty_response(conversation_id, state)
+
+    first_turn = not state["input_items"]
+    cached = _semantic_cache_lookup(req, first_turn)
+    if cached is not None:
+        return await _serve_cached_answer(req, conversation_id, state, cached)
+
+    current_agent, route_event = _pre_route(_get_agent_by_name(state["current_agent"]), req.message)
+    state["input_items"].append({"content": req.message, "role": "user"})
+    old_context = state["context"].model_dump().copy()
+
+    turn_metadata: Dict[str, Any] = {}
+    messages: List[MessageResponse] = []
+    events: List[AgentEvent] = [route_event] if route_event else []
     try:
-        if not conversation_id or conversation_id.strip() == "":
-            return {"error": "Conversation ID không hợp lệ", "history": []}
-        
-        db_chats = ChatHistoryService.get_conversation_history(conversation_id)
-        
-        if not db_chats:
-            return {"history": [], "conversation_id": conversation_id}
-        
-        # Chuyển đổi format
-        history = []
-        for chat in db_chats:
-            history.append({
-                "role": "user",
-                "content": chat.get("question", ""),
-                "timestamp": chat.get("timestamp", None),
-                "agent": chat.get("agent", "")
-            })
-            history.append({
-                "role": "assistant",
-                "content": chat.get("answer", ""),
-                "timestamp": chat.get("timestamp", None),
-                "agent": chat.get("agent", "")
-            })
-        
-        # Tạo reply chính từ tin nhắn cuối cùng của assistant
-        main_reply = ""
-        if history:
-            for msg in reversed(history):
-                if msg["role"] == "assistant":
-                    main_reply = msg["content"]
-                    break
-        
-        # Tạo metadata để hỗ trợ requires_support_form
-        metadata = {}
-        if main_reply and ("support" in main_reply.lower() or "hỗ trợ" in main_reply.lower()):
-            metadata["requires_support_form"] = True
-        
-        return {
-            "history": history,
-            "conversation_id": conversation_id,
-            "total_messages": len(history),
-            "reply": main_reply,
-            "metadata": metadata
-        }
-        
-    except Exception as e:
-        logging.exception(f"Lỗi khi lấy lịch sử conversation {conversation_id}")
-        return {"error": "Đã xảy ra lỗi khi lấy lịch sử conversation", "history": []}
+        await compact_history(state, current_agent.name)
+        if current_agent is triage_agent and triage_agent.wants_multi_intent(req.message):
+            multi_messages, multi_events, input_list = await _multi_intent_turn(state, req.message)
+            messages.extend(multi_messages)
+            events.extend(multi_events)
+        else:
+            result = await run_agent_turn(current_agent, build_run_input(state), state["context"], turn_metadata)
+            input_list = result.to_input_list()
+            for item in result.new_items:
+                event, message, target_agent = _item_to_event(item)
+                if event:
+                    events.append(event)
+                if message:
+                    messages.append(message)
+                if target_agent:
+                    current_agent = target_agent
+    except InputGuardrailTripwireTriggered as e:
+        return await _handle_guardrail_tripwire(e, req, conversation_id, state, current_agent)
+
+    response = await _finalize_turn(
+        req, conversation_id, state, current_agent, old_context, input_list, messages, events
+    )
+    response.metadata.update(turn_metadata)
+    if first_turn:
+        _semantic_cache_store(req, response)
+    return response
+
+
+def _sse(event: str, data: Any) -> Dict[str, str]:
+    if hasattr(data, "model_dump"):
+        data = data.model_dump()
+    return {"event": event, "data": json.dumps(data, ensure_ascii=False, default=str)}
+
+@router.post("/chat/stream")
+async def chat_stream_endpoint(req: ChatRequest):
+    """
+    Chat dạng Server-Sent Events: gửi token delta, handoff, tool_call, guardrail ngay khi có,
+    event cuối "done" chứa ChatResponse đầy đủ (giống POST /chat)
+    """
+    async def event_generator():
+        lock = conversation_locks.get(req.conversation_id) if req.conversation_id else None
+        if lock is not None:
+            await lock.acquire()
+        try:
+            async for event_name, payload in _stream_turn(req):
+                yield _sse(event_name, payload)
+        finally:
+            if lock is not None:
+                lock.release()
+
+    return EventSourceResponse(event_generator())
+
+async def _stream_turn(req: ChatRequest, session: Optional[Tuple[str, Dict[str, Any]]] = None):
+    """
+    Chạy một lượt chat dạng stream, yield (tên event, payload).
+    session=(conversation_id, state) cho phép dùng state đang giữ sẵn (VD: kết nối WebSocket).
+    """
+    if session is not None:
+        conversation_id, state = session
+        is_new = False
+    else:
+        conversation_id, state, is_new = await _load_or_create_state(req)
+    if is_new and req.message.strip() == "":
+        await conversation_store.save(conversation_id, state)
+        yield "done", _empty_response(conversation_id, state)
+        return
+
+    first_turn = not state["input_items"]
+    cached = _semantic_cache_lookup(req, first_turn)
+    if cached is not None:
+        response = await _serve_cached_answer(req, conversation_id, state, cached)
+        for event in response.events:
+            yield event.type, event
+        yield "done", response
+        return
+
+    current_agent, route_event = _pre_route(_get_agent_by_name(state["current_agent"]), req.message)
+    yield "start", {"conversation_id": conversation_id, "current_agent": current_agent.name}
+
+    state["input_items"].append({"content": req.message, "role": "user"})
+    old_context = state["context"].model_dump().copy()
+    messages: List[MessageResponse] = []
+    events: List[AgentEvent] = []
+    if route_event:
+        events.append(route_event)
+        yield route_event.type, route_event
+
+    try:
+        await compact_history(state, current_agent.name)
+        if current_agent is triage_agent and triage_agent.wants_multi_intent(req.message):
+            multi_messages, multi_events, input_list = await _multi_intent_turn(state, req.message)
+            messages.extend(multi_messages)
+            for event in multi_events:
+                events.append(event)
+                yield event.type, event
+            result = None
+        else:
+            run_input = build_run_input(state)
+            # Runner chạy guardrail song song với lượt model đầu tiên, nên delta có thể tới client
+            # trước khi guardrail chặn: chạy guardrail xong mới stream (agent clone bỏ guardrail để không chạy lại)
+            await run_input_guardrails(current_agent, run_input, state["context"])
+            guarded_agent = current_agent
+            streaming_agent = guarded_agent.clone(input_guardrails=[])
+            result = Runner.run_streamed(streaming_agent, run_input, context=state["context"])
+            async for stream_event in result.stream_events():
+                if stream_event.type == "raw_response_event":
+                    if isinstance(stream_event.data, ResponseTextDeltaEvent) and stream_event.data.delta:
+                        yield "delta", {"delta": stream_event.data.delta, "agent": current_agent.name}
+                elif stream_event.type == "agent_updated_stream_event":
+                    new_agent = stream_event.new_agent
+                    current_agent = guarded_agent if new_agent is streaming_agent else new_agent
+                elif stream_event.type == "run_item_stream_event":
+                    event, message, target_agent = _item_to_event(stream_event.item)
+                    if message:
+                        messages.append(message)
+                    if target_agent:
+                        current_agent = target_agent
+                    if event:
+                        events.append(event)
+                        yield event.type, event
+    except InputGuardrailTripwireTriggered as e:
+        response = await _handle_guardrail_tripwire(e, req, conversation_id, state, current_agent)
+        for check in response.guardrails:
+            yield "guardrail", check
+        yield "done", response
+        return
+    except BaseException:
+        # Lượt bị lỗi/huỷ giữa chừng (kể cả client ngắt kết nối): bỏ tin nhắn user vừa thêm để state không bị lệch
+        if state["input_items"] and state["input_items"][-1].get("role") == "user":
+            state["input_items"].pop()
+        raise
+
+    if result is not None:
+        input_list = result.to_input_list()
+    response = await _finalize_turn(
+        req, conversation_id, state, current_agent, old_context, input_list, messages, events
+    )
+    if first_turn:
+        _semantic_cache_store(req, response)
+    for check in response.guardrails:
+        yield "guardrail", check
+    yield "done", response
+
+@router.get("/debug/conversation-store/stats")
+async def debug_conversation_store_stats():
+    """
+    Thống kê hit/miss/eviction của conversation store để tính toán kích thước
+    """
+    return conversation_store.stats()
+
+@router.get("/debug/chat-concurrency/stats")
+async def debug_chat_concurrency_stats():
+    """
+    Thống kê số lượt đang chạy và số request trùng đã được gộp
+    """
+    return {**turn_coalescer.stats(), "locked_stripes": conversation_locks.locked_count()}
+
+@router.get("/debug/guardrail-cache/stats")
+async def debug_guardrail_cache_stats():
+    """
+    Thống kê hit/miss của cache verdict guardrail
+    """
+    return guardrail_cache_stats()
+
+@router.get("/debug/semantic-cache/stats")
+async def debug_semantic_cache_stats():
+    """
+    Thống kê semantic cache của câu hỏi lượt đầu
+    """
+    return semantic_cache.stats()
+
+@router.delete("/debug/semantic-cache")
+async def invalidate_semantic_cache():
+    """
+    Xoá semantic cache (VD: sau khi cập nhật tài liệu trong vector store)
+    """
+    semantic_cache.invalidate()
+    return semantic_cache.stats()
+
+@router.get("/debug/chat-metrics/latency")
+async def debug_chat_latency():
+    """
+    Độ trễ p50/p95 mỗi lượt chat theo chế độ chạy (standard / speculative) và token lãng phí
+    """
+    return turn_metrics.stats()
+
+@router.get("/debug/pre-router/stats")
+async def debug_pre_router_stats():
+    """
+    Tỉ lệ tin nhắn được pre-router định tuyến trực tiếp theo từng route
+    """
+    return pre_router.stats()
+
+@router.get("/debug/history-writer/stats")
+async def debug_history_writer_stats():
+    """
+    Độ sâu hàng đợi ghi chat history, số document đã ghi/bị bỏ (backpressure)
+    """
+    return history_writer.stats()
 
 @router.get("/debug/chat-history/{user_id}")
 async def debug_chat_history(user_id: str):
@@ -336,7 +647,7 @@ async def debug_chat_history(user_id: str):
         
         # Lấy tất cả chat history của user
         cursor = chat_history_collection.find({"user_id": user_id}).sort("timestamp", -1)
-        chats = list(cursor)
+        chats = await cursor.to_list()
         
         # Chuyển đổi ObjectId thành string
         for chat in chats:
@@ -1,21 +1,33 @@
 from fastapi import APIRouter, Query, HTTPException
 from typing import Optional
 from datetime import datetime
-from app.services.chat_history_service import ChatHistoryService
+from app.services.chat_history_service import ChatHistoryService, parse_include
+from app.data.pagination import InvalidCursor
 import logging
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/history", tags=["Chat History"])
 
+INCLUDE_DESCRIPTION = "Extra fields to return, comma-separated: events,context"
+
+def _parse_include(include: Optional[str]):
+    try:
+        return parse_include(include)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/{user_id}")
 async def get_user_chat_history(
     user_id: str,
     limit: int = Query(50, ge=1, le=100),
     offset: int = Query(0, ge=0),
     start_date: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
-    end_date: Optional[str] = Query(None, description="End date (YYYY-MM-DD)")
+    end_date: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    include: Optional[str] = Query(None, description=INCLUDE_DESCRIPTION)
 ):
+    fields = _parse_include(include)
     try:
         # Parse dates if provided
         start_dt = None
@@ -35,12 +47,14 @@ async def get_user_chat_history(
             except ValueError:
                 raise HTTPException(status_code=400, detail="Invalid end_date format. Use YYYY-MM-DD")
         
-        db_chats = ChatHistoryService.get_user_history(
+        db_chats, next_cursor, has_more = await ChatHistoryService.get_user_history_page(
             user_id=user_id,
             limit=limit,
             offset=offset,
             start_date=start_dt,
-            end_date=end_dt
+            end_date=end_dt,
+            cursor=cursor,
+            include=fields
         )
         
         if not db_chats:
@@ -48,6 +62,7 @@ async def get_user_chat_history(
                 "history": [],
                 "total": 0,
                 "has_more": False,
+                "next_cursor": None,
                 "user_id": user_id
             }
         
@@ -66,7 +81,8 @@ async def get_user_chat_history(
                 "content": chat.get("answer", ""),
                 "timestamp": chat.get("timestamp", None),
                 "conversation_id": chat.get("conversation_id", ""),
-                "agent": chat.get("agent", "")
+                "agent": chat.get("agent", ""),
+                **{field: chat.get(field) for field in fields}
             })
         
         # Reverse to show oldest first
@@ -88,7 +104,8 @@ async def get_user_chat_history(
         return {
             "history": history,
             "total": len(history),
-            "has_more": len(db_chats) == limit,
+            "has_more": has_more,
+            "next_cursor": next_cursor,
             "user_id": user_id,
             "limit": limit,
             "offset": offset,
@@ -96,14 +113,20 @@ async def get_user_chat_history(
             "metadata": metadata
         }
         
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.exception(f"Error getting chat history for user {user_id}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/conversation/{conversation_id}")
-async def get_conversation_history(conversation_id: str):
+async def get_conversation_history(
+    conversation_id: str,
+    include: Optional[str] = Query(None, description=INCLUDE_DESCRIPTION)
+):
+    fields = _parse_include(include)
     try:
-        db_chats = ChatHistoryService.get_conversation_history(conversation_id)
+        db_chats = await ChatHistoryService.get_conversation_history(conversation_id, include=fields)
         
         if not db_chats:
             return {
@@ -125,7 +148,8 @@ async def get_conversation_history(conversation_id: str):
                 "role": "assistant",
                 "content": chat.get("answer", ""),
                 "timestamp": chat.get("timestamp", None),
-                "agent": chat.get("agent", "")
+                "agent": chat.get("agent", ""),
+                **{field: chat.get(field) for field in fields}
             })
         
         # Tạo reply chính từ tin nhắn cuối cùng của assistant
@@ -159,7 +183,7 @@ async def get_user_statistics(
     days: int = Query(30, ge=1, le=365, description="Number of days to analyze")
 ):
     try:
-        stats = ChatHistoryService.get_user_statistics(user_id, days)
+        stats = await ChatHistoryService.get_user_statistics(user_id, days)
         
         if not stats:
             return {
@@ -180,28 +204,80 @@ async def get_user_statistics(
         logger.exception(f"Error getting statistics for user {user_id}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@router.get("/user/{user_id}/conversations")
+async def get_user_conversations(
+    user_id: str,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page")
+):
+    try:
+        db_conversations, next_cursor, has_more = await ChatHistoryService.get_user_conversations_page(
+            user_id=user_id,
+            limit=limit,
+            offset=offset,
+            cursor=cursor
+        )
+        
+        conversations = []
+        for conversation in db_conversations:
+            conversations.append({
+                "conversation_id": conversation["_id"],
+                "title": conversation.get("title", ""),
+                "first_message": conversation.get("first_message", ""),
+                "last_message": conversation.get("last_message", ""),
+                "turn_count": conversation.get("turn_count", 0),
+                "last_agent": conversation.get("last_agent", ""),
+                "created_at": conversation.get("created_at", None),
+                "updated_at": conversation.get("updated_at", None)
+            })
+        
+        return {
+            "conversations": conversations,
+            "total": len(conversations),
+            "has_more": has_more,
+            "next_cursor": next_cursor,
+            "user_id": user_id,
+            "limit": limit,
+            "offset": offset
+        }
+        
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception(f"Error getting conversations for user {user_id}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @router.get("/user/{user_id}/search")
 async def search_chat_history(
     user_id: str,
     q: str = Query(..., description="Search term"),
     limit: int = Query(50, ge=1, le=100),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    include: Optional[str] = Query(None, description=INCLUDE_DESCRIPTION)
 ):
+    fields = _parse_include(include)
     try:
         if not q.strip():
             raise HTTPException(status_code=400, detail="Search term cannot be empty")
         
-        db_chats = ChatHistoryService.search_chat_history(
+        db_chats, next_cursor, has_more, truncated = await ChatHistoryService.search_chat_history_page(
             user_id=user_id,
             search_term=q,
             limit=limit,
-            offset=offset
+            offset=offset,
+            cursor=cursor,
+            include=fields
         )
         
         if not db_chats:
             return {
                 "results": [],
                 "total": 0,
+                "has_more": False,
+                "next_cursor": None,
+                "truncated": truncated,
                 "search_term": q,
                 "user_id": user_id
             }
@@ -209,19 +285,25 @@ async def search_chat_history(
         # Convert to display format
         results = []
         for chat in db_chats:
+            highlights = chat.get("highlights") or {}
             results.append({
                 "role": "user",
                 "content": chat.get("question", ""),
                 "timestamp": chat.get("timestamp", None),
                 "conversation_id": chat.get("conversation_id", ""),
-                "agent": chat.get("agent", "")
+                "agent": chat.get("agent", ""),
+                "score": chat.get("score"),
+                "highlight": highlights.get("question")
             })
             results.append({
                 "role": "assistant",
                 "content": chat.get("answer", ""),
                 "timestamp": chat.get("timestamp", None),
                 "conversation_id": chat.get("conversation_id", ""),
-                "agent": chat.get("agent", "")
+                "agent": chat.get("agent", ""),
+                "score": chat.get("score"),
+                "highlight": highlights.get("answer"),
+                **{field: chat.get(field) for field in fields}
             })
         
         # Tạo reply chính từ tin nhắn cuối cùng của assistant
@@ -240,6 +322,9 @@ async def search_chat_history(
         return {
             "results": results,
             "total": len(results),
+            "has_more": has_more,
+            "next_cursor": next_cursor,
+            "truncated": truncated,
             "search_term": q,
             "user_id": user_id,
             "limit": limit,
@@ -248,6 +333,8 @@ async def search_chat_history(
             "metadata": metadata
         }
         
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.exception(f"Error searching chat history for user {user_id}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -255,7 +342,7 @@ async def search_chat_history(
 @router.delete("/{user_id}")
 async def delete_user_history(user_id: str):
     try:
-        success = ChatHistoryService.delete_user_history(user_id)
+        success = await ChatHistoryService.delete_user_history(user_id)
         
         if success:
             return {
@@ -272,7 +359,7 @@ async def delete_user_history(user_id: str):
 @router.delete("/conversation/{conversation_id}")
 async def delete_conversation_history(conversation_id: str):
     try:
-        success = ChatHistoryService.delete_conversation_history(conversation_id)
+        success = await ChatHistoryService.delete_conversation_history(conversation_id)
         
         if success:
             return {
@@ -0,0 +1,107 @@
+import json
+from typing import Any, Dict, Set
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+import logging
+
+from app.entities.models import ChatRequest
+from app.router.chat import (
+    _build_agents_list,
+    _load_or_create_state,
+    _stream_turn,
+    conversation_locks,
+    conversation_store,
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# conversation_id -> các kết nối WebSocket đang mở, dùng để server chủ động đẩy event
+ws_sessions: Dict[str, Set[WebSocket]] = {}
+
+
+def _payload(data: Any) -> Any:
+    return data.model_dump(mode="json") if hasattr(data, "model_dump") else data
+
+
+async def push_event(conversation_id: str, event_type: str, data: Any = None) -> int:
+    """
+    Đẩy một event tới mọi kết nối WebSocket của conversation, trả về số kết nối đã nhận
+    """
+    delivered = 0
+    for ws in list(ws_sessions.get(conversation_id, ())):
+        try:
+            await ws.send_json({"type": event_type, "data": _payload(data)})
+            delivered += 1
+        except Exception as e:
+            logger.warning(f"Không gửi được event {event_type} tới conversation {conversation_id}: {e}")
+    return delivered
+
+
+@router.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Một kết nối gắn với một conversation; state được giữ sẵn trong suốt kết nối.
+    Client gửi {"message": "..."} (hoặc {"type": "ping"}), server stream các event
+    {"type": ..., "data": ...} giống /chat/stream, kết thúc mỗi lượt bằng "done".
+    """
+    await websocket.accept()
+    user_id = websocket.query_params.get("user_id")
+    conversation_id, state, is_new = await _load_or_create_state(ChatRequest(
+        conversation_id=websocket.query_params.get("conversation_id"),
+        message="",
+        user_id=user_id,
+    ))
+    if is_new:
+        await conversation_store.save(conversation_id, state)
+
+    ws_sessions.setdefault(conversation_id, set()).add(websocket)
+    await websocket.send_json({
+        "type": "session",
+        "data": {
+            "conversation_id": conversation_id,
+            "current_agent": state["current_agent"],
+            "agents": _build_agents_list(),
+            "is_new": is_new,
+        },
+    })
+
+    try:
+        while True:
+            try:
+                incoming = json.loads(await websocket.receive_text())
+            except json.JSONDecodeError:
+                incoming = None
+            if not isinstance(incoming, dict):
+                # Frame không phải JSON object: báo lỗi cho client, giữ kết nối
+                await websocket.send_json({"type": "error", "data": {"detail": "Frame phải là JSON object"}})
+                continue
+            if incoming.get("type") == "ping":
+                await websocket.send_json({"type": "pong"})
+                continue
+
+            message = str(incoming.get("message", ""))
+            if not message.strip():
+                await websocket.send_json({"type": "error", "data": {"detail": "Tin nhắn không được để trống"}})
+                continue
+
+            req = ChatRequest(conversation_id=conversation_id, message=message, user_id=user_id)
+            async with conversation_locks.get(conversation_id):
+                async for event_name, payload in _stream_turn(req, session=(conversation_id, state)):
+                    await websocket.send_json({"type": event_name, "data": _payload(payload)})
+                    if event_name == "done" and (payload.metadata or {}).get("requires_support_form"):
+                        await push_event(conversation_id, "requires_support_form", {"conversation_id": conversation_id})
+    except WebSocketDisconnect:
+        logger.info(f"WebSocket của conversation {conversation_id} đã đóng")
+    except Exception as e:
+        logger.exception(f"Lỗi WebSocket chat cho conversation {conversation_id}: {e}")
+        try:
+            await websocket.close(code=1011)
+        except Exception:
+            pass
+    finally:
+        sessions = ws_sessions.get(conversation_id)
+        if sessions is not None:
+            sessions.discard(websocket)
+            if not sessions:
+                ws_sessions.pop(conversation_id, None)
@@ -1,15 +1,18 @@
 from fastapi import APIRouter, HTTPException, status, Request
-from typing import List
+from typing import List, Optional
 import logging
 from datetime import datetime
 import json
 
 from app.entities.models import TechnicalErrorReportCreate, TechnicalErrorReport
 from app.data.database import (
-    save_technical_error_report,
-    get_technical_error_reports,
+    build_technical_error_report,
+    save_technical_error_reports,
+    get_technical_error_reports_page,
     get_technical_error_report_by_id
 )
+from app.data.pagination import InvalidCursor
+from app.services.background_writer import history_writer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -17,6 +20,8 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+history_writer.register("technical_errors", save_technical_error_reports)
+
 @router.post("/technical-error-report/debug")
 async def debug_technical_error_report(request: Request):
     """
@@ -77,16 +82,16 @@ async def create_technical_error_report(report: TechnicalErrorReportCreate):
                 detail="Nội dung lỗi không được để trống"
             )
         
-        # Lưu vào database
+        # Ghi vào spool + hàng đợi ghi nền, không chờ MongoDB
         logger.info(f"Saving report to database...")
-        success = save_technical_error_report(
+        success = history_writer.submit("technical_errors", build_technical_error_report(
             name=report.name.strip(),
             organization=report.organization.strip(),
             error_content=report.error_content.strip(),
             phone=report.phone.strip() if report.phone else None,
             email=report.email.strip() if report.email else None,
             image_url=report.image_url.strip() if report.image_url else None
-        )
+        ))
         
         if success:
             logger.info(f"Report saved successfully")
@@ -111,7 +116,7 @@ async def create_technical_error_report(report: TechnicalErrorReportCreate):
         )
 
 @router.get("/technical-error-reports", response_model=dict)
-async def get_all_technical_error_reports(limit: int = 50, offset: int = 0):
+async def get_all_technical_error_reports(limit: int = 50, offset: int = 0, cursor: Optional[str] = None):
     """
     Lấy danh sách tất cả báo cáo lỗi kỹ thuật
     """
@@ -122,7 +127,7 @@ async def get_all_technical_error_reports(limit: int = 50, offset: int = 0):
         if offset < 0:
             offset = 0
         
-        reports = get_technical_error_reports(limit, offset)
+        reports, next_cursor, has_more = await get_technical_error_reports_page(limit, offset, cursor)
         
         # Chuyển đổi ObjectId thành string để có thể serialize
         for report in reports:
@@ -134,9 +139,13 @@ async def get_all_technical_error_reports(limit: int = 50, offset: int = 0):
             "reports": reports,
             "total": len(reports),
             "limit": limit,
-            "offset": offset
+            "offset": offset,
+            "has_more": has_more,
+            "next_cursor": next_cursor
         }
         
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.exception(f"Lỗi khi lấy danh sách báo cáo lỗi kỹ thuật: {e}")
         raise HTTPException(
@@ -150,7 +159,7 @@ async def get_technical_error_report(report_id: str):
     Lấy báo cáo lỗi kỹ thuật theo ID
     """
     try:
-        report = get_technical_error_report_by_id(report_id)
+        report = await get_technical_error_report_by_id(report_id)
         
         if not report:
             raise HTTPException(
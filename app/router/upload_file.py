@@ -1,3 +1,4 @@
+import asyncio
 from fastapi import APIRouter, File, Form, UploadFile
 from app.services.uploadfile import upload_image_to_s3
 
@@ -8,7 +9,8 @@ async def upload_image(
     user_id: str = Form(None)
 ):
     try:
-        image_url = upload_image_to_s3(image)
+        # boto3 là thư viện đồng bộ, chạy ngoài event loop
+        image_url = await asyncio.to_thread(upload_image_to_s3, image)
         print("image_url", image_url)
         return {
             "success": True,
@@ -5,11 +5,11 @@ from app.config.auth import register_user, login_user
 router = APIRouter()
 
 @router.post("/register")
-def register(user: User):
-    uid = register_user(user.username, user.password)
+async def register(user: User):
+    uid = await register_user(user.username, user.password)
     return {"user_id": uid} if uid else {"error": "Username đã tồn tại"}
 
 @router.post("/login")
-def login(user: User):
-    uid = login_user(user.username, user.password)
+async def login(user: User):
+    uid = await login_user(user.username, user.password)
     return {"user_id": uid} if uid else {"error": "Sai tài khoản hoặc mật khẩu"}
@@ -0,0 +1,256 @@
+import os
+import time
+import asyncio
+import inspect
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from app.services.history_spool import (
+    HISTORY_SPOOL_FSYNC_INTERVAL,
+    HistorySpool,
+    create_history_spool,
+)
+
+logger = logging.getLogger(__name__)
+
+HISTORY_WRITER_MAX_QUEUE = int(os.getenv("HISTORY_WRITER_MAX_QUEUE", "10000"))
+HISTORY_WRITER_BATCH_SIZE = int(os.getenv("HISTORY_WRITER_BATCH_SIZE", "200"))
+HISTORY_WRITER_FLUSH_INTERVAL = float(os.getenv("HISTORY_WRITER_FLUSH_INTERVAL", "0.5"))
+HISTORY_WRITER_MAX_RETRIES = int(os.getenv("HISTORY_WRITER_MAX_RETRIES", "3"))
+HISTORY_SPOOL_REPLAY_INTERVAL = float(os.getenv("HISTORY_SPOOL_REPLAY_INTERVAL", "10"))
+
+
+class BackgroundWriter:
+    """
+    Hàng đợi ghi có giới hạn trong tiến trình: request chỉ đẩy document vào hàng đợi,
+    task nền gom lô theo collection và gọi handler đã đăng ký (VD: insert_many).
+    Khi có spool, document được ghi vào spool trước khi vào hàng đợi; lô ghi thành công
+    được đánh dấu commit, phần còn lại được replayer ghi lại khi MongoDB hoạt động trở lại.
+    Handler phải idempotent theo _id (bỏ qua lỗi trùng khoá).
+    """
+
+    def __init__(
+        self,
+        max_queue: int = HISTORY_WRITER_MAX_QUEUE,
+        batch_size: int = HISTORY_WRITER_BATCH_SIZE,
+        flush_interval: float = HISTORY_WRITER_FLUSH_INTERVAL,
+        max_retries: int = HISTORY_WRITER_MAX_RETRIES,
+        spool: Optional[HistorySpool] = None,
+        replay_interval: float = HISTORY_SPOOL_REPLAY_INTERVAL,
+    ):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spool = spool
+        self.replay_interval = replay_interval
+        self._handlers: Dict[str, Callable[[List[Dict[str, Any]]], Any]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._spool_tasks: List[asyncio.Task] = []
+        self._stopping = False
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.deferred = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.high_water_mark = 0
+        self.last_batch_ms = 0.0
+
+    def register(self, collection_name: str, handler: Callable[[List[Dict[str, Any]]], Any]):
+        """
+        handler(docs) ghi một lô document (sync hoặc async)
+        """
+        self._handlers[collection_name] = handler
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._queue = self._queue or asyncio.Queue(maxsize=self.max_queue)
+        self._stopping = False
+        loop = asyncio.get_running_loop()
+        self._task = loop.create_task(self._run())
+        if self.spool is not None:
+            # Replay ngay khi khởi động: các segment còn lại từ lần chạy trước (kể cả crash)
+            self._spool_tasks = [loop.create_task(self._fsync_loop()), loop.create_task(self._replay_loop())]
+
+    def submit(self, collection_name: str, doc: Dict[str, Any]) -> bool:
+        """
+        Đẩy document vào hàng đợi, không chờ database. Trả về False nếu document bị bỏ
+        (hàng đợi đầy và không có spool).
+        """
+        if collection_name not in self._handlers:
+            raise ValueError(f"Chưa đăng ký handler cho collection {collection_name}")
+        self.start()
+        record_id = None
+        if self.spool is not None:
+            # _id gán trước để ghi lại từ spool không tạo bản trùng
+            doc.setdefault("_id", ObjectId())
+            try:
+                self.spool.append(str(doc["_id"]), collection_name, doc)
+                record_id = str(doc["_id"])
+            except Exception as e:
+                logger.error(f"Không ghi được spool {collection_name}: {e}")
+        try:
+            self._queue.put_nowait((collection_name, doc, record_id))
+        except asyncio.QueueFull:
+            if record_id is not None:
+                # Đã nằm trong spool, replayer sẽ ghi sau
+                self.deferred += 1
+                return True
+            self.dropped += 1
+            logger.error(f"Hàng đợi ghi {collection_name} đầy ({self.max_queue}), bỏ document")
+            return False
+        self.enqueued += 1
+        self.high_water_mark = max(self.high_water_mark, self._queue.qsize())
+        return True
+
+    async def _next_batch(self) -> List[Tuple[str, Dict[str, Any], Optional[str]]]:
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self._queue.get(), timeout=self.flush_interval))
+        except asyncio.TimeoutError:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _call_handler(self, collection_name: str, docs: List[Dict[str, Any]]):
+        handler = self._handlers[collection_name]
+        if inspect.iscoroutinefunction(handler):
+            await handler(docs)
+        else:
+            await asyncio.to_thread(handler, docs)
+
+    async def _write(self, collection_name: str, docs: List[Dict[str, Any]]) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._call_handler(collection_name, docs)
+                self.written += len(docs)
+                return True
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    self.failed_batches += 1
+                    logger.error(f"Không ghi được {len(docs)} document vào {collection_name}: {e}")
+                    return False
+                await asyncio.sleep(min(0.2 * 2 ** attempt, 5))
+        return False
+
+    async def _flush_batch(self, batch: List[Tuple[str, Dict[str, Any], Optional[str]]]):
+        started = time.perf_counter()
+        grouped: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        record_ids: Dict[str, List[str]] = defaultdict(list)
+        for collection_name, doc, record_id in batch:
+            grouped[collection_name].append(doc)
+            if record_id is not None:
+                record_ids[collection_name].append(record_id)
+        for collection_name, docs in grouped.items():
+            if await self._write(collection_name, docs) and record_ids[collection_name]:
+                try:
+                    self.spool.commit(record_ids[collection_name])
+                except Exception as e:
+                    # Không có dấu commit thì replayer ghi lại, handler idempotent nên an toàn
+                    logger.error(f"Không ghi được dấu commit spool: {e}")
+        for _ in batch:
+            self._queue.task_done()
+        self.batches += 1
+        self.last_batch_ms = (time.perf_counter() - started) * 1000
+
+    async def _run(self):
+        while not (self._stopping and self._queue.empty()):
+            batch = await self._next_batch()
+            if batch:
+                await self._flush_batch(batch)
+
+    async def _fsync_loop(self):
+        while True:
+            await asyncio.sleep(HISTORY_SPOOL_FSYNC_INTERVAL)
+            try:
+                await asyncio.to_thread(self.spool.fsync_if_dirty)
+            except Exception as e:
+                logger.error(f"fsync spool lỗi: {e}")
+
+    async def replay_spool(self) -> int:
+        """
+        Ghi lại các record chưa commit trong các segment đã niêm phong; dừng ở lỗi đầu tiên
+        (MongoDB vẫn chưa sẵn sàng) và thử lại ở lần sau. Trả về số document đã ghi lại.
+        """
+        if self.spool is None:
+            return 0
+        await asyncio.to_thread(self.spool.seal_if_stale)
+        replayed = 0
+        for path, records in await asyncio.to_thread(self.spool.pending_segments):
+            grouped: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+            for _, collection_name, doc in records:
+                grouped[collection_name].append(doc)
+            try:
+                for collection_name, docs in grouped.items():
+                    if collection_name not in self._handlers:
+                        raise ValueError(f"Chưa đăng ký handler cho collection {collection_name}")
+                    for i in range(0, len(docs), self.batch_size):
+                        await self._call_handler(collection_name, docs[i:i + self.batch_size])
+            except Exception as e:
+                self.spool.replay_errors += 1
+                logger.warning(f"Chưa replay được spool {path}: {e}")
+                break
+            self.spool.remove_segment(path)
+            replayed += len(records)
+        self.spool.replayed += replayed
+        if replayed:
+            logger.info(f"Đã replay {replayed} document từ spool")
+        return replayed
+
+    async def _replay_loop(self):
+        while True:
+            try:
+                await self.replay_spool()
+            except Exception as e:
+                logger.error(f"Replay spool lỗi: {e}")
+            await asyncio.sleep(self.replay_interval)
+
+    async def stop(self):
+        """
+        Dừng task nền sau khi ghi hết hàng đợi (gọi trong lifespan lúc tắt app)
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        try:
+            await asyncio.wait_for(self._task, timeout=max(self.flush_interval * 4, 10))
+        except asyncio.TimeoutError:
+            logger.error(f"Hết thời gian flush hàng đợi ghi, còn {self._queue.qsize()} document")
+            self._task.cancel()
+        self._task = None
+        for task in self._spool_tasks:
+            task.cancel()
+        self._spool_tasks = []
+        if self.spool is not None:
+            self.spool.close()
+
+    def stats(self) -> Dict[str, Any]:
+        depth = self._queue.qsize() if self._queue is not None else 0
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "queue_depth": depth,
+            "max_queue": self.max_queue,
+            "utilization": depth / self.max_queue if self.max_queue else 0.0,
+            "high_water_mark": self.high_water_mark,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "deferred_to_spool": self.deferred,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "last_batch_ms": round(self.last_batch_ms, 2),
+            "spool": self.spool.stats() if self.spool is not None else None,
+        }
+
+
+history_writer = BackgroundWriter(spool=create_history_spool())
@@ -0,0 +1,454 @@
+import os
+import sys
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app.data.database import chat_history_collection, close_database, db, insert_new_documents
+from app.data.pagination import decode_cursor, encode_cursor, fetch_page
+
+logger = logging.getLogger(__name__)
+
+# Bố cục lưu lượt chat: "turns" (mỗi lượt một document trong chat_history, mặc định)
+# hoặc "buckets" (các lượt được $push vào document bucket của conversation, tối đa CHAT_BUCKET_SIZE lượt)
+CHAT_HISTORY_LAYOUT = os.getenv("CHAT_HISTORY_LAYOUT", "turns").lower()
+CHAT_HISTORY_BUCKETS = CHAT_HISTORY_LAYOUT == "buckets"
+CHAT_BUCKET_SIZE = int(os.getenv("CHAT_BUCKET_SIZE", "50"))
+# Claim ghi lượt chưa hoàn tất sau khoảng này được coi là của writer đã lỗi/crash và có thể tiếp quản
+CHAT_BUCKET_CLAIM_SECONDS = float(os.getenv("CHAT_BUCKET_CLAIM_SECONDS", "60"))
+# Entry ledger tự hết hạn (TTL trên claimed_at) sau khoảng này; lượt cũ hơn khi replay spool
+# được kiểm tra trực tiếp trong bucket thay vì dựa vào ledger
+CHAT_BUCKET_LEDGER_TTL_SECONDS = int(os.getenv("CHAT_BUCKET_LEDGER_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+
+# {conversation_id, user_id, count, start_ts, end_ts, turns: [lượt không kèm conversation_id/user_id]}
+buckets_collection = db["chat_history_buckets"]
+# Ledger mỗi lượt một document (_id = _id lượt): {written, claimed_at}, hết hạn theo CHAT_BUCKET_LEDGER_TTL_SECONDS
+turn_ledger_collection = db["chat_history_bucket_turns"]
+
+# Trường của bucket được gộp lại vào từng lượt khi đọc
+BUCKET_FIELDS = ("conversation_id", "user_id")
+
+_UNWIND = [
+    {"$unwind": "$turns"},
+    {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+        {field: f"${field}" for field in BUCKET_FIELDS}, "$turns",
+    ]}}},
+]
+
+
+def _bucket_match(query: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Điều kiện trên bucket suy ra từ query trên lượt (user_id, conversation_id, khoảng timestamp),
+    để chỉ unwind các bucket có thể chứa lượt khớp
+    """
+    match = {field: query[field] for field in BUCKET_FIELDS if field in query}
+    timestamp = query.get("timestamp")
+    if isinstance(timestamp, dict):
+        end_bounds = {op: v for op, v in timestamp.items() if op in ("$gt", "$gte")}
+        start_bounds = {op: v for op, v in timestamp.items() if op in ("$lt", "$lte")}
+        if end_bounds:
+            match["end_ts"] = end_bounds
+        if start_bounds:
+            match["start_ts"] = start_bounds
+    return match
+
+
+def _turn(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in doc.items() if k not in BUCKET_FIELDS}
+
+
+class TurnWritePending(Exception):
+    """
+    Lượt đang được writer khác ghi (claim chưa quá hạn); ném ra để writer thử lại sau
+    """
+
+
+async def _claim_turns(docs: List[Dict[str, Any]], ledger) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Giành quyền ghi từng lượt bằng insert vào ledger (_id = _id lượt, unique).
+    Trả về (lượt mới giành được, lượt có claim quá hạn đã được tiếp quản).
+    Lượt đã ghi xong bị bỏ qua; lượt đang có writer khác giữ claim thì ném TurnWritePending.
+    """
+    now = datetime.utcnow()
+    claims = [{"_id": doc["_id"], "written": False, "claimed_at": now} for doc in docs]
+    claimed_ids = {claim["_id"] for claim in await insert_new_documents(ledger, claims)}
+    claimed = [doc for doc in docs if doc["_id"] in claimed_ids]
+    others = {doc["_id"]: doc for doc in docs if doc["_id"] not in claimed_ids}
+    if not others:
+        return claimed, []
+
+    recovered = []
+    busy = False
+    stale_before = now - timedelta(seconds=CHAT_BUCKET_CLAIM_SECONDS)
+    async for entry in ledger.find({"_id": {"$in": list(others)}, "written": False}, {"claimed_at": 1}):
+        if entry["claimed_at"] > stale_before:
+            busy = True
+            break
+        # Writer trước bị lỗi/crash giữa chừng: tiếp quản nếu chưa ai khác làm
+        result = await ledger.update_one(
+            {"_id": entry["_id"], "written": False, "claimed_at": entry["claimed_at"]},
+            {"$set": {"claimed_at": now}},
+        )
+        if result.modified_count != 1:
+            busy = True
+            break
+        recovered.append(others[entry["_id"]])
+    if busy:
+        # Nhả claim vừa giành để lần thử lại không tự chặn chính mình
+        await ledger.delete_many({"_id": {"$in": list(claimed_ids | {doc["_id"] for doc in recovered})}, "written": False})
+        raise TurnWritePending("Có lượt của lô đang được writer khác ghi")
+    return claimed, recovered
+
+
+async def insert_turns(
+    docs: List[Dict[str, Any]],
+    collection=buckets_collection,
+    bucket_size: int = CHAT_BUCKET_SIZE,
+    ledger=None,
+) -> List[Dict[str, Any]]:
+    """
+    $push các lượt vào bucket còn chỗ của conversation (upsert bucket mới khi đã đầy).
+    Mỗi lượt được giành quyền ghi qua ledger chat_history_bucket_turns trước khi $push, nên
+    queue writer và spool replayer không thể cùng đẩy một lượt. Lượt đã ghi xong được bỏ qua;
+    lượt cũ hơn TTL của ledger (entry có thể đã hết hạn) được đối chiếu với bucket trước khi $push.
+    Trả về các document thực sự được ghi bởi lần gọi này (để cập nhật cấu trúc dẫn xuất).
+    """
+    if not docs:
+        return []
+    ledger = turn_ledger_collection if ledger is None else ledger
+    for doc in docs:
+        doc.setdefault("_id", ObjectId())
+    claimed, recovered = await _claim_turns(docs, ledger)
+
+    # Lượt tiếp quản có thể đã được $push trước khi writer cũ kịp đánh dấu written;
+    # lượt quá TTL giành claim được có thể chỉ vì entry ledger cũ đã hết hạn
+    expired_before = datetime.utcnow() - timedelta(seconds=CHAT_BUCKET_LEDGER_TTL_SECONDS)
+    check_ids = [doc["_id"] for doc in recovered] + [doc["_id"] for doc in claimed if doc["timestamp"] < expired_before]
+    already_pushed = set()
+    if check_ids:
+        async for bucket in collection.find({"turns._id": {"$in": check_ids}}, {"turns._id": 1}):
+            already_pushed.update(turn["_id"] for turn in bucket.get("turns", []))
+    to_push = [doc for doc in claimed + recovered if doc["_id"] not in already_pushed]
+
+    # ordered=True: các lượt cùng conversation lần lượt lấp đầy bucket hiện tại rồi mới mở bucket mới.
+    # Lỗi giữa chừng thì claim được giữ nguyên, lần ghi lại sau khi claim quá hạn sẽ kiểm tra và tiếp quản.
+    ops = [
+        UpdateOne(
+            {"conversation_id": doc.get("conversation_id"), "count": {"$lt": bucket_size}},
+            {
+                "$push": {"turns": _turn(doc)},
+                "$inc": {"count": 1},
+                "$min": {"start_ts": doc["timestamp"]},
+                "$max": {"end_ts": doc["timestamp"]},
+                "$setOnInsert": {"user_id": doc.get("user_id")},
+            },
+            upsert=True,
+        )
+        for doc in sorted(to_push, key=lambda d: (d["timestamp"], d["_id"]))
+    ]
+    if ops:
+        await collection.bulk_write(ops, ordered=True)
+    if claimed or recovered:
+        ids = [doc["_id"] for doc in claimed + recovered]
+        await ledger.update_many({"_id": {"$in": ids}}, {"$set": {"written": True}})
+    return [doc for doc in claimed if doc["_id"] not in already_pushed] + recovered
+
+
+async def find_turns(
+    query: Dict[str, Any],
+    projection: Optional[Dict[str, Any]] = None,
+    sort: Optional[List[Tuple[str, int]]] = None,
+    skip: int = 0,
+    limit: int = 0,
+    collection=buckets_collection,
+) -> List[Dict[str, Any]]:
+    """
+    Tương đương find(query, projection).sort(sort).skip(skip).limit(limit) trên chat_history,
+    đọc từ các bucket (query chỉ dùng các trường của lượt)
+    """
+    pipeline: List[Dict[str, Any]] = [{"$match": _bucket_match(query)}, *_UNWIND, {"$match": query}]
+    if sort:
+        pipeline.append({"$sort": dict(sort)})
+    if skip:
+        pipeline.append({"$skip": skip})
+    if limit:
+        pipeline.append({"$limit": limit})
+    if projection:
+        pipeline.append({"$project": projection})
+    return await (await collection.aggregate(pipeline)).to_list()
+
+
+_BOUND_CHECKS = {
+    "$gt": lambda value, bound: value > bound,
+    "$gte": lambda value, bound: value >= bound,
+    "$lt": lambda value, bound: value < bound,
+    "$lte": lambda value, bound: value <= bound,
+}
+
+
+def _in_bounds(timestamp, bounds: Dict[str, Any]) -> bool:
+    return all(_BOUND_CHECKS[op](timestamp, bound) for op, bound in bounds.items() if op in _BOUND_CHECKS)
+
+
+def _project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not projection:
+        return doc
+    return {k: v for k, v in doc.items() if k == "_id" or projection.get(k)}
+
+
+async def fetch_turn_page(
+    query: Dict[str, Any],
+    limit: int,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict[str, Any]] = None,
+    collection=buckets_collection,
+) -> Tuple[List[Dict[str, Any]], Optional[str], bool]:
+    """
+    Như pagination.fetch_page (keyset theo timestamp, _id) nhưng đọc từ các bucket.
+    Duyệt bucket theo end_ts giảm dần và dừng khi bucket kế tiếp không thể chứa lượt nào mới hơn
+    lượt cuối của trang, nên chi phí tỉ lệ với kích thước trang chứ không phải toàn bộ lịch sử.
+    query chỉ gồm user_id/conversation_id và khoảng timestamp.
+    """
+    bucket_query = _bucket_match(query)
+    cursor_key = None
+    if cursor:
+        value, doc_id = decode_cursor(cursor)
+        cursor_key = (value, str(doc_id))
+        bucket_query = {"$and": [bucket_query, {"start_ts": {"$lte": value}}]}
+    bounds = query.get("timestamp") if isinstance(query.get("timestamp"), dict) else {}
+    skip = offset if offset and not cursor else 0
+    need = skip + limit + 1
+
+    fields = None
+    if projection:
+        fields = {"end_ts": 1, **{field: 1 for field in BUCKET_FIELDS}, "turns._id": 1, "turns.timestamp": 1}
+        fields.update({f"turns.{field}": 1 for field in projection if field not in BUCKET_FIELDS and field != "_id"})
+
+    # min-heap của `need` lượt mới nhất đã thấy: (khoá sắp xếp, thứ tự, lượt)
+    top: List[Tuple[Tuple[Any, str], int, Dict[str, Any]]] = []
+    seen = 0
+    buckets = collection.find(bucket_query, fields).sort("end_ts", -1)
+    try:
+        async for bucket in buckets:
+            if len(top) >= need and bucket["end_ts"] < top[0][0][0]:
+                break
+            for turn in bucket.get("turns", []):
+                timestamp = turn.get("timestamp")
+                if timestamp is None or not _in_bounds(timestamp, bounds):
+                    continue
+                key = (timestamp, str(turn["_id"]))
+                if cursor_key is not None and not key < cursor_key:
+                    continue
+                if len(top) >= need and not key > top[0][0]:
+                    continue
+                seen += 1
+                item = (key, seen, {**{field: bucket.get(field) for field in BUCKET_FIELDS}, **turn})
+                if len(top) < need:
+                    heapq.heappush(top, item)
+                else:
+                    heapq.heapreplace(top, item)
+    finally:
+        await buckets.close()
+
+    ordered = [_project(doc, projection) for _, _, doc in sorted(top, key=lambda item: item[0], reverse=True)]
+    docs = ordered[skip:]
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = encode_cursor(docs[-1]) if has_more and docs else None
+    return docs, next_cursor, has_more
+
+
+async def find_turns_by_ids(ids: List[Any], projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    if not ids:
+        return []
+    pipeline: List[Dict[str, Any]] = [
+        {"$match": {"turns._id": {"$in": ids}}},
+        *_UNWIND,
+        {"$match": {"_id": {"$in": ids}}},
+    ]
+    if projection:
+        pipeline.append({"$project": projection})
+    return await (await buckets_collection.aggregate(pipeline)).to_list()
+
+
+async def aggregate_turns(query: Dict[str, Any], stages: List[Dict[str, Any]], **kwargs) -> List[Dict[str, Any]]:
+    """
+    Chạy các stage aggregate trên các lượt khớp query (như chat_history.aggregate([{$match: query}, ...]))
+    """
+    pipeline = [{"$match": _bucket_match(query)}, *_UNWIND, {"$match": query}, *stages]
+    return await (await buckets_collection.aggregate(pipeline, **kwargs)).to_list()
+
+
+async def iter_turns(query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Duyệt các lượt khớp query (như chat_history.find(query, projection)), dùng cho các CLI dựng lại dữ liệu
+    """
+    pipeline: List[Dict[str, Any]] = [{"$match": _bucket_match(query)}, *_UNWIND, {"$match": query}]
+    if projection:
+        pipeline.append({"$project": projection})
+    async for doc in await buckets_collection.aggregate(pipeline):
+        yield doc
+
+
+async def delete_buckets(query: Dict[str, Any]) -> int:
+    """
+    Xoá bucket theo user_id hoặc conversation_id, trả về số lượt đã xoá
+    """
+    deleted = 0
+    async for bucket in buckets_collection.find(query, {"count": 1, "turns._id": 1}):
+        deleted += bucket.get("count", 0)
+        # Ledger không có index theo user/conversation: xoá theo _id lượt của từng bucket
+        turn_ids = [turn["_id"] for turn in bucket.get("turns", [])]
+        if turn_ids:
+            await turn_ledger_collection.delete_many({"_id": {"$in": turn_ids}})
+    await buckets_collection.delete_many(query)
+    return deleted
+
+
+async def migrate(batch_size: int = 500) -> int:
+    """
+    Chép các lượt trong chat_history sang bucket (theo conversation, thứ tự thời gian).
+    Chạy lại an toàn: lượt đã ghi (theo ledger) được bỏ qua. chat_history được giữ nguyên.
+    """
+    migrated = 0
+    batch: List[Dict[str, Any]] = []
+    cursor = chat_history_collection.find({}).sort([("conversation_id", 1), ("timestamp", 1)])
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            migrated += len(await insert_turns(batch))
+            batch = []
+    if batch:
+        migrated += len(await insert_turns(batch))
+    return migrated
+
+
+def _bench_docs(conversations: int, turns: int) -> List[Dict[str, Any]]:
+    # Các conversation xen kẽ nhau như khi nhiều người dùng chat cùng lúc
+    base = datetime.utcnow() - timedelta(minutes=turns)
+    docs = []
+    for t in range(turns):
+        for c in range(conversations):
+            docs.append({
+                "_id": ObjectId(),
+                "conversation_id": f"bench-conv-{c}",
+                "user_id": f"bench-user-{c % 10}",
+                "question": f"Câu hỏi số {t} về thủ tục hành chính và chuyển đổi số " * 3,
+                "answer": f"Trả lời số {t}: nội dung hướng dẫn chi tiết cho người dùng " * 8,
+                "agent": ("triage", "faq", "document")[t % 3],
+                "timestamp": base + timedelta(minutes=t, milliseconds=c),
+            })
+    return docs
+
+
+async def _timed(label: str, count: int, coro_factory) -> float:
+    started = time.perf_counter()
+    await coro_factory()
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<28} {count:>7} op  {elapsed:8.3f}s  {count / elapsed if elapsed else 0:10.0f} op/s")
+    return elapsed
+
+
+async def benchmark(conversations: int = 200, turns: int = 50, batch_size: int = 50, bucket_size: int = CHAT_BUCKET_SIZE):
+    """
+    So sánh thông lượng ghi/đọc giữa bố cục "turns" và "buckets" trên collection tạm
+    """
+    from app.data.indexes import INDEX_SPECS
+
+    turns_coll = db["bench_chat_history"]
+    buckets_coll = db["bench_chat_history_buckets"]
+    ledger_coll = db["bench_chat_history_bucket_turns"]
+    docs = _bench_docs(conversations, turns)
+    conversation_ids = [f"bench-conv-{c}" for c in range(conversations)]
+    user_ids = sorted({doc["user_id"] for doc in docs})
+    projection = {"question": 1, "answer": 1, "timestamp": 1, "agent": 1, "conversation_id": 1}
+    print(f"{len(docs)} lượt, {conversations} conversation, lô ghi {batch_size}, bucket {bucket_size} lượt")
+
+    try:
+        for coll in (turns_coll, buckets_coll, ledger_coll):
+            await coll.drop()
+        await turns_coll.create_indexes(INDEX_SPECS["chat_history"])
+        await buckets_coll.create_indexes(INDEX_SPECS["chat_history_buckets"])
+        await ledger_coll.create_indexes(INDEX_SPECS["chat_history_bucket_turns"])
+        batches = [docs[i:i + batch_size] for i in range(0, len(docs), batch_size)]
+
+        async def write_turns():
+            for batch in batches:
+                await insert_new_documents(turns_coll, [dict(doc) for doc in batch])
+
+        async def write_buckets():
+            for batch in batches:
+                await insert_turns([dict(doc) for doc in batch], buckets_coll, bucket_size, ledger_coll)
+
+        async def read_turns_conversations():
+            for cid in conversation_ids:
+                await turns_coll.find({"conversation_id": cid}, projection).sort("timestamp", 1).to_list()
+
+        async def read_bucket_conversations():
+            for cid in conversation_ids:
+                await find_turns({"conversation_id": cid}, projection, [("timestamp", 1), ("_id", 1)], collection=buckets_coll)
+
+        async def read_turns_recent():
+            for cid in conversation_ids:
+                await turns_coll.find({"conversation_id": cid}, projection).sort("timestamp", -1).limit(10).to_list()
+
+        async def read_bucket_recent():
+            for cid in conversation_ids:
+                await find_turns({"conversation_id": cid}, projection, [("timestamp", -1), ("_id", -1)], limit=10, collection=buckets_coll)
+
+        async def read_turns_pages():
+            for uid in user_ids:
+                await fetch_page(turns_coll, {"user_id": uid}, 50, projection=projection)
+
+        async def read_bucket_pages():
+            for uid in user_ids:
+                await fetch_turn_page({"user_id": uid}, 50, projection=projection, collection=buckets_coll)
+
+        for layout, colls, steps in (
+            ("turns", (turns_coll,), (write_turns, read_turns_conversations, read_turns_recent, read_turns_pages)),
+            ("buckets", (buckets_coll, ledger_coll), (write_buckets, read_bucket_conversations, read_bucket_recent, read_bucket_pages)),
+        ):
+            print(f"[{layout}]")
+            write, conversations_read, recent_read, pages_read = steps
+            await _timed("ghi (lượt)", len(docs), write)
+            await _timed("đọc conversation", len(conversation_ids), conversations_read)
+            await _timed("đọc 10 lượt gần nhất", len(conversation_ids), recent_read)
+            await _timed("trang lịch sử user", len(user_ids), pages_read)
+            # Bố cục buckets tính cả ledger (dữ liệu + index) vào dung lượng
+            for coll in colls:
+                stats = await db.command("collStats", coll.name)
+                print(
+                    f"  {coll.name}: {stats.get('count')} document, dữ liệu {stats.get('size', 0) / 1024:.0f} KiB, "
+                    f"index {stats.get('totalIndexSize', 0) / 1024:.0f} KiB"
+                )
+    finally:
+        for coll in (turns_coll, buckets_coll, ledger_coll):
+            await coll.drop()
+
+
+async def _main(args: List[str]):
+    try:
+        if args[0] == "migrate":
+            migrated = await migrate()
+            print(f"Đã chép {migrated} lượt chat sang bucket")
+        else:
+            numbers = [int(a) for a in args[1:]]
+            await benchmark(*numbers)
+    finally:
+        await close_database()
+
+
+if __name__ == "__main__":
+    # python -m app.services.chat_buckets migrate
+    # python -m app.services.chat_buckets bench [conversations] [turns] [batch_size] [bucket_size]
+    if len(sys.argv) < 2 or sys.argv[1] not in ("migrate", "bench"):
+        print("Cách dùng: python -m app.services.chat_buckets migrate|bench [conversations] [turns] [batch_size] [bucket_size]")
+        sys.exit(1)
+    asyncio.run(_main(sys.argv[1:]))
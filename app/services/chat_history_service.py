@@ -1,13 +1,80 @@
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta
 from app.data.database import chat_history_collection
+from app.data.pagination import InvalidCursor, fetch_page
+from app.services.background_writer import history_writer
+from app.services import chat_buckets, chat_payloads, chat_search, conversation_summaries, user_stats
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Trường đủ để hiển thị lịch sử; events/context (có thể rất lớn) chỉ đọc khi được yêu cầu
+HISTORY_FIELDS = ("question", "answer", "timestamp", "agent", "conversation_id")
+OPTIONAL_FIELDS = ("events", "context")
+REHYDRATE_FIELDS = ("question", "answer", "timestamp", "agent", "user_id", "context")
+
+
+def parse_include(value: Optional[str]) -> List[str]:
+    """
+    Đọc tham số include=events,context, báo lỗi nếu có trường không hỗ trợ
+    """
+    fields = [f.strip() for f in (value or "").split(",") if f.strip()]
+    unknown = [f for f in fields if f not in OPTIONAL_FIELDS]
+    if unknown:
+        raise ValueError(f"include không hỗ trợ: {', '.join(unknown)} (chỉ nhận {', '.join(OPTIONAL_FIELDS)})")
+    return fields
+
+
+def history_projection(include: Optional[List[str]] = None, fields=HISTORY_FIELDS) -> Dict[str, int]:
+    projection = {field: 1 for field in fields}
+    for field in include or []:
+        if field in OPTIONAL_FIELDS:
+            projection[field] = 1
+    return projection
+
+
 class ChatHistoryService:
     @staticmethod
-    def save_chat(
+    def build_chat_doc(
+        conversation_id: str,
+        user_id: str,
+        question: str,
+        answer: str,
+        agent: str,
+        context: Dict[str, Any] = None,
+        events: List[Dict[str, Any]] = None,
+        context_delta: Dict[str, Any] = None,
+        context_base: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Tạo document chat_history cho một lượt hội thoại
+        (context là snapshot đầy đủ, context_delta là thay đổi so với lượt đã lưu trước,
+        context_base là dấu vân tay của context gốc của delta)
+        """
+        doc = {
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "question": question,
+            "answer": answer,
+            "agent": agent,
+            "timestamp": datetime.utcnow(),
+            "context": context,
+            "events": events
+        }
+        if context_delta is not None:
+            doc["context_delta"] = context_delta
+            doc["context_base"] = context_base
+        return doc
+
+    @staticmethod
+    def context_fields(state: Dict[str, Any], conversation_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        context hoặc context_delta cho lượt hiện tại của conversation (xem chat_payloads)
+        """
+        return chat_payloads.context_fields(state, conversation_id)
+
+    @staticmethod
+    async def save_chat(
         conversation_id: str,
         user_id: str,
         question: str,
@@ -20,34 +87,99 @@ class ChatHistoryService:
         Lưu một cuộc hội thoại vào database
         """
         try:
-            chat_doc = {
-                "conversation_id": conversation_id,
-                "user_id": user_id,
-                "question": question,
-                "answer": answer,
-                "agent": agent,
-                "timestamp": datetime.utcnow(),
-                "context": context,
-                "events": events
-            }
-            
-            result = chat_history_collection.insert_one(chat_doc)
-            return result.inserted_id is not None
+            chat_doc = ChatHistoryService.build_chat_doc(
+                conversation_id, user_id, question, answer, agent, context, events
+            )
+            return await ChatHistoryService.save_chats([chat_doc]) == 1
         except Exception as e:
             logger.error(f"Lỗi khi lưu chat history: {e}")
             return False
 
     @staticmethod
-    def get_user_history(
+    async def save_chats(chat_docs: List[Dict[str, Any]]) -> int:
+        """
+        Lưu một lô document chat_history (insert_many), trả về số document mới được ghi.
+        events/context được tách sang chat_turn_payloads (CHAT_PAYLOAD_SPLIT).
+        Document đã tồn tại (_id trùng, VD khi replay spool) được bỏ qua.
+        Với CHAT_HISTORY_LAYOUT=buckets, phần nóng được $push vào chat_history_buckets.
+        """
+        try:
+            if chat_buckets.CHAT_HISTORY_BUCKETS:
+                new_docs = await chat_payloads.insert_turns(chat_docs, chat_buckets.insert_turns)
+            else:
+                new_docs = await chat_payloads.insert_turns(chat_docs)
+        except Exception:
+            # Delta của lượt sau không được dựa trên context chưa chắc đã lưu
+            chat_payloads.mark_context_lost(chat_docs)
+            raise
+        await ChatHistoryService._after_insert(new_docs)
+        return len(new_docs)
+
+    @staticmethod
+    async def _after_insert(new_docs: List[Dict[str, Any]]):
+        """
+        Cập nhật các cấu trúc dẫn xuất (search index, conversation summary, thống kê ngày) cho document mới ghi.
+        Lỗi ở đây không làm hỏng lượt ghi; dựng lại bằng CLI tương ứng nếu cần.
+        """
+        if not new_docs:
+            return
+        try:
+            await chat_search.index_turns(new_docs)
+        except Exception as e:
+            logger.error(f"Lỗi khi cập nhật search index: {e}")
+        try:
+            await conversation_summaries.record_turns(new_docs)
+        except Exception as e:
+            logger.error(f"Lỗi khi cập nhật conversation summary: {e}")
+        if user_stats.USER_STATS_ROLLUP:
+            try:
+                await user_stats.record_turns(new_docs)
+            except Exception as e:
+                logger.error(f"Lỗi khi cập nhật thống kê ngày: {e}")
+
+    @staticmethod
+    def enqueue_chat(**kwargs) -> bool:
+        """
+        Đưa lượt hội thoại vào hàng đợi ghi nền, không chờ MongoDB
+        """
+        doc = ChatHistoryService.build_chat_doc(**kwargs)
+        queued = history_writer.submit("chat_history", doc)
+        if not queued:
+            chat_payloads.mark_context_lost([doc])
+        return queued
+
+    @staticmethod
+    async def get_user_history(
         user_id: str, 
         limit: int = 50, 
         offset: int = 0,
         start_date: Optional[datetime] = None,
-        end_date: Optional[datetime] = None
+        end_date: Optional[datetime] = None,
+        include: Optional[List[str]] = None
     ) -> List[Dict[str, Any]]:
         """
         Lấy lịch sử chat của user với filter theo thời gian
         """
+        docs, _, _ = await ChatHistoryService.get_user_history_page(
+            user_id, limit, offset, start_date, end_date, include=include
+        )
+        return docs
+
+    @staticmethod
+    async def get_user_history_page(
+        user_id: str,
+        limit: int = 50,
+        offset: int = 0,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        cursor: Optional[str] = None,
+        include: Optional[List[str]] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str], bool]:
+        """
+        Lấy một trang lịch sử chat của user, trả về (docs, next_cursor, has_more).
+        Có cursor thì phân trang theo keyset (timestamp, _id), không thì theo offset.
+        Chỉ đọc HISTORY_FIELDS, thêm events/context qua include.
+        """
         try:
             query = {"user_id": user_id}
             
@@ -60,123 +192,203 @@ class ChatHistoryService:
                     time_filter["$lte"] = end_date
                 query["timestamp"] = time_filter
             
-            cursor = chat_history_collection.find(query).sort("timestamp", -1).skip(offset).limit(limit)
-            return list(cursor)
+            if chat_buckets.CHAT_HISTORY_BUCKETS:
+                docs, next_cursor, has_more = await chat_buckets.fetch_turn_page(
+                    query, limit, offset, cursor, history_projection(include)
+                )
+            else:
+                docs, next_cursor, has_more = await fetch_page(
+                    chat_history_collection, query, limit, offset, cursor, history_projection(include)
+                )
+            return await chat_payloads.attach_payloads(docs, include or []), next_cursor, has_more
+        except InvalidCursor:
+            raise
         except Exception as e:
             logger.error(f"Lỗi khi lấy user history: {e}")
-            return []
+            return [], None, False
 
     @staticmethod
-    def get_conversation_history(conversation_id: str) -> List[Dict[str, Any]]:
+    async def get_conversation_history(
+        conversation_id: str, include: Optional[List[str]] = None
+    ) -> List[Dict[str, Any]]:
         """
-        Lấy toàn bộ lịch sử của một conversation
+        Lấy toàn bộ lịch sử của một conversation (HISTORY_FIELDS + include)
         """
         try:
-            cursor = chat_history_collection.find(
-                {"conversation_id": conversation_id}
-            ).sort("timestamp", 1)
-            return list(cursor)
+            docs = await ChatHistoryService._find_conversation_turns(conversation_id, history_projection(include))
+            return await chat_payloads.attach_payloads(docs, include or [])
         except Exception as e:
             logger.error(f"Lỗi khi lấy conversation history: {e}")
             return []
 
     @staticmethod
-    def get_user_statistics(user_id: str, days: int = 30) -> Dict[str, Any]:
+    async def _find_conversation_turns(
+        conversation_id: str,
+        projection: Dict[str, Any],
+        newest_first: bool = False,
+        limit: int = 0
+    ) -> List[Dict[str, Any]]:
+        """
+        Các lượt của một conversation theo thời gian, theo bố cục đang dùng
+        """
+        direction = -1 if newest_first else 1
+        query = {"conversation_id": conversation_id}
+        if chat_buckets.CHAT_HISTORY_BUCKETS:
+            return await chat_buckets.find_turns(
+                query, projection, [("timestamp", direction), ("_id", direction)], limit=limit
+            )
+        cursor = chat_history_collection.find(query, projection).sort("timestamp", direction)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list()
+
+    @staticmethod
+    async def get_user_conversations_page(
+        user_id: str,
+        limit: int = 20,
+        offset: int = 0,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str], bool]:
         """
-        Lấy thống kê chat của user trong N ngày gần đây
+        Danh sách conversation của user từ collection conversations, trả về (docs, next_cursor, has_more)
         """
         try:
+            return await conversation_summaries.list_conversations(user_id, limit, offset, cursor)
+        except InvalidCursor:
+            raise
+        except Exception as e:
+            logger.error(f"Lỗi khi lấy danh sách conversation: {e}")
+            return [], None, False
+
+    @staticmethod
+    async def get_recent_conversation_turns(conversation_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Lấy N lượt hội thoại gần nhất của một conversation (theo thứ tự thời gian tăng dần)
+        """
+        try:
+            turns = await ChatHistoryService._find_conversation_turns(
+                conversation_id, history_projection(fields=REHYDRATE_FIELDS), newest_first=True, limit=limit
+            )
+            turns.reverse()
+            # Chỉ lượt cuối cần context đầy đủ (để dựng lại state)
+            await chat_payloads.attach_payloads(turns[-1:], ["context"])
+            return turns
+        except Exception as e:
+            logger.error(f"Lỗi khi lấy các lượt gần nhất của conversation: {e}")
+            return []
+
+    @staticmethod
+    async def get_user_statistics(user_id: str, days: int = 30) -> Dict[str, Any]:
+        """
+        Lấy thống kê chat của user trong N ngày gần đây: đọc các document thống kê ngày
+        (user_daily_stats, O(days)); chưa có rollup thì tính bằng một aggregate $facet
+        """
+        try:
+            if user_stats.USER_STATS_ROLLUP:
+                stats = await user_stats.get_statistics(user_id, days)
+                if stats is not None:
+                    return stats
+
             start_date = datetime.utcnow() - timedelta(days=days)
-            
-            # Tổng số tin nhắn
-            total_messages = chat_history_collection.count_documents({
-                "user_id": user_id,
-                "timestamp": {"$gte": start_date}
-            })
-            
-            # Số conversation
-            conversations = chat_history_collection.distinct("conversation_id", {
-                "user_id": user_id,
-                "timestamp": {"$gte": start_date}
-            })
-            
-            # Agent được sử dụng nhiều nhất
-            pipeline = [
-                {"$match": {"user_id": user_id, "timestamp": {"$gte": start_date}}},
-                {"$group": {"_id": "$agent", "count": {"$sum": 1}}},
-                {"$sort": {"count": -1}},
-                {"$limit": 5}
-            ]
-            top_agents = list(chat_history_collection.aggregate(pipeline))
-            
-            # Tin nhắn theo ngày
-            daily_pipeline = [
-                {"$match": {"user_id": user_id, "timestamp": {"$gte": start_date}}},
-                {"$group": {
-                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}},
-                    "count": {"$sum": 1}
-                }},
-                {"$sort": {"_id": 1}}
-            ]
-            daily_stats = list(chat_history_collection.aggregate(daily_pipeline))
-            
-            return {
-                "total_messages": total_messages,
-                "total_conversations": len(conversations),
-                "top_agents": top_agents,
-                "daily_stats": daily_stats,
-                "period_days": days
-            }
+            match = {"user_id": user_id, "timestamp": {"$gte": start_date}}
+            result = await ChatHistoryService._aggregate_turns(match, user_stats.facet_stages())
+            return user_stats.from_facet(result, days)
         except Exception as e:
             logger.error(f"Lỗi khi lấy user statistics: {e}")
             return {}
 
     @staticmethod
-    def delete_user_history(user_id: str) -> bool:
+    async def _aggregate_turns(query: Dict[str, Any], stages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        aggregate [{$match: query}, *stages] trên các lượt chat, theo bố cục đang dùng
+        """
+        if chat_buckets.CHAT_HISTORY_BUCKETS:
+            return await chat_buckets.aggregate_turns(query, stages)
+        return await (await chat_history_collection.aggregate([{"$match": query}, *stages])).to_list()
+
+    @staticmethod
+    async def _delete_turns(query: Dict[str, Any]) -> int:
+        if chat_buckets.CHAT_HISTORY_BUCKETS:
+            return await chat_buckets.delete_buckets(query)
+        result = await chat_history_collection.delete_many(query)
+        return result.deleted_count
+
+    @staticmethod
+    async def delete_user_history(user_id: str) -> bool:
         """
         Xóa toàn bộ lịch sử chat của user
         """
         try:
-            result = chat_history_collection.delete_many({"user_id": user_id})
-            return result.deleted_count > 0
+            deleted = await ChatHistoryService._delete_turns({"user_id": user_id})
+            await chat_search.unindex({"user_id": user_id})
+            await chat_payloads.delete_payloads({"user_id": user_id})
+            await conversation_summaries.delete_summaries({"user_id": user_id})
+            await user_stats.delete_user_stats(user_id)
+            return deleted > 0
         except Exception as e:
             logger.error(f"Lỗi khi xóa user history: {e}")
             return False
 
     @staticmethod
-    def delete_conversation_history(conversation_id: str) -> bool:
+    async def delete_conversation_history(conversation_id: str) -> bool:
         """
         Xóa lịch sử của một conversation
         """
         try:
-            result = chat_history_collection.delete_many({"conversation_id": conversation_id})
-            return result.deleted_count > 0
+            await chat_search.unindex({"conversation_id": conversation_id})
+            await chat_payloads.delete_payloads({"conversation_id": conversation_id})
+            await conversation_summaries.delete_summaries({"_id": conversation_id})
+            if user_stats.USER_STATS_ROLLUP:
+                turns = await ChatHistoryService._find_conversation_turns(
+                    conversation_id, {"user_id": 1, "agent": 1, "timestamp": 1}
+                )
+                await user_stats.forget_conversation(conversation_id, turns)
+            deleted = await ChatHistoryService._delete_turns({"conversation_id": conversation_id})
+            return deleted > 0
         except Exception as e:
             logger.error(f"Lỗi khi xóa conversation history: {e}")
             return False
 
     @staticmethod
-    def search_chat_history(
+    async def search_chat_history(
         user_id: str,
         search_term: str,
         limit: int = 50,
-        offset: int = 0
+        offset: int = 0,
+        include: Optional[List[str]] = None
     ) -> List[Dict[str, Any]]:
         """
         Tìm kiếm trong lịch sử chat của user
         """
+        docs, _, _, _ = await ChatHistoryService.search_chat_history_page(
+            user_id, search_term, limit, offset, include=include
+        )
+        return docs
+
+    @staticmethod
+    async def search_chat_history_page(
+        user_id: str,
+        search_term: str,
+        limit: int = 50,
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        include: Optional[List[str]] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str], bool, bool]:
+        """
+        Tìm kiếm trong lịch sử chat của user (BM25 trên inverted index, không phân biệt dấu),
+        trả về (docs, next_cursor, has_more, truncated) theo thứ tự liên quan
+        """
         try:
-            # Tìm kiếm trong cả question và answer
-            query = {
-                "user_id": user_id,
-                "$or": [
-                    {"question": {"$regex": search_term, "$options": "i"}},
-                    {"answer": {"$regex": search_term, "$options": "i"}}
-                ]
-            }
-            
-            cursor = chat_history_collection.find(query).sort("timestamp", -1).skip(offset).limit(limit)
-            return list(cursor)
+            load_turns = chat_buckets.find_turns_by_ids if chat_buckets.CHAT_HISTORY_BUCKETS else None
+            docs, next_cursor, has_more, truncated = await chat_search.search(
+                user_id, search_term, limit, offset, cursor, history_projection(include), load_turns
+            )
+            return await chat_payloads.attach_payloads(docs, include or []), next_cursor, has_more, truncated
+        except InvalidCursor:
+            raise
         except Exception as e:
             logger.error(f"Lỗi khi tìm kiếm chat history: {e}")
-            return [] 
\ No newline at end of file
+            return [], None, False, False
+
+
+history_writer.register("chat_history", ChatHistoryService.save_chats)
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import asyncio
+import hashlib
+import logging
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app.data.database import chat_history_collection, close_database, db, insert_new_documents
+
+logger = logging.getLogger(__name__)
+
+# Phần "lạnh" của mỗi lượt chat (events, context), _id trùng với _id của lượt trong chat_history.
+# Context lưu dạng snapshot đầy đủ hoặc delta so với lượt đã lưu trước đó của conversation;
+# delta kèm context_base (dấu vân tay của context gốc) để phía đọc phát hiện chuỗi bị đứt.
+payload_collection = db["chat_turn_payloads"]
+
+CHAT_PAYLOAD_SPLIT = os.getenv("CHAT_PAYLOAD_SPLIT", "true").lower() == "true"
+# Sau bao nhiêu delta thì ghi lại một snapshot để giới hạn số bản ghi phải gộp khi đọc
+CONTEXT_SNAPSHOT_INTERVAL = int(os.getenv("CONTEXT_SNAPSHOT_INTERVAL", "20"))
+
+COLD_FIELDS = ("events", "context", "context_delta", "context_base")
+
+# Conversation có lượt mang context bị bỏ/ghi lỗi: mốc trong state có thể chưa từng được lưu,
+# lượt tiếp theo phải ghi snapshot đầy đủ thay vì delta
+_lost_context_conversations: set = set()
+
+
+def context_fingerprint(context: Optional[Dict[str, Any]]) -> Optional[str]:
+    if context is None:
+        return None
+    raw = json.dumps(context, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _delta(base: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "context_delta": {k: v for k, v in current.items() if base.get(k) != v},
+        "context_base": context_fingerprint(base),
+    }
+
+
+def mark_context_lost(docs: List[Dict[str, Any]]):
+    for doc in docs:
+        if doc.get("conversation_id") and (doc.get("context") is not None or doc.get("context_delta") is not None):
+            _lost_context_conversations.add(doc["conversation_id"])
+
+
+def context_fields(state: Dict[str, Any], conversation_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Trường context cho document chat_history của lượt hiện tại: snapshot khi chưa có mốc
+    (lượt đầu, sau restart, đủ CONTEXT_SNAPSHOT_INTERVAL delta, hoặc lượt trước không được ghi),
+    còn lại là delta. Cập nhật mốc trong state (persisted_context, context_deltas), nên gọi
+    trước khi lưu state để worker khác tiếp tục từ đúng mốc.
+    """
+    current = state["context"].model_dump()
+    if not CHAT_PAYLOAD_SPLIT:
+        return {"context": current}
+    base = state.get("persisted_context")
+    deltas = state.get("context_deltas", 0)
+    state["persisted_context"] = current
+    if conversation_id in _lost_context_conversations:
+        _lost_context_conversations.discard(conversation_id)
+        base = None
+    if base is None or deltas >= CONTEXT_SNAPSHOT_INTERVAL:
+        state["context_deltas"] = 0
+        return {"context": current}
+    state["context_deltas"] = deltas + 1
+    return _delta(base, current)
+
+
+def split_doc(doc: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """
+    Tách document lượt chat thành (phần nóng cho chat_history, phần lạnh cho chat_turn_payloads)
+    """
+    hot = {k: v for k, v in doc.items() if k not in COLD_FIELDS}
+    cold = {k: doc[k] for k in COLD_FIELDS if doc.get(k) is not None}
+    if not cold:
+        return hot, None
+    cold.update({
+        "_id": doc["_id"],
+        "conversation_id": doc.get("conversation_id"),
+        "user_id": doc.get("user_id"),
+        "timestamp": doc.get("timestamp"),
+    })
+    return hot, cold
+
+
+async def insert_hot_turns(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return await insert_new_documents(chat_history_collection, docs)
+
+
+async def insert_turns(
+    docs: List[Dict[str, Any]],
+    insert_hot: Callable[[List[Dict[str, Any]]], Awaitable[List[Dict[str, Any]]]] = insert_hot_turns,
+) -> List[Dict[str, Any]]:
+    """
+    Ghi lô lượt chat theo bố cục tách nóng/lạnh; phần lạnh ghi trước để lượt nóng
+    không bao giờ trỏ tới payload chưa tồn tại. Trả về các document nóng mới được ghi.
+    insert_hot ghi phần nóng (mặc định vào chat_history, hoặc vào bucket).
+    """
+    if not CHAT_PAYLOAD_SPLIT:
+        return await insert_hot(docs)
+    for doc in docs:
+        doc.setdefault("_id", ObjectId())
+    pairs = [split_doc(doc) for doc in docs]
+    await insert_new_documents(payload_collection, [cold for _, cold in pairs if cold is not None])
+    return await insert_hot([hot for hot, _ in pairs])
+
+
+def _apply(context: Optional[Dict[str, Any]], payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Context sau lượt `payload`; None khi không dựng lại được (delta tính trên một context
+    không có trong chuỗi đã lưu, VD lượt gốc bị mất hoặc worker khác giữ mốc cũ)
+    """
+    if payload.get("context") is not None:
+        return dict(payload["context"])
+    if payload.get("context_delta") is not None:
+        if context is None:
+            return None
+        # Delta cũ (trước khi có context_base) được áp dụng như trước
+        if "context_base" in payload and payload["context_base"] != context_fingerprint(context):
+            return None
+        return {**context, **payload["context_delta"]}
+    return context
+
+
+async def _contexts_until(conversation_id: str, timestamp) -> Dict[Any, Dict[str, Any]]:
+    """
+    Dựng context đầy đủ cho các lượt của conversation tính tới `timestamp`:
+    đọc ngược tới snapshot gần nhất rồi gộp delta theo thứ tự thời gian
+    """
+    chain: List[Dict[str, Any]] = []
+    cursor = payload_collection.find(
+        {"conversation_id": conversation_id, "timestamp": {"$lte": timestamp}},
+        {"context": 1, "context_delta": 1, "context_base": 1},
+    ).sort([("timestamp", -1), ("_id", -1)])
+    async for payload in cursor:
+        chain.append(payload)
+        if payload.get("context") is not None:
+            break
+    contexts: Dict[Any, Optional[Dict[str, Any]]] = {}
+    context = None
+    for payload in reversed(chain):
+        context = _apply(context, payload)
+        contexts[payload["_id"]] = context
+    if chain and context is None:
+        logger.warning(f"Chuỗi context của conversation {conversation_id} bị đứt trước {chain[0]['_id']}, bỏ qua context")
+    return contexts
+
+
+async def attach_payloads(docs: List[Dict[str, Any]], include: List[str]) -> List[Dict[str, Any]]:
+    """
+    Gắn events/context cho các document nóng (đọc kèm include). Document cũ vẫn còn
+    events/context nhúng trong chat_history được giữ nguyên.
+    """
+    wants_events = "events" in include
+    wants_context = "context" in include
+    if not docs or not (wants_events or wants_context):
+        return docs
+
+    if wants_events:
+        missing = [doc["_id"] for doc in docs if doc.get("events") is None]
+        if missing:
+            cursor = payload_collection.find({"_id": {"$in": missing}}, {"events": 1})
+            events = {p["_id"]: p.get("events") for p in await cursor.to_list()}
+            for doc in docs:
+                if doc.get("events") is None and doc["_id"] in events:
+                    doc["events"] = events[doc["_id"]]
+
+    if wants_context:
+        pending = defaultdict(list)
+        for doc in docs:
+            if doc.get("context") is None:
+                pending[doc.get("conversation_id")].append(doc)
+        for conversation_id, conversation_docs in pending.items():
+            unresolved = sorted(conversation_docs, key=lambda d: (d["timestamp"], d["_id"]), reverse=True)
+            while unresolved:
+                contexts = await _contexts_until(conversation_id, unresolved[0]["timestamp"])
+                if not contexts:
+                    break
+                for doc in unresolved:
+                    if doc["_id"] in contexts:
+                        doc["context"] = contexts[doc["_id"]]
+                resolved = [doc for doc in unresolved if doc["_id"] in contexts]
+                unresolved = [doc for doc in unresolved if doc["_id"] not in contexts]
+                if not resolved:
+                    # Lượt cũ không có payload (dữ liệu trước khi tách)
+                    unresolved = unresolved[1:]
+    return docs
+
+
+async def delete_payloads(query: Dict[str, Any]) -> int:
+    result = await payload_collection.delete_many(query)
+    return result.deleted_count
+
+
+async def migrate(batch_size: int = 500) -> int:
+    """
+    Chuyển events/context đang nhúng trong chat_history sang chat_turn_payloads
+    (context chuyển thành snapshot + delta theo từng conversation), rồi $unset khỏi chat_history.
+    Chạy lại an toàn: payload ghi idempotent theo _id, document đã chuyển không còn khớp query.
+    """
+    query = {"$or": [{"events": {"$exists": True}}, {"context": {"$exists": True}}]}
+    cursor = chat_history_collection.find(query).sort([("conversation_id", 1), ("timestamp", 1)])
+    previous: Dict[str, Tuple[Dict[str, Any], int]] = {}
+    payloads: List[Dict[str, Any]] = []
+    unsets: List[UpdateOne] = []
+    migrated = 0
+
+    async def flush():
+        nonlocal payloads, unsets
+        await insert_new_documents(payload_collection, payloads)
+        if unsets:
+            await chat_history_collection.bulk_write(unsets, ordered=False)
+        payloads, unsets = [], []
+
+    async for doc in cursor:
+        conversation_id = doc.get("conversation_id")
+        context = doc.get("context")
+        if context is not None:
+            base, deltas = previous.get(conversation_id, (None, 0))
+            if base is not None and deltas < CONTEXT_SNAPSHOT_INTERVAL:
+                doc.update(_delta(base, context))
+                del doc["context"]
+                previous[conversation_id] = (context, deltas + 1)
+            else:
+                previous[conversation_id] = (context, 0)
+        _, cold = split_doc(doc)
+        if cold is not None:
+            payloads.append(cold)
+        unsets.append(UpdateOne({"_id": doc["_id"]}, {"$unset": {"events": "", "context": ""}}))
+        migrated += 1
+        if len(unsets) >= batch_size:
+            await flush()
+    await flush()
+    return migrated
+
+
+async def _main():
+    try:
+        migrated = await migrate()
+        print(f"Đã chuyển payload của {migrated} lượt chat")
+    finally:
+        await close_database()
+
+
+if __name__ == "__main__":
+    # python -m app.services.chat_payloads
+    if len(sys.argv) > 1:
+        print("Cách dùng: python -m app.services.chat_payloads")
+        sys.exit(1)
+    asyncio.run(_main())
@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import html
+import math
+import base64
+import asyncio
+import logging
+import unicodedata
+from datetime import datetime
+from collections import Counter, defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from app.data.database import chat_history_collection, db, close_database, insert_new_documents
+from app.data.pagination import InvalidCursor
+from app.services import chat_buckets
+from app.services.text_normalize import iter_words, normalize_text, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Mỗi lượt chat một document posting (_id = id lượt) với mảng terms [{term, tf}], index multikey theo (user, term).
+# df lưu riêng mỗi (user, term) một document; số lượt và tổng độ dài lưu theo user
+search_postings_collection = db["chat_search_postings"]
+search_terms_collection = db["chat_search_terms"]
+search_stats_collection = db["chat_search_stats"]
+
+SEARCH_BM25_K1 = float(os.getenv("SEARCH_BM25_K1", "1.2"))
+SEARCH_BM25_B = float(os.getenv("SEARCH_BM25_B", "0.75"))
+# Giới hạn posting đọc cho mỗi term (mới nhất trước); khi bị cắt, kết quả trả về kèm cờ truncated
+SEARCH_MAX_POSTINGS_PER_TERM = int(os.getenv("SEARCH_MAX_POSTINGS_PER_TERM", "5000"))
+SEARCH_MAX_QUERY_TERMS = int(os.getenv("SEARCH_MAX_QUERY_TERMS", "16"))
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "160"))
+
+
+def _turn_text(doc: Dict[str, Any]) -> str:
+    return f"{doc.get('question') or ''}\n{doc.get('answer') or ''}"
+
+
+def _term_id(user_id: str, term: str) -> str:
+    return f"{user_id}:{term}"
+
+
+def _posting_for(doc: Dict[str, Any]) -> Dict[str, Any]:
+    tokens = tokenize(_turn_text(doc))
+    return {
+        "_id": doc["_id"],
+        "user_id": doc.get("user_id"),
+        "conversation_id": doc.get("conversation_id"),
+        "timestamp": doc.get("timestamp"),
+        "len": len(tokens),
+        "terms": [{"term": term, "tf": tf} for term, tf in Counter(tokens).items()],
+    }
+
+
+async def _apply_stats(postings: List[Dict[str, Any]], sign: int):
+    """
+    Cộng (sign=1) hoặc trừ (sign=-1) df của từng (user, term) và số lượt/tổng độ dài của user
+    """
+    df: Counter = Counter()
+    per_user: Dict[str, Counter] = defaultdict(Counter)
+    for posting in postings:
+        user_id = posting["user_id"]
+        per_user[user_id]["docs"] += sign
+        per_user[user_id]["total_length"] += sign * posting.get("len", 0)
+        for entry in posting.get("terms") or []:
+            df[(user_id, entry["term"])] += sign
+    if df:
+        await search_terms_collection.bulk_write([
+            UpdateOne(
+                {"_id": _term_id(user_id, term)},
+                {"$inc": {"df": n}, "$setOnInsert": {"user_id": user_id, "term": term}},
+                upsert=sign > 0,
+            )
+            for (user_id, term), n in df.items()
+        ], ordered=False)
+        if sign < 0:
+            await search_terms_collection.delete_many({"user_id": {"$in": list(per_user)}, "df": {"$lte": 0}})
+    for user_id, inc in per_user.items():
+        await search_stats_collection.update_one({"_id": user_id}, {"$inc": dict(inc)}, upsert=sign > 0)
+
+
+async def index_turns(docs: List[Dict[str, Any]]):
+    """
+    Cập nhật inverted index cho các lượt chat vừa được ghi; lượt đã có posting (trùng _id) được bỏ qua
+    """
+    postings = [_posting_for(doc) for doc in docs if doc.get("user_id")]
+    if not postings:
+        return
+    await _apply_stats(await insert_new_documents(search_postings_collection, postings), 1)
+
+
+async def unindex(query: Dict[str, Any]):
+    """
+    Xoá posting khớp query (user_id hoặc conversation_id) và trừ lại thống kê BM25
+    """
+    if "user_id" in query:
+        await search_postings_collection.delete_many(query)
+        await search_terms_collection.delete_many({"user_id": query["user_id"]})
+        await search_stats_collection.delete_one({"_id": query["user_id"]})
+        return
+    postings = await search_postings_collection.find(query, {"user_id": 1, "len": 1, "terms.term": 1}).to_list()
+    if not postings:
+        return
+    await search_postings_collection.delete_many({"_id": {"$in": [posting["_id"] for posting in postings]}})
+    await _apply_stats(postings, -1)
+
+
+def _encode_offset(offset: int) -> str:
+    raw = json.dumps({"offset": offset}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_offset(token: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        offset = int(json.loads(raw)["offset"])
+    except Exception as e:
+        raise InvalidCursor(f"Cursor không hợp lệ: {token}") from e
+    if offset < 0:
+        raise InvalidCursor(f"Cursor không hợp lệ: {token}")
+    return offset
+
+
+def highlight(text: str, terms: List[str], max_chars: int = SEARCH_SNIPPET_CHARS) -> Optional[str]:
+    """
+    Cắt đoạn quanh lần khớp đầu tiên, bọc các từ khớp (so trên dạng đã bỏ dấu) bằng <mark>
+    """
+    if not text:
+        return None
+    text = unicodedata.normalize("NFC", text)
+    term_set = set(terms)
+    matches = [m for m in iter_words(text) if normalize_text(m.group()) in term_set]
+    if not matches:
+        return None
+    start = max(0, matches[0].start() - max_chars // 4)
+    end = min(len(text), start + max_chars)
+    # Lùi/tiến tới ranh giới từ để không cắt giữa chữ
+    while start > 0 and not text[start - 1].isspace():
+        start -= 1
+    while end < len(text) and not text[end].isspace():
+        end += 1
+
+    parts = ["…" if start > 0 else ""]
+    pos = start
+    for m in matches:
+        if m.start() < start or m.end() > end:
+            continue
+        parts.append(html.escape(text[pos:m.start()]))
+        parts.append(f"<mark>{html.escape(m.group())}</mark>")
+        pos = m.end()
+    parts.append(html.escape(text[pos:end]))
+    parts.append("…" if end < len(text) else "")
+    return "".join(parts)
+
+
+async def search(
+    user_id: str,
+    query: str,
+    limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict[str, Any]] = None,
+    load_turns: Optional[Callable[[List[Any], Optional[Dict[str, Any]]], Awaitable[List[Dict[str, Any]]]]] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str], bool, bool]:
+    """
+    Tìm lượt chat của user theo BM25 trên inverted index; trả về (docs, next_cursor, has_more, truncated).
+    truncated = True khi có term vượt SEARCH_MAX_POSTINGS_PER_TERM (chỉ các lượt mới nhất được chấm điểm).
+    Mỗi doc có thêm "score" và "highlights" ({"question", "answer"}).
+    load_turns(ids, projection) nạp các lượt của trang (mặc định đọc chat_history).
+    """
+    if cursor:
+        offset = _decode_offset(cursor)
+    terms = list(dict.fromkeys(tokenize(query)))[:SEARCH_MAX_QUERY_TERMS]
+    if not terms:
+        return [], None, False, False
+
+    stats = await search_stats_collection.find_one({"_id": user_id}, {"docs": 1, "total_length": 1})
+    if not stats or not stats.get("docs"):
+        return [], None, False, False
+    n_docs = stats["docs"]
+    avg_len = (stats.get("total_length") or 0) / n_docs or 1.0
+    df_cursor = search_terms_collection.find({"_id": {"$in": [_term_id(user_id, t) for t in terms]}}, {"term": 1, "df": 1})
+    df = {doc["term"]: doc.get("df", 0) for doc in await df_cursor.to_list()}
+
+    scores: Dict[Any, float] = defaultdict(float)
+    timestamps: Dict[Any, Any] = {}
+    truncated = False
+    for term in terms:
+        term_df = df.get(term, 0)
+        if term_df <= 0:
+            continue
+        idf = math.log(1 + (n_docs - term_df + 0.5) / (term_df + 0.5))
+        # terms.$ chỉ trả về phần tử khớp của mảng terms; đọc thêm một posting để biết có bị cắt không
+        postings = search_postings_collection.find(
+            {"user_id": user_id, "terms.term": term}, {"terms.$": 1, "len": 1, "timestamp": 1}
+        ).sort("timestamp", -1).limit(SEARCH_MAX_POSTINGS_PER_TERM + 1)
+        read = 0
+        async for posting in postings:
+            read += 1
+            if read > SEARCH_MAX_POSTINGS_PER_TERM:
+                truncated = True
+                break
+            tf = posting["terms"][0]["tf"]
+            norm = SEARCH_BM25_K1 * (1 - SEARCH_BM25_B + SEARCH_BM25_B * posting.get("len", 0) / avg_len)
+            scores[posting["_id"]] += idf * tf * (SEARCH_BM25_K1 + 1) / (tf + norm)
+            timestamps[posting["_id"]] = posting.get("timestamp")
+
+    ranked = sorted(scores, key=lambda tid: (scores[tid], timestamps[tid] or datetime.min), reverse=True)
+    page_ids = ranked[offset:offset + limit]
+    has_more = len(ranked) > offset + limit
+    next_cursor = _encode_offset(offset + limit) if has_more else None
+    if not page_ids:
+        return [], None, False, truncated
+
+    if load_turns is not None:
+        docs = await load_turns(page_ids, projection)
+    else:
+        docs = await chat_history_collection.find({"_id": {"$in": page_ids}}, projection).to_list()
+    by_id = {doc["_id"]: doc for doc in docs}
+    results = []
+    for turn_id in page_ids:
+        doc = by_id.get(turn_id)
+        if doc is None:
+            continue
+        doc["score"] = round(scores[turn_id], 4)
+        doc["highlights"] = {
+            "question": highlight(doc.get("question") or "", terms),
+            "answer": highlight(doc.get("answer") or "", terms),
+        }
+        results.append(doc)
+    return results, next_cursor, has_more, truncated
+
+
+async def reindex(user_id: Optional[str] = None, batch_size: int = 500) -> int:
+    """
+    Dựng lại index từ lịch sử chat theo bố cục đang dùng (toàn bộ hoặc một user), trả về số lượt đã index
+    """
+    query = {"user_id": user_id} if user_id else {"user_id": {"$nin": [None, ""]}}
+    if user_id:
+        await unindex(query)
+    else:
+        await search_postings_collection.delete_many({})
+        await search_terms_collection.delete_many({})
+        await search_stats_collection.delete_many({})
+    total = 0
+    batch: List[Dict[str, Any]] = []
+    fields = {"user_id": 1, "conversation_id": 1, "question": 1, "answer": 1, "timestamp": 1}
+    if chat_buckets.CHAT_HISTORY_BUCKETS:
+        turns = chat_buckets.iter_turns(query, fields)
+    else:
+        turns = chat_history_collection.find(query, fields)
+    async for doc in turns:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            await index_turns(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        await index_turns(batch)
+        total += len(batch)
+    return total
+
+
+async def _main(args: List[str]):
+    try:
+        total = await reindex(args[0] if args else None)
+        print(f"Đã index {total} lượt chat")
+    finally:
+        await close_database()
+
+
+if __name__ == "__main__":
+    # python -m app.services.chat_search [user_id]
+    asyncio.run(_main(sys.argv[1:]))
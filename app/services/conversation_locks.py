@@ -0,0 +1,65 @@
+import os
+import zlib
+import asyncio
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_LOCK_STRIPES = int(os.getenv("CONVERSATION_LOCK_STRIPES", "1024"))
+
+
+class StripedLocks:
+    """
+    Tập asyncio.Lock cố định; mỗi conversation_id được băm vào một stripe
+    nên bộ nhớ không tăng theo số conversation.
+    """
+
+    def __init__(self, stripes: int = CONVERSATION_LOCK_STRIPES):
+        self._locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(stripes)]
+
+    def get(self, key: str) -> asyncio.Lock:
+        return self._locks[zlib.crc32(key.encode("utf-8")) % len(self._locks)]
+
+    def locked_count(self) -> int:
+        return sum(1 for lock in self._locks if lock.locked())
+
+
+class TurnCoalescer:
+    """
+    Gộp các request trùng nhau (cùng key) đang chạy: request đến sau
+    chờ và dùng lại kết quả của request đầu tiên thay vì chạy lại agent.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._started = 0
+        self._coalesced = 0
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is not None:
+            self._coalesced += 1
+            logger.info(f"Gộp request trùng đang xử lý: {key}")
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(factory())
+        self._inflight[key] = task
+        self._started += 1
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: client đầu tiên ngắt kết nối thì các request đang chờ vẫn nhận được kết quả
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inflight": len(self._inflight),
+            "started": self._started,
+            "coalesced": self._coalesced,
+        }
+
+
+def turn_key(conversation_id: str, message: str, user_id: str = None) -> str:
+    normalized = " ".join(message.split()).lower()
+    digest = hashlib.sha1(f"{user_id or ''}\x00{normalized}".encode("utf-8")).hexdigest()
+    return f"{conversation_id}:{digest}"
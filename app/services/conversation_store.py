@@ -0,0 +1,334 @@
+import os
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_STORE_MAX_ENTRIES = int(os.getenv("CONVERSATION_STORE_MAX_ENTRIES", "5000"))
+CONVERSATION_STORE_MAX_BYTES = int(os.getenv("CONVERSATION_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+CONVERSATION_STORE_TTL_SECONDS = float(os.getenv("CONVERSATION_STORE_TTL_SECONDS", str(2 * 60 * 60)))
+CONVERSATION_STORE_BACKEND = os.getenv("CONVERSATION_STORE_BACKEND", "memory")
+# Mongo store: trong khoảng này cache được dùng mà không kiểm tra version. Chỉ đặt > 0 khi có
+# sticky session; mặc định 0 (luôn kiểm tra version, an toàn khi cân bằng tải không sticky)
+CONVERSATION_STORE_FRESH_SECONDS = float(os.getenv("CONVERSATION_STORE_FRESH_SECONDS", "0"))
+
+
+class ConversationStore:
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        pass
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]) -> bool:
+        """
+        Lưu state, trả về False nếu bị từ chối vì xung đột version (worker khác đã ghi trước)
+        """
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+    async def close(self):
+        pass
+
+
+def estimate_state_size(state: Dict[str, Any]) -> int:
+    """
+    Ước lượng số byte mà state của một conversation chiếm (input_items + context)
+    """
+    size = 0
+    try:
+        size += len(json.dumps(state.get("input_items") or [], ensure_ascii=False, default=str).encode("utf-8"))
+    except Exception:
+        size += len(str(state.get("input_items")).encode("utf-8"))
+    ctx = state.get("context")
+    if ctx is not None:
+        dump = getattr(ctx, "model_dump_json", None)
+        size += len(dump().encode("utf-8")) if dump else len(str(ctx).encode("utf-8"))
+    return size
+
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    Store trong tiến trình có giới hạn: số entry tối đa, tổng byte tối đa,
+    TTL theo thời gian không hoạt động và loại bỏ theo LRU.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CONVERSATION_STORE_MAX_ENTRIES,
+        max_bytes: int = CONVERSATION_STORE_MAX_BYTES,
+        ttl_seconds: float = CONVERSATION_STORE_TTL_SECONDS,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # conversation_id -> (state, size, last_access); thứ tự = LRU -> MRU
+        self._conversations: "OrderedDict[str, tuple]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = {"capacity": 0, "bytes": 0, "ttl": 0}
+
+    def _is_expired(self, last_access: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - last_access > self.ttl_seconds
+
+    def _pop(self, conversation_id: str):
+        _, size, _ = self._conversations.pop(conversation_id)
+        self._total_bytes -= size
+
+    def _purge_expired(self, now: float):
+        # Entry ít được dùng nhất nằm đầu OrderedDict nên chỉ cần quét từ đầu
+        while self._conversations:
+            oldest_id, (_, _, last_access) = next(iter(self._conversations.items()))
+            if not self._is_expired(last_access, now):
+                break
+            self._pop(oldest_id)
+            self._evictions["ttl"] += 1
+
+    def _enforce_limits(self, keep_id: str):
+        while len(self._conversations) > self.max_entries:
+            oldest_id = next(iter(self._conversations))
+            if oldest_id == keep_id:
+                break
+            self._pop(oldest_id)
+            self._evictions["capacity"] += 1
+
+        while self._total_bytes > self.max_bytes and len(self._conversations) > 1:
+            oldest_id = next(iter(self._conversations))
+            if oldest_id == keep_id:
+                break
+            self._pop(oldest_id)
+            self._evictions["bytes"] += 1
+
+        if self._total_bytes > self.max_bytes:
+            logger.warning(
+                f"Conversation {keep_id} vượt quá giới hạn bộ nhớ của store ({self._total_bytes} > {self.max_bytes} bytes)"
+            )
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        return self.get_nowait(conversation_id)
+
+    def get_nowait(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            if entry is None:
+                self._misses += 1
+                return None
+            state, size, last_access = entry
+            if self._is_expired(last_access, now):
+                self._pop(conversation_id)
+                self._evictions["ttl"] += 1
+                self._misses += 1
+                return None
+            self._conversations[conversation_id] = (state, size, now)
+            self._conversations.move_to_end(conversation_id)
+            self._hits += 1
+            return state
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]) -> bool:
+        self.save_nowait(conversation_id, state)
+        return True
+
+    def save_nowait(self, conversation_id: str, state: Dict[str, Any]):
+        size = estimate_state_size(state)
+        now = time.monotonic()
+        with self._lock:
+            if conversation_id in self._conversations:
+                self._pop(conversation_id)
+            self._conversations[conversation_id] = (state, size, now)
+            self._total_bytes += size
+            self._purge_expired(now)
+            self._enforce_limits(conversation_id)
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            if conversation_id in self._conversations:
+                self._pop(conversation_id)
+
+    def __contains__(self, conversation_id: str) -> bool:
+        with self._lock:
+            return conversation_id in self._conversations
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._conversations),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits / lookups) if lookups else 0.0,
+                "evictions": dict(self._evictions),
+            }
+
+
+def _to_document(conversation_id: str, state: Dict[str, Any], version: int) -> Dict[str, Any]:
+    """
+    Chuyển state sang document MongoDB (chỉ gồm kiểu dữ liệu JSON)
+    """
+    doc = {}
+    for key, value in state.items():
+        if key == "context":
+            dump = getattr(value, "model_dump", None)
+            doc[key] = dump() if dump else value
+        else:
+            doc[key] = json.loads(json.dumps(value, ensure_ascii=False, default=str))
+    doc["_id"] = conversation_id
+    doc["version"] = version
+    doc["updated_at"] = datetime.utcnow()
+    return doc
+
+
+def _from_document(doc: Dict[str, Any]) -> Dict[str, Any]:
+    from app.agent.formatter_agent import CompanyAgentContext
+
+    state = {k: v for k, v in doc.items() if k not in ("_id", "version", "updated_at")}
+    state["context"] = CompanyAgentContext(**(doc.get("context") or {}))
+    state.setdefault("input_items", [])
+    return state
+
+
+class MongoConversationStore(ConversationStore):
+    """
+    Store dùng chung giữa các worker (không cần sticky session), lưu trong MongoDB.
+    - Đọc qua cache trong tiến trình (read-through): entry còn "tươi" (< fresh_seconds kể từ lần
+      đồng bộ) được dùng ngay, còn lại chỉ đọc trường version để biết worker khác đã cập nhật chưa.
+      Mặc định fresh_seconds = 0: luôn kiểm tra version.
+    - save() ghi ngay và có kiểm tra version (ReplaceOne theo version đã đọc), nên worker khác
+      không bao giờ đọc được state cũ hơn lượt đã trả lời.
+    - Xung đột (worker khác đã ghi trước) được đếm, log, nạp lại state mới nhất vào cache
+      và báo cho caller (save trả về False).
+    """
+
+    def __init__(
+        self,
+        collection,
+        cache: Optional[InMemoryConversationStore] = None,
+        fresh_seconds: float = CONVERSATION_STORE_FRESH_SECONDS,
+    ):
+        self._collection = collection
+        self._cache = cache or InMemoryConversationStore()
+        self.fresh_seconds = fresh_seconds
+        # conversation_id -> (version, synced_at)
+        self._meta: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._db_reads = 0
+        self._version_checks = 0
+        self._writes = 0
+        self._write_errors = 0
+        self._version_conflicts = 0
+
+    def _prune_meta(self):
+        if len(self._meta) > 2 * self._cache.max_entries:
+            for conversation_id in list(self._meta):
+                if conversation_id not in self._cache:
+                    del self._meta[conversation_id]
+
+    async def _load(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        self._db_reads += 1
+        doc = await self._collection.find_one({"_id": conversation_id})
+        if doc is None:
+            return None
+        state = _from_document(doc)
+        self._cache.save_nowait(conversation_id, state)
+        with self._lock:
+            self._meta[conversation_id] = (doc.get("version", 0), time.monotonic())
+        return state
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        state = self._cache.get_nowait(conversation_id)
+        try:
+            if state is None:
+                return await self._load(conversation_id)
+
+            with self._lock:
+                version, synced_at = self._meta.get(conversation_id, (0, 0.0))
+            if time.monotonic() - synced_at < self.fresh_seconds:
+                return state
+
+            self._version_checks += 1
+            doc = await self._collection.find_one({"_id": conversation_id}, {"version": 1})
+            if doc is not None and doc.get("version", 0) != version:
+                return await self._load(conversation_id)
+            with self._lock:
+                self._meta[conversation_id] = (version, time.monotonic())
+            return state
+        except Exception as e:
+            logger.error(f"Lỗi khi đọc conversation state {conversation_id}: {e}")
+            return state
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]) -> bool:
+        """
+        Ghi state với version = version đã đọc + 1. Trả về False nếu worker khác đã ghi trước
+        (state trong cache được thay bằng bản mới nhất từ MongoDB).
+        """
+        from pymongo.errors import DuplicateKeyError
+
+        with self._lock:
+            expected = self._meta.get(conversation_id, (0, 0.0))[0]
+        doc = _to_document(conversation_id, state, expected + 1)
+        try:
+            # Không khớp version đã đọc -> upsert chèn trùng _id -> DuplicateKeyError
+            await self._collection.replace_one({"_id": conversation_id, "version": expected}, doc, upsert=True)
+        except DuplicateKeyError:
+            await self._on_conflict(conversation_id, expected)
+            return False
+        except Exception as e:
+            # Giữ state trong cache để worker này phục vụ tiếp; lần save sau ghi lại với cùng version
+            self._write_errors += 1
+            logger.error(f"Lỗi khi ghi conversation state {conversation_id}: {e}")
+            self._cache.save_nowait(conversation_id, state)
+            return True
+        self._writes += 1
+        self._cache.save_nowait(conversation_id, state)
+        with self._lock:
+            self._meta[conversation_id] = (expected + 1, time.monotonic())
+            self._prune_meta()
+        return True
+
+    async def _on_conflict(self, conversation_id: str, expected: int):
+        self._version_conflicts += 1
+        logger.warning(
+            f"Xung đột version conversation state {conversation_id} (đã đọc version {expected}, "
+            f"worker khác đã ghi trước); nạp lại state mới nhất"
+        )
+        try:
+            if await self._load(conversation_id) is None:
+                self._cache.delete(conversation_id)
+        except Exception as e:
+            logger.error(f"Lỗi khi nạp lại conversation state {conversation_id}: {e}")
+            self._cache.delete(conversation_id)
+            with self._lock:
+                self._meta.pop(conversation_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "mongo",
+            "cache": self._cache.stats(),
+            "fresh_seconds": self.fresh_seconds,
+            "db_reads": self._db_reads,
+            "version_checks": self._version_checks,
+            "writes": self._writes,
+            "write_errors": self._write_errors,
+            "version_conflicts": self._version_conflicts,
+        }
+
+
+def create_conversation_store() -> ConversationStore:
+    """
+    Tạo conversation store theo CONVERSATION_STORE_BACKEND (memory | mongo)
+    """
+    if CONVERSATION_STORE_BACKEND == "mongo":
+        from app.data.database import conversation_state_collection
+
+        return MongoConversationStore(conversation_state_collection)
+    return InMemoryConversationStore()
@@ -0,0 +1,144 @@
+import os
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from app.data.database import chat_history_collection, close_database, db
+from app.data.pagination import fetch_page
+from app.services import chat_buckets
+
+logger = logging.getLogger(__name__)
+
+# Mỗi conversation một document (_id = conversation_id), cập nhật dần theo từng lượt được lưu
+conversations_collection = db["conversations"]
+
+CONVERSATION_TITLE_CHARS = int(os.getenv("CONVERSATION_TITLE_CHARS", "80"))
+
+SUMMARY_FIELDS = {
+    "user_id": 1, "title": 1, "first_message": 1, "last_message": 1,
+    "turn_count": 1, "last_agent": 1, "created_at": 1, "updated_at": 1,
+}
+
+
+def make_title(question: str) -> str:
+    title = " ".join((question or "").split())
+    if len(title) > CONVERSATION_TITLE_CHARS:
+        title = title[:CONVERSATION_TITLE_CHARS].rsplit(" ", 1)[0] + "…"
+    return title
+
+
+def _summary_update(turns: List[Dict[str, Any]]) -> UpdateOne:
+    """
+    Upsert bằng pipeline: trường "đầu tiên" chỉ đặt khi chưa có, trường "cuối cùng" chỉ
+    ghi đè khi lượt mới hơn updated_at hiện tại (replay spool không làm lùi dữ liệu)
+    """
+    first, last = turns[0], turns[-1]
+    is_newer = {"$gt": [last["timestamp"], {"$ifNull": ["$updated_at", datetime.min]}]}
+    is_older = {"$lt": [first["timestamp"], {"$ifNull": ["$created_at", datetime.max]}]}
+    return UpdateOne(
+        {"_id": first["conversation_id"]},
+        [{"$set": {
+            "user_id": {"$ifNull": ["$user_id", {"$literal": first.get("user_id")}]},
+            "title": {"$cond": [is_older, {"$literal": make_title(first.get("question"))}, "$title"]},
+            "first_message": {"$cond": [is_older, {"$literal": first.get("question")}, "$first_message"]},
+            "created_at": {"$cond": [is_older, first["timestamp"], "$created_at"]},
+            "last_message": {"$cond": [is_newer, {"$literal": last.get("answer") or last.get("question")}, "$last_message"]},
+            "last_agent": {"$cond": [is_newer, {"$literal": last.get("agent")}, "$last_agent"]},
+            "updated_at": {"$cond": [is_newer, last["timestamp"], "$updated_at"]},
+            "turn_count": {"$add": [{"$ifNull": ["$turn_count", 0]}, len(turns)]},
+        }}],
+        upsert=True,
+    )
+
+
+async def record_turns(docs: List[Dict[str, Any]]):
+    """
+    Cập nhật summary cho các lượt chat vừa được ghi (chỉ gọi với document mới)
+    """
+    grouped: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for doc in docs:
+        if doc.get("conversation_id") and doc.get("timestamp"):
+            grouped[doc["conversation_id"]].append(doc)
+    if not grouped:
+        return
+    ops = [
+        _summary_update(sorted(turns, key=lambda d: (d["timestamp"], d["_id"])))
+        for turns in grouped.values()
+    ]
+    await conversations_collection.bulk_write(ops, ordered=False)
+
+
+async def list_conversations(
+    user_id: str,
+    limit: int = 20,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str], bool]:
+    """
+    Danh sách conversation của user, mới cập nhật trước (keyset theo updated_at, _id)
+    """
+    return await fetch_page(
+        conversations_collection, {"user_id": user_id}, limit, offset, cursor, SUMMARY_FIELDS, field="updated_at"
+    )
+
+
+async def delete_summaries(query: Dict[str, Any]) -> int:
+    result = await conversations_collection.delete_many(query)
+    return result.deleted_count
+
+
+async def rebuild(batch_size: int = 500) -> int:
+    """
+    Dựng lại collection conversations từ lịch sử chat theo bố cục đang dùng (dữ liệu cũ hoặc sau sự cố).
+    title được tính sau $merge bằng make_title để giống hệt summary ghi theo từng lượt.
+    """
+    match = {"conversation_id": {"$nin": [None, ""]}}
+    stages = [
+        {"$sort": {"conversation_id": 1, "timestamp": 1}},
+        {"$group": {
+            "_id": "$conversation_id",
+            "user_id": {"$first": "$user_id"},
+            "first_message": {"$first": "$question"},
+            "created_at": {"$first": "$timestamp"},
+            "last_question": {"$last": "$question"},
+            "last_answer": {"$last": "$answer"},
+            "last_agent": {"$last": "$agent"},
+            "updated_at": {"$last": "$timestamp"},
+            "turn_count": {"$sum": 1},
+        }},
+        {"$set": {"last_message": {"$ifNull": ["$last_answer", "$last_question"]}}},
+        {"$unset": ["last_question", "last_answer"]},
+        {"$merge": {"into": "conversations", "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+    if chat_buckets.CHAT_HISTORY_BUCKETS:
+        await chat_buckets.aggregate_turns(match, stages, allowDiskUse=True)
+    else:
+        await (await chat_history_collection.aggregate([{"$match": match}, *stages], allowDiskUse=True)).to_list()
+
+    ops: List[UpdateOne] = []
+    cursor = conversations_collection.find({"title": {"$exists": False}}, {"first_message": 1})
+    async for doc in cursor:
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"title": make_title(doc.get("first_message"))}}))
+        if len(ops) >= batch_size:
+            await conversations_collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await conversations_collection.bulk_write(ops, ordered=False)
+    return await conversations_collection.count_documents({})
+
+
+async def _main():
+    try:
+        total = await rebuild()
+        print(f"Đã dựng lại {total} conversation")
+    finally:
+        await close_database()
+
+
+if __name__ == "__main__":
+    # python -m app.services.conversation_summaries
+    asyncio.run(_main())
@@ -0,0 +1,209 @@
+import os
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+from agents import Runner
+from app.agent.summary_agent import history_summary_agent
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+    _encoding_error = None
+except Exception as e:
+    _encoding = None
+    _encoding_error = e
+_fallback_warned = False
+
+SUMMARY_PREFIX = "Tóm tắt các lượt hội thoại trước đó:\n"
+
+# max_tokens: ngưỡng bắt đầu nén; keep_tokens: phần gần nhất giữ nguyên văn sau khi nén;
+# tool_output_tokens: giới hạn cho mỗi output của tool (VD: kết quả FileSearchTool)
+DEFAULT_HISTORY_BUDGET = {
+    "max_tokens": 6000,
+    "keep_tokens": 3000,
+    "tool_output_tokens": 1500,
+}
+
+
+def _load_budgets() -> Dict[str, Dict[str, int]]:
+    """
+    Đọc budget theo agent từ HISTORY_BUDGETS (JSON), VD:
+    {"default": {"max_tokens": 6000}, "Company Info Agent": {"max_tokens": 8000, "keep_tokens": 4000}}
+    """
+    budgets = {"default": dict(DEFAULT_HISTORY_BUDGET)}
+    raw = os.getenv("HISTORY_BUDGETS")
+    if raw:
+        try:
+            for agent_name, budget in json.loads(raw).items():
+                budgets[agent_name] = {**budgets.get("default", DEFAULT_HISTORY_BUDGET), **budget}
+        except Exception as e:
+            logger.error(f"HISTORY_BUDGETS không hợp lệ, dùng budget mặc định: {e}")
+    return budgets
+
+
+HISTORY_BUDGETS = _load_budgets()
+
+
+def get_budget(agent_name: str) -> Dict[str, int]:
+    return HISTORY_BUDGETS.get(agent_name, HISTORY_BUDGETS["default"])
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    global _fallback_warned
+    if not _fallback_warned:
+        _fallback_warned = True
+        logger.warning(f"Không dùng được tiktoken ({_encoding_error}), ước lượng token theo số byte")
+    # Không có tiktoken: ước lượng ~3 byte UTF-8 mỗi token (tiếng Việt có dấu)
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def _item_text(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return " ".join(_item_text(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return " ".join(_item_text(v) for v in value)
+    return ""
+
+
+def count_item_tokens(item: Dict[str, Any]) -> int:
+    # Cộng thêm vài token cho phần khung của mỗi item (role, type, ...)
+    return count_tokens(_item_text(item)) + 4
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens]) + " …[đã rút gọn]"
+    return text.encode("utf-8")[: max_tokens * 3].decode("utf-8", errors="ignore") + " …[đã rút gọn]"
+
+
+def cap_tool_outputs(items: List[Dict[str, Any]], max_tokens: int) -> List[Dict[str, Any]]:
+    """
+    Giới hạn kích thước output của tool trong lịch sử (function_call_output, file_search_call)
+    """
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        item_type = item.get("type")
+        if item_type == "function_call_output" and isinstance(item.get("output"), str):
+            item["output"] = _truncate(item["output"], max_tokens)
+        elif item_type == "file_search_call" and item.get("results"):
+            per_result = max(max_tokens // len(item["results"]), 1)
+            for res in item["results"]:
+                if isinstance(res, dict) and isinstance(res.get("text"), str):
+                    res["text"] = _truncate(res["text"], per_result)
+    return items
+
+
+def _is_user_message(item: Dict[str, Any]) -> bool:
+    return isinstance(item, dict) and item.get("role") == "user" and item.get("type", "message") == "message"
+
+
+def _find_window_start(items: List[Dict[str, Any]], keep_tokens: int) -> int:
+    """
+    Tìm vị trí bắt đầu của cửa sổ giữ nguyên văn: luôn bắt đầu ở một tin nhắn user
+    để không tách tool call khỏi output của nó.
+    """
+    used = 0
+    start = len(items)
+    for idx in range(len(items) - 1, -1, -1):
+        used += count_item_tokens(items[idx])
+        if used > keep_tokens:
+            break
+        start = idx
+    for idx in range(start, len(items)):
+        if _is_user_message(items[idx]):
+            return idx
+    # Lượt cuối đã vượt keep_tokens: giữ từ tin nhắn user gần nhất
+    for idx in range(len(items) - 1, -1, -1):
+        if _is_user_message(items[idx]):
+            return idx
+    return 0
+
+
+def _transcript(items: List[Dict[str, Any]]) -> str:
+    lines = []
+    for item in items:
+        role = item.get("role") if isinstance(item, dict) else None
+        if role in ("user", "assistant"):
+            text = _item_text(item.get("content", "")).strip()
+            if text:
+                lines.append(f"{role}: {text}")
+    return "\n".join(lines)
+
+
+async def _summarize(previous_summary: Optional[str], items: List[Dict[str, Any]], context: Any) -> Optional[str]:
+    transcript = _transcript(items)
+    if not transcript:
+        return previous_summary
+    prompt = (
+        f"Bản tóm tắt trước đó:\n{previous_summary or '(chưa có)'}\n\n"
+        f"Các lượt hội thoại cần gộp vào:\n{transcript}"
+    )
+    result = await Runner.run(history_summary_agent, prompt, context=context)
+    return str(result.final_output).strip()
+
+
+async def compact_history(state: Dict[str, Any], agent_name: str) -> bool:
+    """
+    Nén state["input_items"] theo budget của agent trước khi gọi Runner.run.
+    Các lượt cũ được gộp vào state["history_summary"]; trả về True nếu đã nén.
+    """
+    budget = get_budget(agent_name)
+    items = cap_tool_outputs(state.get("input_items") or [], budget["tool_output_tokens"])
+    summary = state.get("history_summary")
+
+    total = count_tokens(summary or "") + sum(count_item_tokens(item) for item in items)
+    if total <= budget["max_tokens"]:
+        return False
+
+    start = _find_window_start(items, budget["keep_tokens"])
+    if start <= 0:
+        return False
+
+    try:
+        summary = await _summarize(summary, items[:start], state.get("context"))
+    except Exception as e:
+        # Không tóm tắt được thì vẫn cắt bớt lịch sử, giữ tóm tắt cũ
+        logger.error(f"Lỗi khi tóm tắt lịch sử hội thoại: {e}")
+
+    state["input_items"] = items[start:]
+    state["history_summary"] = summary
+    logger.info(f"Nén lịch sử cho {agent_name}: {total} tokens, bỏ {start} items")
+    return True
+
+
+def build_run_input(state: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Input gửi cho Runner: bản tóm tắt (nếu có) + cửa sổ lịch sử gần nhất
+    """
+    summary = state.get("history_summary")
+    if not summary:
+        return state["input_items"]
+    return [{"role": "developer", "content": SUMMARY_PREFIX + summary}] + state["input_items"]
+
+
+def strip_summary(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Bỏ item tóm tắt khỏi result.to_input_list() trước khi lưu lại vào state
+    """
+    return [
+        item for item in items
+        if not (
+            isinstance(item, dict)
+            and item.get("role") == "developer"
+            and isinstance(item.get("content"), str)
+            and item["content"].startswith(SUMMARY_PREFIX)
+        )
+    ]
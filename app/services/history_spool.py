@@ -0,0 +1,221 @@
+import os
+import glob
+import time
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from bson import json_util
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SPOOL_ENABLED = os.getenv("HISTORY_SPOOL_ENABLED", "true").lower() == "true"
+HISTORY_SPOOL_DIR = os.getenv("HISTORY_SPOOL_DIR", "spool")
+HISTORY_SPOOL_SEGMENT_BYTES = int(os.getenv("HISTORY_SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+HISTORY_SPOOL_FSYNC_INTERVAL = float(os.getenv("HISTORY_SPOOL_FSYNC_INTERVAL", "0.05"))
+# Segment đang ghi được niêm phong sau khoảng thời gian này để replayer xử lý
+HISTORY_SPOOL_SEAL_SECONDS = float(os.getenv("HISTORY_SPOOL_SEAL_SECONDS", "30"))
+
+OPEN_SUFFIX = ".open"
+SEALED_SUFFIX = ".jsonl"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _segment_in_use(path: str) -> bool:
+    """
+    Segment .open còn được tiến trình khác giữ hay không: tiến trình ghi giữ flock suốt vòng đời
+    segment, lock tự nhả khi tiến trình chết. Không dựa vào PID vì sau khi container khởi động lại,
+    tiến trình mới thường có cùng PID (VD: 1) với tiến trình đã crash.
+    """
+    if fcntl is None:
+        try:
+            pid = int(os.path.basename(path).split("-")[2])
+        except (IndexError, ValueError):
+            return True
+        return pid != os.getpid() and _pid_alive(pid)
+    try:
+        with open(path, "rb") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    except BlockingIOError:
+        return True
+    except FileNotFoundError:
+        # Vừa được niêm phong (.open -> .jsonl), sẽ được đọc ở lượt sau
+        return True
+    return False
+
+
+class HistorySpool:
+    """
+    Spool ghi trước (write-ahead) dạng JSONL, mỗi dòng một record {"id", "c", "d"}
+    hoặc một dấu commit {"commit": [id, ...]} sau khi đã ghi vào MongoDB thành công.
+    - append() ghi vào page cache ngay trong request, fsync được gom theo lô bởi fsync_if_dirty().
+    - Segment được niêm phong (đổi .open -> .jsonl) khi đủ lớn hoặc đủ lâu;
+      replayer đọc segment đã niêm phong, ghi lại các record chưa commit rồi xoá segment.
+    """
+
+    def __init__(self, directory: str = HISTORY_SPOOL_DIR, segment_bytes: int = HISTORY_SPOOL_SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._path: Optional[str] = None
+        self._opened_at = 0.0
+        self._size = 0
+        self._records = 0
+        self._dirty = False
+        self._seq = 0
+        self.appended = 0
+        self.fsyncs = 0
+        self.replayed = 0
+        self.replay_errors = 0
+
+    def _open_segment(self):
+        self._seq += 1
+        name = f"spool-{int(time.time() * 1000)}-{os.getpid()}-{self._seq}{OPEN_SUFFIX}"
+        self._path = os.path.join(self.directory, name)
+        if fcntl is None:
+            self._file = open(self._path, "ab")
+        else:
+            # Lấy flock trên tên tạm rồi mới đổi sang .open, để replayer không bao giờ thấy segment chưa khoá
+            staging = self._path + ".new"
+            self._file = open(staging, "ab")
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.replace(staging, self._path)
+        self._opened_at = time.monotonic()
+        self._size = 0
+        self._records = 0
+
+    def _seal_locked(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._path, self._path[: -len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        self._file = None
+        self._path = None
+        self._dirty = False
+
+    def _write_line(self, payload: Dict[str, Any]):
+        if self._file is None:
+            self._open_segment()
+        line = (json_util.dumps(payload) + "\n").encode("utf-8")
+        self._file.write(line)
+        self._file.flush()
+        self._size += len(line)
+        self._dirty = True
+
+    def append(self, record_id: str, collection_name: str, doc: Dict[str, Any]):
+        with self._lock:
+            self._write_line({"id": record_id, "c": collection_name, "d": doc})
+            self._records += 1
+            self.appended += 1
+            if self._size >= self.segment_bytes:
+                self._seal_locked()
+
+    def commit(self, record_ids: Iterable[str]):
+        record_ids = list(record_ids)
+        if not record_ids:
+            return
+        with self._lock:
+            self._write_line({"commit": record_ids})
+
+    def fsync_if_dirty(self):
+        """
+        Gom fsync: gọi định kỳ từ task nền thay vì fsync sau mỗi record
+        """
+        with self._lock:
+            if self._file is not None and self._dirty:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+                self.fsyncs += 1
+
+    def seal_if_stale(self, max_age: float = HISTORY_SPOOL_SEAL_SECONDS):
+        with self._lock:
+            if self._file is not None and time.monotonic() - self._opened_at >= max_age:
+                self._seal_locked()
+
+    def close(self):
+        with self._lock:
+            self._seal_locked()
+
+    def _sealed_segments(self) -> List[str]:
+        paths = sorted(glob.glob(os.path.join(self.directory, f"*{SEALED_SUFFIX}")))
+        # Segment .open của tiến trình đã chết (crash) cũng cần replay
+        for path in sorted(glob.glob(os.path.join(self.directory, f"*{OPEN_SUFFIX}"))):
+            if path == self._path:
+                continue
+            if not _segment_in_use(path):
+                paths.append(path)
+        return paths
+
+    @staticmethod
+    def _pending_records(path: str) -> List[Tuple[str, str, Dict[str, Any]]]:
+        records: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        committed = set()
+        with open(path, "rb") as f:
+            for raw in f:
+                try:
+                    payload = json_util.loads(raw.decode("utf-8"))
+                except Exception:
+                    # Dòng cuối bị ghi dở khi crash
+                    continue
+                if "commit" in payload:
+                    committed.update(payload["commit"])
+                else:
+                    records[payload["id"]] = (payload["c"], payload["d"])
+        return [(rid, coll, doc) for rid, (coll, doc) in records.items() if rid not in committed]
+
+    def pending_segments(self) -> List[Tuple[str, List[Tuple[str, str, Dict[str, Any]]]]]:
+        segments = []
+        for path in self._sealed_segments():
+            try:
+                segments.append((path, self._pending_records(path)))
+            except FileNotFoundError:
+                # Worker khác đã replay và xoá
+                continue
+        return segments
+
+    def remove_segment(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "active_records": self._records,
+            "active_bytes": self._size,
+            "sealed_segments": len(glob.glob(os.path.join(self.directory, f"*{SEALED_SUFFIX}"))),
+            "appended": self.appended,
+            "fsyncs": self.fsyncs,
+            "replayed": self.replayed,
+            "replay_errors": self.replay_errors,
+        }
+
+
+def create_history_spool() -> Optional[HistorySpool]:
+    if not HISTORY_SPOOL_ENABLED:
+        return None
+    try:
+        return HistorySpool()
+    except Exception as e:
+        logger.error(f"Không tạo được spool {HISTORY_SPOOL_DIR}, tắt spool: {e}")
+        return None
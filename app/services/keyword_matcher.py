@@ -0,0 +1,60 @@
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+
+class KeywordMatcher:
+    """
+    Automaton Aho-Corasick: tìm mọi từ khoá trong văn bản với một lần quét.
+    Chỉ nhận các match đứng trọn ở ranh giới từ (không khớp "phí" trong "phía").
+    """
+
+    def __init__(self, keywords: Iterable[Tuple[str, str]]):
+        # keywords: (từ khoá, nhãn)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[str, str]]] = [[]]
+        for keyword, label in keywords:
+            self._add(keyword, label)
+        self._build()
+
+    def _add(self, keyword: str, label: str):
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((keyword, label))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0) if self._goto[fail].get(ch, 0) != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> List[Tuple[str, str, int]]:
+        """
+        Trả về danh sách (từ khoá, nhãn, vị trí bắt đầu)
+        """
+        matches = []
+        node = 0
+        for idx, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for keyword, label in self._out[node]:
+                start = idx - len(keyword) + 1
+                end = idx + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                    matches.append((keyword, label, start))
+        return matches
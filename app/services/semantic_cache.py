@@ -0,0 +1,190 @@
+import os
+import math
+import time
+import zlib
+import hashlib
+import threading
+import logging
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.services.text_normalize import tokenize
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+# Tăng giá trị này khi nội dung vector store thay đổi mà không đổi vector_store_id
+SEMANTIC_CACHE_VERSION = os.getenv("SEMANTIC_CACHE_VERSION", "1")
+
+FEATURE_DIMS = 1 << 20
+
+
+def _features(text: str) -> Dict[int, int]:
+    """
+    Đếm feature băm: âm tiết đã bỏ dấu + bigram âm tiết
+    """
+    tokens = tokenize(text)
+    grams = tokens + [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+    counts: Dict[int, int] = defaultdict(int)
+    for gram in grams:
+        counts[zlib.crc32(gram.encode("utf-8")) % FEATURE_DIMS] += 1
+    return dict(counts)
+
+
+def _weights(features: Dict[int, int]) -> Dict[int, float]:
+    """
+    Vector đã chuẩn hoá L2 với TF tuyến tính-log (1 + log tf), không dùng IDF để vector
+    của một entry không đổi theo thời gian và chỉ cần tính một lần khi store()
+    """
+    weights = {f: 1.0 + math.log(tf) for f, tf in features.items()}
+    norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+    return {f: w / norm for f, w in weights.items()}
+
+
+@dataclass
+class CacheEntry:
+    question: str
+    answer: str
+    agent: str
+    weights: Dict[int, float]
+    expires_at: float
+    hits: int = 0
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+
+class SemanticAnswerCache:
+    """
+    Cache câu trả lời theo độ tương đồng: vector TF băm (đã chuẩn hoá sẵn) trên văn bản tiếng Việt
+    đã bỏ dấu, so khớp cosine bằng tích vô hướng qua inverted index, có TTL, LRU và phiên bản (đổi phiên bản = xoá cache)
+    """
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl_seconds: float = SEMANTIC_CACHE_TTL_SECONDS,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.version: Optional[str] = None
+        self._entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self._postings: Dict[int, Set[int]] = defaultdict(set)
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+    def set_version(self, version: str):
+        with self._lock:
+            if self.version is not None and self.version != version:
+                logger.info(f"Semantic cache đổi phiên bản {self.version} -> {version}, xoá cache")
+                self._clear()
+                self.invalidations += 1
+            self.version = version
+
+    def _clear(self):
+        self._entries.clear()
+        self._postings.clear()
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        for f in entry.weights:
+            postings = self._postings.get(f)
+            if postings is not None:
+                postings.discard(entry_id)
+                if not postings:
+                    del self._postings[f]
+
+    def lookup(self, question: str) -> Optional[Tuple[CacheEntry, float]]:
+        features = _features(question)
+        if not features:
+            return None
+        query = _weights(features)
+        now = time.monotonic()
+        with self._lock:
+            # Cộng dồn tích vô hướng theo từng feature chung với các entry ứng viên
+            scores: Dict[int, float] = defaultdict(float)
+            for f, w in query.items():
+                for entry_id in self._postings.get(f, ()):
+                    scores[entry_id] += w * self._entries[entry_id].weights[f]
+
+            best: Optional[Tuple[int, float]] = None
+            for entry_id, score in scores.items():
+                if now >= self._entries[entry_id].expires_at:
+                    self._remove(entry_id)
+                    continue
+                if best is None or score > best[1]:
+                    best = (entry_id, score)
+
+            if best is None or best[1] < self.threshold:
+                self.misses += 1
+                return None
+            entry = self._entries[best[0]]
+            entry.hits += 1
+            self._entries.move_to_end(best[0])
+            self.hits += 1
+            return entry, best[1]
+
+    def store(self, question: str, answer: str, agent: str, metadata: Optional[Dict[str, Any]] = None):
+        features = _features(question)
+        if not features or not answer:
+            return
+        weights = _weights(features)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = CacheEntry(
+                question=question,
+                answer=answer,
+                agent=agent,
+                weights=weights,
+                expires_at=time.monotonic() + self.ttl_seconds,
+                metadata=metadata or {},
+            )
+            for f in weights:
+                self._postings[f].add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            self.stores += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": SEMANTIC_CACHE_ENABLED,
+            "version": self.version,
+            "entries": len(self._entries),
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "stores": self.stores,
+            "invalidations": self.invalidations,
+        }
+
+
+def agent_cache_version(agent) -> str:
+    """
+    Phiên bản cache của một agent: đổi model, instructions hoặc vector store là đổi phiên bản
+    """
+    vector_store_ids: List[str] = []
+    for tool in getattr(agent, "tools", []):
+        vector_store_ids.extend(getattr(tool, "vector_store_ids", []) or [])
+    raw = "\x00".join([
+        SEMANTIC_CACHE_VERSION,
+        str(getattr(agent, "model", "")),
+        str(getattr(agent, "instructions", "")),
+        ",".join(sorted(vector_store_ids)),
+    ])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,49 @@
+import re
+import unicodedata
+from typing import Iterator, List
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def fold_char(ch: str) -> str:
+    """
+    Bỏ dấu một ký tự tiếng Việt (giữ nguyên độ dài 1 ký tự để ánh xạ vị trí)
+    """
+    if ch in ("đ", "Đ"):
+        return "d" if ch == "đ" else "D"
+    decomposed = unicodedata.normalize("NFD", ch)
+    return decomposed[0] if decomposed else ch
+
+
+def fold_diacritics(text: str) -> str:
+    """
+    Bỏ dấu tiếng Việt: "Chuyển đổi số" -> "Chuyen doi so"
+    """
+    return "".join(fold_char(ch) for ch in unicodedata.normalize("NFC", text))
+
+
+def normalize_text(text: str) -> str:
+    """
+    Chuẩn hoá để so khớp: chữ thường, bỏ dấu, bỏ dấu câu, gộp khoảng trắng
+    """
+    folded = fold_diacritics(text.lower())
+    return " ".join(_WORD_RE.findall(folded))
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Tách âm tiết (tiếng Việt viết cách nhau bằng khoảng trắng) sau khi chuẩn hoá
+    """
+    return normalize_text(text).split()
+
+
+def iter_words(text: str) -> Iterator["re.Match"]:
+    """
+    Duyệt các từ trên văn bản gốc (giữ vị trí ký tự, dùng để highlight)
+    """
+    return _WORD_RE.finditer(text)
+
+
+def collapse_whitespace(text: str) -> str:
+    return _SPACE_RE.sub(" ", text).strip()
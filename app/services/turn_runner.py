@@ -0,0 +1,150 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import suppress
+from typing import Any, Deque, Dict, List, Optional
+
+from agents import InputGuardrailTripwireTriggered, RunContextWrapper, Runner
+
+logger = logging.getLogger(__name__)
+
+# Chạy agent song song với input guardrail, chỉ trả kết quả khi guardrail đạt (opt-in)
+SPECULATIVE_GUARDRAILS = os.getenv("SPECULATIVE_GUARDRAILS", "false").lower() == "true"
+TURN_METRICS_WINDOW = int(os.getenv("TURN_METRICS_WINDOW", "1000"))
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[idx]
+
+
+class TurnMetrics:
+    """
+    Độ trễ mỗi lượt chat (cửa sổ N mẫu gần nhất) theo chế độ chạy, kèm token bị lãng phí
+    khi chạy speculative mà guardrail chặn
+    """
+
+    def __init__(self, window: int = TURN_METRICS_WINDOW):
+        self._samples: Dict[str, Deque[Dict[str, float]]] = {}
+        self._window = window
+        self._lock = threading.Lock()
+        self.tripwires = 0
+        self.cancelled_runs = 0
+        self.wasted_input_tokens = 0
+        self.wasted_output_tokens = 0
+
+    def record(self, mode: str, total_ms: float, guardrail_ms: Optional[float] = None):
+        with self._lock:
+            samples = self._samples.setdefault(mode, deque(maxlen=self._window))
+            samples.append({"total_ms": total_ms, "guardrail_ms": guardrail_ms or 0.0})
+
+    def record_waste(self, result: Any = None):
+        with self._lock:
+            if result is None:
+                self.cancelled_runs += 1
+                return
+            usage = getattr(getattr(result, "context_wrapper", None), "usage", None)
+            self.wasted_input_tokens += getattr(usage, "input_tokens", 0) or 0
+            self.wasted_output_tokens += getattr(usage, "output_tokens", 0) or 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            modes = {}
+            for mode, samples in self._samples.items():
+                totals = [s["total_ms"] for s in samples]
+                guards = [s["guardrail_ms"] for s in samples]
+                modes[mode] = {
+                    "count": len(totals),
+                    "p50_ms": _percentile(totals, 0.5),
+                    "p95_ms": _percentile(totals, 0.95),
+                    "guardrail_p50_ms": _percentile(guards, 0.5),
+                    "guardrail_p95_ms": _percentile(guards, 0.95),
+                }
+            return {
+                "speculative_enabled": SPECULATIVE_GUARDRAILS,
+                "modes": modes,
+                "tripwires": self.tripwires,
+                "cancelled_runs": self.cancelled_runs,
+                "wasted_input_tokens": self.wasted_input_tokens,
+                "wasted_output_tokens": self.wasted_output_tokens,
+            }
+
+
+turn_metrics = TurnMetrics()
+
+
+async def run_input_guardrails(agent, input, context: Any) -> float:
+    """
+    Chạy song song các input guardrail của agent; guardrail đầu tiên bị kích hoạt
+    sẽ huỷ các guardrail còn lại và ném InputGuardrailTripwireTriggered như Runner.
+    Trả về thời gian chạy (ms).
+    """
+    started = time.perf_counter()
+    wrapper = RunContextWrapper(context=context)
+    tasks = [asyncio.ensure_future(g.run(agent, input, wrapper)) for g in agent.input_guardrails]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            guardrail_result = await next_done
+            if guardrail_result.output.tripwire_triggered:
+                raise InputGuardrailTripwireTriggered(guardrail_result)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return (time.perf_counter() - started) * 1000
+
+
+def _copy_context(source: Any, target: Any):
+    for key, value in source.model_dump().items():
+        setattr(target, key, value)
+
+
+async def _run_speculative(agent, input, context: Any):
+    # Agent chạy trên bản sao context: nếu guardrail chặn thì context thật không bị thay đổi
+    speculative_context = context.model_copy(deep=True)
+    run_task = asyncio.ensure_future(
+        Runner.run(agent.clone(input_guardrails=[]), input, context=speculative_context)
+    )
+    try:
+        guardrail_ms = await run_input_guardrails(agent, input, context)
+    except BaseException:
+        if run_task.done() and not run_task.cancelled() and run_task.exception() is None:
+            turn_metrics.record_waste(run_task.result())
+        else:
+            run_task.cancel()
+            with suppress(BaseException):
+                await run_task
+            turn_metrics.record_waste()
+        raise
+    result = await run_task
+    _copy_context(speculative_context, context)
+    return result, guardrail_ms
+
+
+async def run_agent_turn(agent, input, context: Any, metadata: Optional[Dict[str, Any]] = None):
+    """
+    Chạy một lượt agent (Runner.run hoặc speculative), ghi nhận độ trễ vào turn_metrics
+    """
+    speculative = SPECULATIVE_GUARDRAILS and bool(getattr(agent, "input_guardrails", None))
+    mode = "speculative" if speculative else "standard"
+    started = time.perf_counter()
+    guardrail_ms = None
+    try:
+        if speculative:
+            result, guardrail_ms = await _run_speculative(agent, input, context)
+        else:
+            result = await Runner.run(agent, input, context=context)
+    except InputGuardrailTripwireTriggered:
+        turn_metrics.tripwires += 1
+        raise
+    total_ms = (time.perf_counter() - started) * 1000
+    turn_metrics.record(mode, total_ms, guardrail_ms)
+    if metadata is not None:
+        metadata["latency_ms"] = round(total_ms, 1)
+        metadata["speculative"] = speculative
+    return result
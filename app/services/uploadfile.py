@@ -47,7 +47,7 @@ def upload_image_to_s3(file: UploadFile, folder: str = "technical_errors") -> st
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi upload ảnh: {str(e)}")
 
-def save_technical_error_to_db(
+async def save_technical_error_to_db(
     user_id: str,
     full_name: str,
     organization: str = None,
@@ -72,7 +72,7 @@ def save_technical_error_to_db(
             "status": "pending"
         }
         
-        result = technical_errors_collection.insert_one(error_data)
+        result = await technical_errors_collection.insert_one(error_data)
         error_data["_id"] = result.inserted_id
         
         return error_data
@@ -80,7 +80,7 @@ def save_technical_error_to_db(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi lưu lỗi kỹ thuật: {str(e)}")
 
-def get_technical_errors_by_user_id(user_id: str) -> list:
+async def get_technical_errors_by_user_id(user_id: str) -> list:
     """Get technical errors for a specific user"""
     try:
         technical_errors_collection = db["technical_errors"]
@@ -89,7 +89,7 @@ def get_technical_errors_by_user_id(user_id: str) -> list:
             {"user_id": user_id}
         ).sort("timestamp", -1)
         
-        errors = list(cursor)
+        errors = await cursor.to_list()
         
         # Convert ObjectId to string for JSON serialization
         for error in errors:
@@ -100,7 +100,7 @@ def get_technical_errors_by_user_id(user_id: str) -> list:
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi lấy lỗi kỹ thuật: {str(e)}")
 
-def update_technical_error_status(error_id: str, status: str, notes: str = None) -> dict:
+async def update_technical_error_status(error_id: str, status: str, notes: str = None) -> dict:
     """Update technical error status"""
     try:
         from bson import ObjectId
@@ -111,7 +111,7 @@ def update_technical_error_status(error_id: str, status: str, notes: str = None)
             update_data["notes"] = notes
         update_data["updated_at"] = datetime.utcnow()
         
-        result = technical_errors_collection.update_one(
+        result = await technical_errors_collection.update_one(
             {"_id": ObjectId(error_id)},
             {"$set": update_data}
         )
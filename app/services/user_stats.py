@@ -0,0 +1,202 @@
+import os
+import sys
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+
+from app.data.database import chat_history_collection, close_database, db
+from app.services import chat_buckets
+
+logger = logging.getLogger(__name__)
+
+# Mỗi (user, ngày UTC) một document: số tin nhắn, số tin theo agent, các conversation trong ngày.
+# _id = "<user_id>:<YYYY-MM-DD>", cập nhật bằng $inc/$addToSet khi lượt chat được ghi
+daily_stats_collection = db["user_daily_stats"]
+
+USER_STATS_ROLLUP = os.getenv("USER_STATS_ROLLUP", "true").lower() == "true"
+TOP_AGENTS_LIMIT = 5
+
+DAY_FORMAT = "%Y-%m-%d"
+
+
+def _day(timestamp: datetime) -> str:
+    return timestamp.strftime(DAY_FORMAT)
+
+
+def _agent_key(agent: Optional[str]) -> str:
+    # Tên agent dùng làm tên trường (agents.<agent>), không được chứa dấu chấm
+    return (agent or "unknown").replace(".", "_")
+
+
+def _group_by_day(docs: List[Dict[str, Any]]) -> Dict[tuple, Dict[str, Any]]:
+    grouped: Dict[tuple, Dict[str, Any]] = defaultdict(lambda: {"messages": 0, "agents": Counter(), "conversations": set()})
+    for doc in docs:
+        if not doc.get("user_id") or not doc.get("timestamp"):
+            continue
+        day = grouped[(doc["user_id"], _day(doc["timestamp"]))]
+        day["messages"] += 1
+        day["agents"][_agent_key(doc.get("agent"))] += 1
+        if doc.get("conversation_id"):
+            day["conversations"].add(doc["conversation_id"])
+    return grouped
+
+
+async def record_turns(docs: List[Dict[str, Any]]):
+    """
+    Cộng dồn thống kê ngày cho các lượt chat vừa được ghi (chỉ gọi với document mới)
+    """
+    ops = []
+    for (user_id, day), totals in _group_by_day(docs).items():
+        inc = {"messages": totals["messages"]}
+        inc.update({f"agents.{agent}": count for agent, count in totals["agents"].items()})
+        update = {"$inc": inc, "$setOnInsert": {"user_id": user_id, "day": day}}
+        if totals["conversations"]:
+            update["$addToSet"] = {"conversations": {"$each": sorted(totals["conversations"])}}
+        ops.append(UpdateOne({"_id": f"{user_id}:{day}"}, update, upsert=True))
+    if ops:
+        await daily_stats_collection.bulk_write(ops, ordered=False)
+
+
+async def forget_conversation(conversation_id: str, docs: List[Dict[str, Any]]):
+    """
+    Trừ các lượt của một conversation sắp bị xoá khỏi thống kê ngày
+    """
+    ops = []
+    for (user_id, day), totals in _group_by_day(docs).items():
+        inc = {"messages": -totals["messages"]}
+        inc.update({f"agents.{agent}": -count for agent, count in totals["agents"].items()})
+        ops.append(UpdateOne(
+            {"_id": f"{user_id}:{day}"},
+            {"$inc": inc, "$pull": {"conversations": conversation_id}},
+        ))
+    if ops:
+        await daily_stats_collection.bulk_write(ops, ordered=False)
+
+
+async def delete_user_stats(user_id: str) -> int:
+    result = await daily_stats_collection.delete_many({"user_id": user_id})
+    return result.deleted_count
+
+
+async def get_statistics(user_id: str, days: int) -> Optional[Dict[str, Any]]:
+    """
+    Thống kê N ngày gần đây từ các document ngày (đọc O(days) document).
+    Trả về None khi user chưa có rollup trong khoảng này (dữ liệu trước khi bật rollup).
+    """
+    start_day = _day(datetime.utcnow() - timedelta(days=days))
+    cursor = daily_stats_collection.find(
+        {"user_id": user_id, "day": {"$gte": start_day}},
+        {"day": 1, "messages": 1, "agents": 1, "conversations": 1},
+    ).sort("day", 1)
+    rollups = await cursor.to_list()
+    if not rollups:
+        return None
+
+    agents: Counter = Counter()
+    conversations = set()
+    daily_stats = []
+    for rollup in rollups:
+        if rollup.get("messages", 0) <= 0:
+            continue
+        daily_stats.append({"_id": rollup["day"], "count": rollup["messages"]})
+        agents.update({agent: count for agent, count in (rollup.get("agents") or {}).items() if count > 0})
+        conversations.update(rollup.get("conversations") or [])
+    return {
+        "total_messages": sum(day["count"] for day in daily_stats),
+        "total_conversations": len(conversations),
+        "top_agents": [{"_id": agent, "count": count} for agent, count in agents.most_common(TOP_AGENTS_LIMIT)],
+        "daily_stats": daily_stats,
+        "period_days": days,
+    }
+
+
+def facet_stages() -> List[Dict[str, Any]]:
+    """
+    Một lần aggregate (sau $match theo user và thời gian) tính đủ các thống kê bằng $facet
+    """
+    return [{"$facet": {
+        "totals": [
+            {"$group": {"_id": None, "messages": {"$sum": 1}, "conversations": {"$addToSet": "$conversation_id"}}},
+            {"$project": {"messages": 1, "conversations": {"$size": "$conversations"}}},
+        ],
+        "top_agents": [
+            {"$group": {"_id": "$agent", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            {"$limit": TOP_AGENTS_LIMIT},
+        ],
+        "daily_stats": [
+            {"$group": {"_id": {"$dateToString": {"format": DAY_FORMAT, "date": "$timestamp"}}, "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}},
+        ],
+    }}]
+
+
+def from_facet(result: List[Dict[str, Any]], days: int) -> Dict[str, Any]:
+    facet = result[0] if result else {}
+    totals = (facet.get("totals") or [{}])[0]
+    return {
+        "total_messages": totals.get("messages", 0),
+        "total_conversations": totals.get("conversations", 0),
+        "top_agents": facet.get("top_agents", []),
+        "daily_stats": facet.get("daily_stats", []),
+        "period_days": days,
+    }
+
+
+async def rebuild(user_id: Optional[str] = None) -> int:
+    """
+    Dựng lại user_daily_stats từ lịch sử chat (toàn bộ hoặc một user), trả về số document ngày
+    """
+    query = {"user_id": user_id} if user_id else {"user_id": {"$nin": [None, ""]}}
+    await daily_stats_collection.delete_many({"user_id": user_id} if user_id else {})
+    stages = [
+        {"$group": {
+            "_id": {
+                "user_id": "$user_id",
+                "day": {"$dateToString": {"format": DAY_FORMAT, "date": "$timestamp"}},
+                "agent": {"$replaceAll": {"input": {"$ifNull": ["$agent", "unknown"]}, "find": ".", "replacement": "_"}},
+            },
+            "count": {"$sum": 1},
+            "conversations": {"$addToSet": "$conversation_id"},
+        }},
+        {"$group": {
+            "_id": {"user_id": "$_id.user_id", "day": "$_id.day"},
+            "messages": {"$sum": "$count"},
+            "agents": {"$push": {"k": "$_id.agent", "v": "$count"}},
+            "conversations": {"$push": "$conversations"},
+        }},
+        {"$project": {
+            "_id": {"$concat": ["$_id.user_id", ":", "$_id.day"]},
+            "user_id": "$_id.user_id",
+            "day": "$_id.day",
+            "messages": 1,
+            "agents": {"$arrayToObject": "$agents"},
+            "conversations": {"$setDifference": [
+                {"$reduce": {"input": "$conversations", "initialValue": [], "in": {"$setUnion": ["$$value", "$$this"]}}},
+                [None],
+            ]},
+        }},
+        {"$merge": {"into": "user_daily_stats", "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+    if chat_buckets.CHAT_HISTORY_BUCKETS:
+        await chat_buckets.aggregate_turns(query, stages, allowDiskUse=True)
+    else:
+        await (await chat_history_collection.aggregate([{"$match": query}, *stages], allowDiskUse=True)).to_list()
+    return await daily_stats_collection.count_documents({"user_id": user_id} if user_id else {})
+
+
+async def _main(args: List[str]):
+    try:
+        total = await rebuild(args[0] if args else None)
+        print(f"Đã dựng lại {total} document thống kê ngày")
+    finally:
+        await close_database()
+
+
+if __name__ == "__main__":
+    # python -m app.services.user_stats [user_id]
+    asyncio.run(_main(sys.argv[1:]))